@@ -153,6 +153,25 @@ def main():
             'tracker_maxpeers': {
                 'type': 'int',  'default': None,     'required': False},
 
+            'tracker_policy': {
+                'type': 'str',  'default': None,     'required': False,
+                'choices': ['random', 'topology']},
+
+            'tracker_udp_port': {
+                'type': 'int',  'default': None,     'required': False},
+
+            'tracker_sync_interval': {
+                'type': 'int',  'default': None,     'required': False},
+
+            'tracker_max_interval': {
+                'type': 'int',  'default': None,     'required': False},
+
+            'tracker_swarm_size': {
+                'type': 'int',  'default': None,     'required': False},
+
+            'tracker_jitter': {
+                'type': 'int',  'default': None,     'required': False},
+
             'torrent_listen_port_min': {
                 'type': 'int',  'default': None,     'required': False},
 
@@ -168,6 +187,12 @@ def main():
             'lweb_pidfile': {
                 'type': 'str',  'default': None,     'required': False},
 
+            'lweb_db_threads': {
+                'type': 'int',  'default': None,     'required': False},
+
+            'cache_ttl': {
+                'type': 'int',  'default': None,     'required': False},
+
             'cluster_ips': {
                 'type': 'str',  'default': None,     'required': False},
 
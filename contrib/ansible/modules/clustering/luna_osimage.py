@@ -38,7 +38,7 @@ def luna_osimage_present(data):
 
     for key in ['path', 'kernver', 'kernopts',
                 'dracutmodules', 'kernmodules', 'grab_exclude_list',
-                'grab_filesystems']:
+                'grab_filesystems', 'codec', 'format']:
         if data[key] and data[key] != osimage.get(key):
             ret &= osimage.set(key, data[key])
             changed = True
@@ -47,14 +47,19 @@ def luna_osimage_present(data):
         ret &= osimage.set('comment', data['comment'])
         changed = True
 
+    for key in ['delta', 'incremental', 'stream']:
+        if (data[key] is not None and
+                data[key] != bool(osimage.get(key))):
+            ret &= osimage.set(key, data[key])
+            changed = True
+
     if data['pack']:
         changed = True
         if data['copy_boot']:
             ret &= osimage.copy_boot()
         else:
             ret &= osimage.pack_boot()
-        ret &= osimage.create_tarball()
-        ret &= osimage.create_torrent()
+        ret &= osimage.create_tarball(torrent=True)
 
     return not ret, changed, osimage.get('name')
 
@@ -109,6 +114,23 @@ def main():
             'grab_filesystems': {
                 'type': 'str', 'default': '', 'required': False},
 
+            'codec': {
+                'type': 'str', 'default': '', 'required': False,
+                'choices': ['', 'pigz', 'zstd', 'none']},
+
+            'format': {
+                'type': 'str', 'default': '', 'required': False,
+                'choices': ['', 'tar', 'squashfs']},
+
+            'delta': {
+                'type': 'bool', 'default': None, 'required': False},
+
+            'incremental': {
+                'type': 'bool', 'default': None, 'required': False},
+
+            'stream': {
+                'type': 'bool', 'default': None, 'required': False},
+
             'pack': {
                 'type': 'bool', 'default': False, 'required': False},
 
@@ -134,6 +134,32 @@ function _get_luna_ctty () {
     [ "x${luna_ctty}" = "x" ] && luna_ctty="/dev/tty1"
     echo -n $luna_ctty
 }
+function _get_install_script () {
+    # script is fetched again after every failed install attempt.
+    # lweb answers 304 if the script is not changed since last download
+    local luna_url luna_node etag code
+    luna_url=$1
+    luna_node=$2
+    etag=""
+    if [ -s /luna/install.sh -a -s /luna/install.etag ]; then
+        etag=$(cat /luna/install.etag)
+    fi
+    code=$(curl -s -m 60 --connect-timeout 10 \
+        -H "If-None-Match: ${etag}" -D /luna/install.headers \
+        -o /luna/install.sh.new -w '%{http_code}' \
+        "$luna_url?step=install&node=$luna_node")
+    if [ "x$code" = "x304" ]; then
+        echo "Luna: Install script is not changed."
+        return 0
+    fi
+    if [ "x$code" != "x200" ]; then
+        return 1
+    fi
+    mv /luna/install.sh.new /luna/install.sh
+    sed -n 's/^[Ee][Tt][Aa][Gg]: *\([^\r]*\)\r*$/\1/p' \
+        /luna/install.headers > /luna/install.etag
+    return 0
+}
 if [ "x$root" = "xluna" ]; then
     luna_start
     luna_ctty=$(_get_luna_ctty)
@@ -147,7 +173,7 @@ if [ "x$root" = "xluna" ]; then
         RES="failure"
         while [ "x$RES" = "xfailure" ]; do
             echo "Luna: Trying to get install script."
-            while ! curl -f -s -m 60 --connect-timeout 10 "$luna_url?step=install&node=$luna_node" > /luna/install.sh; do
+            while ! _get_install_script "$luna_url" "$luna_node"; do
                 echo "Luna: Could not get install script. Sleeping 10 sec."
                 sleep 10
             done
@@ -11,9 +11,14 @@ depends() {
 }
 
 install() {
-    dracut_install ssh sshd scp tar wget curl awk sed gzip basename dd partx \
+    dracut_install ssh sshd scp tar wget curl awk sed gzip basename dd partx xargs \
                    parted mkfs.ext2 mkfs.ext3 mkfs.ext4 mkfs.xfs ipmitool \
-                   blkdiscard fstrim nslookup dig
+                   blkdiscard fstrim nslookup dig mkfifo
+    # needed for tarballs packed with zstd only
+    dracut_install -o zstd
+    # needed for squashfs osimages only
+    dracut_install -o unsquashfs
+    instmods squashfs loop overlay
     inst_libdir_file libnssdbm3.so libnsspem.so libsoftokn3.chk \
                      libsoftokn3.so libsqlite3.so
 
@@ -20,14 +20,22 @@
 */
 #include <stdlib.h>
 #include <unistd.h>
+#include <fcntl.h>
+#include <errno.h>
+#include <cstdio>
 #include <csignal>
 #include <iostream>
 #include <fstream>
+#include <map>
+#include <set>
 #include "boost/asio/error.hpp"
 #include "libtorrent/entry.hpp"
 #include "libtorrent/bencode.hpp"
 #include "libtorrent/session.hpp"
-#include "libtorrent/session.hpp"
+#include "libtorrent/alert_types.hpp"
+
+// pieces requested from libtorrent ahead of the one written to stream
+#define STREAM_WINDOW 16
 
 
 
@@ -42,6 +50,77 @@ bool yes(libtorrent::torrent_status const&)
 void exit_signalHandler( int signum ) {
     run = 0;
 }
+int write_all(int fd, const char *buf, int size) {
+    while (size > 0) {
+        int written = write(fd, buf, size);
+        if (written < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+            return -1;
+        }
+        buf += written;
+        size -= written;
+    }
+    return 0;
+}
+
+/*
+* Download pieces in order and write them to outfd as soon as they are
+* verified, so data can be unpacked while torrent is still downloading.
+* Pieces are read back by libtorrent, as they could be in its cache only.
+*/
+int stream_torrent(libtorrent::torrent_handle &torrent, int num_pieces, int outfd, int delay) {
+    using namespace libtorrent;
+
+    std::map<int, std::pair<boost::shared_array<char>, int> > ready;
+    std::set<int> requested;
+    int next_piece = 0;
+    int ticks = 0;
+
+    torrent.set_sequential_download(true);
+
+    while (next_piece < num_pieces && run) {
+        for (int i = next_piece; i < num_pieces && i < next_piece + STREAM_WINDOW; i++) {
+            if (requested.count(i) == 0 && torrent.have_piece(i)) {
+                torrent.read_piece(i);
+                requested.insert(i);
+            }
+        }
+
+        std::auto_ptr<alert> a = s.pop_alert();
+        while (a.get()) {
+            read_piece_alert *rp = alert_cast<read_piece_alert>(a.get());
+            if (rp) {
+                if (rp->buffer) {
+                    ready[rp->piece] = std::make_pair(rp->buffer, rp->size);
+                } else {
+                    // will be requested again
+                    fprintf(stderr, "Unable to read piece %i\n", rp->piece);
+                    requested.erase(rp->piece);
+                }
+            }
+            a = s.pop_alert();
+        }
+
+        while (ready.count(next_piece)) {
+            if (write_all(outfd, ready[next_piece].first.get(), ready[next_piece].second) < 0) {
+                perror("write");
+                return 1;
+            }
+            ready.erase(next_piece);
+            requested.erase(next_piece);
+            next_piece++;
+        }
+
+        usleep(100000);
+        if (delay > 0 && ++ticks % (delay * 10) == 0) {
+            torrent.force_reannounce();
+        }
+    }
+    return 0;
+}
+
 void printhelp(char *s) {
     fprintf(stdout, "Usage: %s [-option] [argument]\n" ,s);
     fprintf(stdout, "       -h                  Print help.\n");
@@ -50,6 +129,7 @@ void printhelp(char *s) {
     fprintf(stdout, "       -f PIDFILE          File to write own pid to. (%s.pid by default)\n", s);
     fprintf(stdout, "       -b XXX.XXX.XXX.XXX  IP to bind. (0.0.0.0 by default)\n");
     fprintf(stdout, "       -d NUM              Sent announce to tracker every NUM sec. (10 sec by default)\n");
+    fprintf(stdout, "       -o FILE             Download sequentially and write data to FILE (fifo) in order.\n");
     exit(1);
 }
 
@@ -64,12 +144,14 @@ int main(int argc, char* argv[])
         int mypid;
         char pidfilename[255];
         char ip[16];
+        char outfilename[255];
         int delay = 10;
+        outfilename[0] = 0;
         strcpy(ip, "0.0.0.0");
         strcpy(pidfilename, argv[0]);
         strcat(pidfilename, ".pid");
 
-        while((tmp=getopt(argc,argv,"ht:p:f:b:d:"))!=-1) {
+        while((tmp=getopt(argc,argv,"ht:p:f:b:d:o:"))!=-1) {
              switch(tmp) {
                 case 'h':
                     printhelp(argv[0]);
@@ -89,6 +171,9 @@ int main(int argc, char* argv[])
                 case 'd':
                     delay = atoi(optarg);
                     break;
+                case 'o':
+                    strcpy(outfilename, optarg);
+                    break;
                 default:
                     printhelp(argv[0]);
                     break;
@@ -145,6 +230,23 @@ int main(int argc, char* argv[])
         pidfile << "\n";
         pidfile.close();
 
+        if (outfilename[0]) {
+            // reader exits on error, should not kill us
+            std::signal(SIGPIPE, SIG_IGN);
+            s.set_alert_mask(alert::storage_notification | alert::error_notification);
+            // blocks until reader opens the fifo
+            int outfd = open(outfilename, O_WRONLY | O_CREAT, 0644);
+            if (outfd < 0) {
+                perror(outfilename);
+            } else {
+                if (stream_torrent(torrent, p.ti->num_pieces(), outfd, delay)) {
+                    fprintf(stderr, "Streaming to %s failed\n", outfilename);
+                }
+                // EOF for the reader
+                close(outfd);
+            }
+        }
+
         std::vector<torrent_status> vts;
         s.get_torrent_status(&vts, &yes, 0);
         torrent_status& st = vts[0];
@@ -22,8 +22,6 @@ along with Luna.  If not, see <http://www.gnu.org/licenses/>.
 
 from config import *
 
-import logging
-import pymongo
 
 from cluster import Cluster
 from osimage import OsImage
@@ -34,6 +32,7 @@ from switch import Switch
 from network import Network
 from tracker import *
 from manager import Manager
+from metrics import MetricsHandler
 from otherdev import OtherDev
 from mac_updater import MacUpdater
 import utils
@@ -41,24 +40,14 @@ import utils
 
 __version__ = '1.2'
 __all__ = ['cluster', 'osimage', 'bmcsetup', 'group', 'node', 'switch',
-           'network', 'tracker', 'manager', 'mac_updater', 'utils']
+           'network', 'tracker', 'manager', 'metrics', 'mac_updater',
+           'utils']
 __author__ = 'Dmitry Chirikov'
 
 
-def list(collection):
-    logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger(__name__)
-
-    try:
-        mongo_client = pymongo.MongoClient(**utils.helpers.get_con_options())
-    except:
-        err_msg = "Unable to connect to MongoDB."
-        logger.error(err_msg)
-        raise RuntimeError, err_msg
-
-    logger.debug("Connection to MongoDB was successful.")
-
-    mongo_db = mongo_client[db_name]
+def list(collection, mongo_db=None):
+    if mongo_db is None:
+        mongo_db = utils.helpers.get_mongo_db()
     mongo_collection = mongo_db[collection]
 
     ret = []
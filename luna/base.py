@@ -20,9 +20,8 @@ along with Luna.  If not, see <http://www.gnu.org/licenses/>.
 
 '''
 
-from config import db_name, use_key, usedby_key
+from config import use_key, usedby_key
 
-import pymongo
 import inspect
 import logging
 
@@ -49,6 +48,9 @@ class Base(object):
     _name = None
     _DBRef = None
     _json = None
+    # changes of the object invalidate stored node params
+    _params_dep = False
+    _params_skip_keys = []
 
     def __init__(self):
         """
@@ -110,20 +112,17 @@ class Base(object):
         if mongo_db:
             self._mongo_db = mongo_db
         else:
-            try:
-                client = pymongo.MongoClient(**utils.helpers.get_con_options())
-            except:
-                err_msg = "Unable to connect to MongoDB."
-                self.log.error(err_msg)
-                raise RuntimeError, err_msg
-
-            self.log.debug("Connection to MongoDB was successful.")
-            self._mongo_db = client[db_name]
+            self._mongo_db = utils.helpers.get_mongo_db()
 
         self._mongo_collection = self._mongo_db[self._collection_name]
 
-        self._json = self._mongo_collection.find_one({'$or': [{'name': name},
-                                                              {'_id': id}]})
+        self._json = utils.cache.get(self._mongo_db, self._collection_name,
+                                     id=id, name=name)
+
+        if self._json is None:
+            self._json = self._mongo_collection.find_one(
+                {'$or': [{'name': name}, {'_id': id}]})
+            utils.cache.put(self._mongo_db, self._collection_name, self._json)
 
         if not create and not self._json:
             err_msg = ("Object '{}' of type '{}' does not exist"
@@ -174,20 +173,68 @@ class Base(object):
 
         return None
 
+    def _invalidate_cache(self, key=None):
+        """
+        Drop document of this object from the cache and
+        stored node params depending on it
+        """
+
+        utils.cache.invalidate(self._mongo_db, self._collection_name, self._id)
+
+        if self._params_dep and key not in self._params_skip_keys:
+            utils.helpers.invalidate_params(self._mongo_db, [self._id])
+
     def _get_json(self):
         """Return document as stored in DB in json format"""
 
         return self._json
 
+    def _resolve_names(self, dbrefs, names=None):
+        """
+        Returns {DBRef: name} for the list of DBRefs.
+        Names are fetched using one query per collection.
+        'names' can contain already resolved DBRefs
+        """
+
+        if names is None:
+            names = {}
+
+        ids = {}
+        for dbref in dbrefs:
+            if dbref in names:
+                continue
+            ids.setdefault(dbref.collection, set()).add(dbref.id)
+
+        for collection in ids:
+            mongo_collection = self._mongo_db[collection]
+            docs = mongo_collection.find(
+                {'_id': {'$in': list(ids[collection])}}, {'name': 1})
+
+            for doc in docs:
+                if 'name' in doc:
+                    names[DBRef(collection, doc['_id'])] = doc['name']
+
+        return names
+
     def show(self):
+        def get_dbrefs(json):
+            if type(json) is DBRef:
+                return [json]
+            if type(json) is dict:
+                json = json.values()
+            if type(json) is not list:
+                return []
+            dbrefs = []
+            for elem in json:
+                dbrefs.extend(get_dbrefs(elem))
+            return dbrefs
+
         def get_value(value):
             if type(value) is not DBRef:
                 return value
             dbref = value
-            mongo_collection = self._mongo_db[dbref.collection]
             try:
-                name = mongo_collection.find_one({'_id': dbref.id})['name']
-                name = '[' + name + ']'
+                name = '[' + names[dbref] + ']'
             except:
                 name = '[id_' + str(dbref.id) + ']'
             return name
@@ -223,6 +270,7 @@ class Base(object):
             json.pop(usedby_key)
         except:
             pass
+        names = self._resolve_names(get_dbrefs(json))
         return resolve_links(json)
 
     def get(self, key):
@@ -250,6 +298,7 @@ class Base(object):
         return value
 
     def store(self, obj):
+        obj[use_key] = {}
         obj[usedby_key] = {}
         self._id = self._mongo_collection.insert(obj)
 
@@ -286,6 +335,7 @@ class Base(object):
         self._mongo_collection.update({'_id': self._id},
                                       {'$set': {key: value}},
                                       multi=False, upsert=False)
+        self._invalidate_cache(key)
 
         self._json[key] = value
 
@@ -305,9 +355,8 @@ class Base(object):
 
         return True
 
-    def link(self, remote_dbref):
-        """Unlink objects in MongoDB"""
-        self.log.debug("function args {}".format(self._debug_function()))
+    def _get_remote_dbref(self, remote_dbref):
+        """Returns DBRef for the object to link to or None"""
 
         try:
             remote_dbref = remote_dbref.DBRef
@@ -322,47 +371,107 @@ class Base(object):
             self.log.error("Can't link an object to itself")
             return None
 
-        use_doc = self._mongo_collection.find_one({'_id': self._id},
-                                                  {use_key: 1, '_id': 0})
+        return remote_dbref
+
+    def _add_links(self, mongo_collection, ids, key, dbref, count=1):
+        """
+        Atomically increments key.<collection>.<id> counter of dbref
+        in all the documents with given ids.
+        Returns number of updated documents.
+        """
+
+        coll_path = '.'.join([key, dbref.collection])
+        path = '.'.join([coll_path, str(dbref.id)])
+
+        # Multi-document update does not tell which documents were
+        # updated, so a document which got its first link to the
+        # collection from another writer could not be retried
+        updated = 0
+        for obj_id in ids:
+            updated += self._add_link(mongo_collection, obj_id, coll_path,
+                                      path, str(dbref.id), count)
+
+        return updated
+
+    def _add_link(self, mongo_collection, obj_id, coll_path, path, link_id,
+                  count):
+        """
+        Increments counter of the link in the document obj_id.
+        Returns 1 or 0 if there is no such document.
+        """
+
+        while True:
+            ret = mongo_collection.update(
+                {'_id': obj_id, coll_path: {'$exists': True}},
+                {'$inc': {path: count}}, multi=False)
+            if ret['n']:
+                return 1
+
+            # no links to this collection yet
+            ret = mongo_collection.update(
+                {'_id': obj_id, coll_path: {'$exists': False}},
+                {'$set': {coll_path: {link_id: count}}}, multi=False)
+            if ret['n']:
+                return 1
+
+            # another writer created the subdocument between the updates
+            # or removed the document
+            if not mongo_collection.find_one({'_id': obj_id}, {'_id': 1}):
+                return 0
+
+    def _del_links(self, mongo_collection, ids, key, dbref, count=1):
+        """
+        Atomically decrements key.<collection>.<id> counter of dbref
+        in all the documents with given ids. Counters dropped to zero
+        are removed as well as empty collection subdocuments.
+        Returns number of updated documents.
+        """
+
+        coll_path = '.'.join([key, dbref.collection])
+        path = '.'.join([coll_path, str(dbref.id)])
+
+        steps = [
+            # last link to the collection
+            ({coll_path: {str(dbref.id): count}}, {'$unset': {coll_path: ''}}),
+            # last link to the object
+            ({path: count}, {'$unset': {path: ''}}),
+            ({path: {'$gt': count}}, {'$inc': {path: -count}}),
+        ]
+
+        updated = 0
+        for query, update in steps:
+            query['_id'] = {'$in': ids}
+            ret = mongo_collection.update(query, update, multi=True)
+            updated += ret['n']
+
+            if updated >= len(ids):
+                break
+
+        return updated
+
+    def link(self, remote_dbref):
+        """Link objects in MongoDB"""
+        self.log.debug("function args {}".format(self._debug_function()))
+
+        remote_dbref = self._get_remote_dbref(remote_dbref)
+        if not remote_dbref:
+            return None
 
         remote_collection = self._mongo_db[remote_dbref.collection]
-        usedby_doc = remote_collection.find_one({'_id': remote_dbref.id},
-                                                {usedby_key: 1, '_id': 0})
-        try:
-            use_doc = use_doc[use_key]
-        except:
-            use_doc = {}
-        try:
-            usedby_doc = usedby_doc[usedby_key]
-        except:
-            usedby_doc = {}
-        try:
-            links = use_doc[remote_dbref.collection][str(remote_dbref.id)]
-        except:
-            links = 0
-        try:
-            backlinks = usedby_doc[self._DBRef.collection][str(self._DBRef.id)]
-        except:
-            backlinks = 0
-        links += 1
-        backlinks += 1
-        try:
-            use_doc[remote_dbref.collection][str(remote_dbref.id)] = links
-        except:
-            use_doc[remote_dbref.collection] = {}
-            use_doc[remote_dbref.collection][str(remote_dbref.id)] = links
-        try:
-            usedby_doc[self._DBRef.collection][str(self._DBRef.id)] = backlinks
-        except:
-            usedby_doc[self._DBRef.collection] = {}
-            usedby_doc[self._DBRef.collection][str(self._DBRef.id)] = backlinks
-        self._mongo_collection.update({'_id': self._id},
-                                      {'$set': {use_key: use_doc}})
-        remote_collection.update({'_id': remote_dbref.id},
-                                 {'$set': {usedby_key: usedby_doc}})
+
+        self._add_links(self._mongo_collection, [self._id],
+                        use_key, remote_dbref)
+        self._add_links(remote_collection, [remote_dbref.id],
+                        usedby_key, self._DBRef)
+
+        self._invalidate_cache()
+        utils.cache.invalidate(self._mongo_db, remote_dbref.collection,
+                               remote_dbref.id)
+
+        return True
 
     def unlink(self, remote_dbref):
-        """Link objects in MongoDB"""
+        """Unlink objects in MongoDB"""
         self.log.debug("function args {}".format(self._debug_function()))
 
         try:
@@ -381,54 +490,136 @@ class Base(object):
             return None
 
         remote_collection = self._mongo_db[remote_dbref.collection]
-        use_doc = self._mongo_collection.find_one({'_id': self._id},
-                                                  {use_key: 1, '_id': 0})
-        usedby_doc = remote_collection.find_one({'_id': remote_dbref.id},
-                                                {usedby_key: 1, '_id': 0})
-        try:
-            use_doc = use_doc[use_key]
-        except:
-            use_doc = {}
-        try:
-            usedby_doc = usedby_doc[usedby_key]
-        except:
-            usedby_doc = {}
-        try:
-            links = use_doc[remote_dbref.collection][str(remote_dbref.id)]
-        except:
-            links = 0
-        try:
-            backlinks = usedby_doc[self._DBRef.collection][str(self._DBRef.id)]
-        except:
-            backlinks = 0
 
-        if links < 1:
+        if not self._del_links(self._mongo_collection, [self._id],
+                               use_key, remote_dbref):
             self.log.error("No links to this object. Cannot unlink.")
             return None
 
-        if backlinks < 1:
+        if not self._del_links(remote_collection, [remote_dbref.id],
+                               usedby_key, self._DBRef):
             self.log.error(("Link to this objct exists, "
                             "but no backlinks to this object. Cannot unlink."))
+            self._add_links(self._mongo_collection, [self._id],
+                            use_key, remote_dbref)
             return None
 
-        links -= 1
-        backlinks -= 1
-        if links < 1:
-            use_doc[remote_dbref.collection].pop(str(remote_dbref.id))
-            if len(use_doc[remote_dbref.collection]) < 1:
-                use_doc.pop(remote_dbref.collection)
-        else:
-            use_doc[remote_dbref.collection][str(remote_dbref.id)] = links
-        if backlinks < 1:
-            usedby_doc[self._DBRef.collection].pop(str(self._DBRef.id))
-            if len(usedby_doc[self._DBRef.collection]) < 1:
-                usedby_doc.pop(self._DBRef.collection)
-        else:
-            usedby_doc[self._DBRef.collection][str(self._DBRef.id)] = backlinks
-        self._mongo_collection.update({'_id': self._id},
-                                      {'$set': {use_key: use_doc}})
-        remote_collection.update({'_id': remote_dbref.id},
-                                 {'$set': {usedby_key: usedby_doc}})
+        self._invalidate_cache()
+        utils.cache.invalidate(self._mongo_db, remote_dbref.collection,
+                               remote_dbref.id)
+
+        return True
+
+    def _group_links(self, remote_dbrefs):
+        """
+        Returns {(collection, count): [ids]} for the list of objects
+        or None if some of them can't be linked
+        """
+
+        counts = {}
+        for remote_dbref in remote_dbrefs:
+            remote_dbref = self._get_remote_dbref(remote_dbref)
+            if not remote_dbref:
+                return None
+
+            counts[remote_dbref] = counts.get(remote_dbref, 0) + 1
+
+        groups = {}
+        for remote_dbref, count in counts.items():
+            group = (remote_dbref.collection, count)
+            groups.setdefault(group, []).append(remote_dbref.id)
+
+        return groups
+
+    def link_many(self, remote_dbrefs):
+        """
+        Link object to the list of objects in MongoDB.
+        One update is sent for every remote collection
+        """
+        self.log.debug("function args {}".format(self._debug_function()))
+
+        groups = self._group_links(remote_dbrefs)
+        if groups is None:
+            return None
+
+        use_inc = {}
+        use_query = {'_id': self._id}
+        for (collection, count), ids in groups.items():
+            coll_path = '.'.join([use_key, collection])
+            use_query[coll_path] = {'$exists': True}
+            for remote_id in ids:
+                use_inc['.'.join([coll_path, str(remote_id)])] = count
+
+        if not use_inc:
+            return True
+
+        ret = self._mongo_collection.update(use_query, {'$inc': use_inc})
+        if not ret['n']:
+            # some of the collections are not linked yet
+            for (collection, count), ids in groups.items():
+                for remote_id in ids:
+                    self._add_links(self._mongo_collection, [self._id],
+                                    use_key, DBRef(collection, remote_id),
+                                    count)
+
+        for (collection, count), ids in groups.items():
+            remote_collection = self._mongo_db[collection]
+            self._add_links(remote_collection, ids,
+                            usedby_key, self._DBRef, count)
+
+            for remote_id in ids:
+                utils.cache.invalidate(self._mongo_db, collection, remote_id)
+
+        self._invalidate_cache()
+
+        return True
+
+    def unlink_many(self, remote_dbrefs):
+        """
+        Unlink object from the list of objects in MongoDB.
+        One set of updates is sent for every remote collection
+        """
+        self.log.debug("function args {}".format(self._debug_function()))
+
+        groups = self._group_links(remote_dbrefs)
+        if groups is None:
+            return None
+
+        unlinked = []
+        for (collection, count), ids in groups.items():
+            for remote_id in ids:
+                remote_dbref = DBRef(collection, remote_id)
+
+                if self._del_links(self._mongo_collection, [self._id],
+                                   use_key, remote_dbref, count):
+                    unlinked.append((remote_dbref, count))
+                    continue
+
+                self.log.error(("No links to '{}'. Cannot unlink."
+                                .format(remote_dbref)))
+
+                for remote_dbref, count in unlinked:
+                    self._add_links(self._mongo_collection, [self._id],
+                                    use_key, remote_dbref, count)
+
+                self._invalidate_cache()
+                return None
+
+        for (collection, count), ids in groups.items():
+            remote_collection = self._mongo_db[collection]
+            updated = self._del_links(remote_collection, ids,
+                                      usedby_key, self._DBRef, count)
+
+            if updated < len(ids):
+                self.log.error(("Some of the objects in '{}' have no "
+                                "backlinks to this object".format(collection)))
+
+            for remote_id in ids:
+                utils.cache.invalidate(self._mongo_db, collection, remote_id)
+
+        self._invalidate_cache()
+
+        return True
 
     def get_links(self, resolve=False, collection=None):
         """Enumerates all references"""
@@ -449,20 +640,20 @@ class Base(object):
             use_doc = {}
             use_doc['collection'] = collection_objs
 
-        output = []
+        dbrefs = []
         for col_iter in use_doc:
             for uid in use_doc[col_iter]:
-                dbref = DBRef(col_iter, ObjectId(uid))
-                remote_col = self._mongo_db[dbref.collection]
-                if not resolve:
-                    name = str(dbref.id)
-                else:
-                    try:
-                        name = remote_col.find_one({'_id': dbref.id})['name']
-                    except:
-                        name = str(dbref.id)
-                output.extend([{'collection': dbref.collection,
-                                'name': name, 'DBRef': dbref}])
+                dbrefs.append(DBRef(col_iter, ObjectId(uid)))
+
+        names = {}
+        if resolve:
+            names = self._resolve_names(dbrefs)
+
+        output = []
+        for dbref in dbrefs:
+            name = names.get(dbref, str(dbref.id))
+            output.extend([{'collection': dbref.collection,
+                            'name': name, 'DBRef': dbref}])
         return output
 
     def get_back_links(self, resolve=False, collection=None):
@@ -484,20 +675,20 @@ class Base(object):
             usedby_doc = {}
             usedby_doc['collection'] = collection_objs
 
-        output = []
+        dbrefs = []
         for col_iter in usedby_doc:
             for uid in usedby_doc[col_iter]:
-                dbref = DBRef(col_iter, ObjectId(uid))
-                remote_col = self._mongo_db[dbref.collection]
-                if not resolve:
-                    name = str(dbref.id)
-                else:
-                    try:
-                        name = remote_col.find_one({'_id': dbref.id})['name']
-                    except:
-                        name = str(dbref.id)
-                output.extend([{'collection': dbref.collection,
-                                'name': name, 'DBRef': dbref}])
+                dbrefs.append(DBRef(col_iter, ObjectId(uid)))
+
+        names = {}
+        if resolve:
+            names = self._resolve_names(dbrefs)
+
+        output = []
+        for dbref in dbrefs:
+            name = names.get(dbref, str(dbref.id))
+            output.extend([{'collection': dbref.collection,
+                            'name': name, 'DBRef': dbref}])
         return output
 
     def cleanup_links(self):
@@ -514,8 +705,8 @@ class Base(object):
 
             return False
 
-        for link in links:
-            self.unlink(link['DBRef'])
+        if links:
+            self.unlink_many([link['DBRef'] for link in links])
 
         return True
 
@@ -533,6 +724,7 @@ class Base(object):
         self.release_resources()
 
         ret = self._mongo_collection.remove({'_id': self._id}, multi=False)
+        self._invalidate_cache()
         self._wipe_vars()
 
         return not ret['err']
@@ -34,6 +34,7 @@ class BMCSetup(Base):
     """
 
     log = logging.getLogger(__name__)
+    _params_dep = True
 
     def __init__(self, name=None, mongo_db=None, create=False, id=None,
                  userid=3, user='ladmin', password='ladmin',
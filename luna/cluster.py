@@ -31,7 +31,6 @@ import logging
 import subprocess
 
 from bson.objectid import ObjectId
-from tornado import template
 from pymongo.errors import OperationFailure
 
 from luna.base import Base
@@ -75,11 +74,19 @@ class Cluster(Base):
                          'tracker_interval': type(0),
                          'tracker_min_interval': type(0),
                          'tracker_maxpeers': type(0),
+                         'tracker_policy': type(''),
+                         'tracker_udp_port': type(0),
+                         'tracker_sync_interval': type(0),
+                         'tracker_max_interval': type(0),
+                         'tracker_swarm_size': type(0),
+                         'tracker_jitter': type(0),
                          'torrent_listen_port_min': type(0),
                          'torrent_listen_port_max': type(0),
                          'torrent_pidfile': type(''),
                          'lweb_pidfile': type(''),
                          'lweb_num_proc': type(0),
+                         'lweb_db_threads': type(0),
+                         'cache_ttl': type(0),
                          'cluster_ips': type(''),
                          'named_include_file': type(''),
                          'named_zone_dir': type(''),
@@ -147,7 +154,15 @@ class Cluster(Base):
                        'tracker_interval': 10,
                        'tracker_min_interval': 5,
                        'tracker_maxpeers': 200,
+                       'tracker_policy': 'topology',
+                       'tracker_udp_port': 7050,
+                       'tracker_sync_interval': 1000,
+                       'tracker_max_interval': 120,
+                       'tracker_swarm_size': 100,
+                       'tracker_jitter': 10,
                        'lweb_num_proc': 0,
+                       'lweb_db_threads': 8,
+                       'cache_ttl': 5,
                        'lweb_pidfile': '/run/luna/lweb.pid',
                        'named_include_file': '/etc/named.luna.zones',
                        'named_zone_dir': '/var/named',
@@ -232,6 +247,17 @@ class Cluster(Base):
                 self.log.error("No such user exists.")
                 return False
 
+        elif key == 'tracker_jitter':
+            if value < 0 or value > 100:
+                self.log.error("Tracker jitter should be within 0-100%.")
+                return False
+
+        elif key == 'tracker_policy':
+            if value not in ['random', 'topology']:
+                self.log.error("Tracker policy should be "
+                               "'random' or 'topology'.")
+                return False
+
         elif key == 'cluster_ips':
             if not bool(value):
                 value = ''
@@ -389,7 +415,7 @@ class Cluster(Base):
         conf_primary = {}
         conf_secondary = {}
 
-        tloader = template.Loader(self.get('path') + '/templates')
+        templates_path = self.get('path') + '/templates'
 
         if self.is_ha() and ask_ha:
 
@@ -401,11 +427,13 @@ class Cluster(Base):
             conf_primary['peer_addr'] = conf_secondary['my_addr']
             conf_secondary['peer_addr'] = conf_primary['my_addr']
 
-            dhcpd_conf_primary = tloader.load('templ_dhcpd.cfg').generate(
+            dhcpd_conf_primary = utils.templates.render(
+                templates_path, 'templ_dhcpd.cfg',
                 c=c, conf_primary=conf_primary,
                 conf_secondary=None)
 
-            dhcpd_conf_secondary = tloader.load('templ_dhcpd.cfg').generate(
+            dhcpd_conf_secondary = utils.templates.render(
+                templates_path, 'templ_dhcpd.cfg',
                 c=c, conf_primary=None,
                 conf_secondary=conf_secondary)
 
@@ -419,7 +447,8 @@ class Cluster(Base):
 
             return True
 
-        dhcpd_conf = tloader.load('templ_dhcpd.cfg').generate(
+        dhcpd_conf = utils.templates.render(
+            templates_path, 'templ_dhcpd.cfg',
             c=c, conf_primary=None, conf_secondary=None)
 
         f1 = open('/etc/dhcp/dhcpd.conf', 'w')
@@ -522,7 +551,7 @@ class Cluster(Base):
         serial_num = 1
 
         for netid in netids:
-            netobj = Network(id=ObjectId(netid))
+            netobj = Network(id=ObjectId(netid), mongo_db=self._mongo_db)
             self.log.debug('Network {}'. format(netobj.name))
             net_zone_data = netobj.zone_data
             self.log.debug('net_zone_data: {}'.format(zone_data))
@@ -622,14 +651,14 @@ class Cluster(Base):
             zone['data'] = zone_data[6]['reverse'][rev_name6]
             zones.append(zone)
 
-        tloader = template.Loader(self.get('path') + '/templates',
-                                  autoescape=None)
+        templates_path = self.get('path') + '/templates'
 
         # create include file for named.conf
         namedconffile = open(includefile, 'w')
 
         namedconffile.write(
-            tloader.load('templ_named_conf.cfg').generate(z=zones)
+            utils.templates.render(templates_path, 'templ_named_conf.cfg',
+                                   autoescape=None, z=zones)
         )
 
         namedconffile.close()
@@ -668,7 +697,8 @@ class Cluster(Base):
 
             with open(zonefilepath, 'w') as zonefile:
                 zonefile.write(
-                    tloader.load(zone['template']).generate(z=zone['data'])
+                    utils.templates.render(templates_path, zone['template'],
+                                           autoescape=None, z=zone['data'])
                 )
 
             if nameduid and namedgid:
@@ -687,6 +717,7 @@ class Cluster(Base):
         if force:
             # this will return None
             self._mongo_db.connection.drop_database(db_name)
+            utils.cache.clear(self._mongo_db)
             try:
                 if db_name in self._mongo_db.connection.database_names():
                     self.log.error('Unable to delete DB \'{}\''.format(db_name))
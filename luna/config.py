@@ -22,6 +22,7 @@ along with Luna.  If not, see <http://www.gnu.org/licenses/>.
 
 use_key = '_use_'
 usedby_key = '_usedby_'
+params_collection = 'node_params'
 db_name = 'luna'
 torrent_key = 'Luna'
 db_version = 1.2
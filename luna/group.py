@@ -26,6 +26,7 @@ import logging
 import uuid
 
 from bson.objectid import ObjectId
+from bson.dbref import DBRef
 
 from luna import utils
 from luna.base import Base
@@ -39,6 +40,7 @@ class Group(Base):
     """Class for operating with group records"""
 
     log = logging.getLogger(__name__)
+    _params_dep = True
 
     def __init__(self, name=None, mongo_db=None, create=False,
                  id=None, prescript='', bmcsetup=None,
@@ -126,15 +128,15 @@ class Group(Base):
 
             # Link this group to its dependencies and the current cluster
 
-            self.link(cluster)
+            links = [cluster, osimageobj]
 
             if bmcobj:
-                self.link(bmcobj)
+                links.append(bmcobj)
 
             if domainobj:
-                self.link(domainobj)
+                links.append(domainobj)
 
-            self.link(osimageobj)
+            self.link_many(links)
 
         self.log = logging.getLogger('group.' + self._name)
         self._networks = {}
@@ -261,11 +263,44 @@ class Group(Base):
         else:
             params['torrent'] = ''
 
+        codec = osimage.get('tarball_codec')
+        fmt = osimage.get('tarball_format')
+        params['image_format'] = fmt or utils.pack.DEFAULT_FORMAT
+        params['tar_flags'] = utils.pack.get_codec(codec)['tar_flags']
+        if osimage.get('tarball_segmented'):
+            # do not stop on end-of-archive of the first segment
+            params['tar_flags'] += ' -i'
+
+        params['tarball_id'] = params['tarball'] or ''
         if params['tarball']:
-            params['tarball'] += ".tgz"
+            params['tarball'] = utils.pack.tarball_name(params['tarball'],
+                                                        codec, fmt)
         else:
             params['tarball'] = ''
 
+        # /etc/{passwd,group} of the image to be fetched before tarball
+        params['accounts'] = ''
+        if params['tarball_id'] and osimage.get('tarball_accounts'):
+            params['accounts'] = utils.pack.accounts_name(
+                params['tarball_id'])
+
+        # tarball is unpacked while being downloaded, so users and
+        # groups can not be taken from it
+        params['stream'] = bool(osimage.get('stream') and
+                                params['image_format'] == 'tar' and
+                                params['accounts'])
+
+        # nodes having tarball 'base' on disk can download delta only
+        params['delta'] = {}
+        delta_uid = osimage.get('delta_tarball')
+        if delta_uid and osimage.get('delta_torrent'):
+            params['delta'] = {
+                'base': osimage.get('delta_base'),
+                'torrent': osimage.get('delta_torrent') + '.torrent',
+                'tarball': utils.pack.tarball_name(delta_uid, codec),
+                'removed': delta_uid + '.removed',
+            }
+
         params['bmcsetup'] = {}
         if self.get('bmcsetup'):
 
@@ -964,32 +999,51 @@ class Group(Base):
         self.set_domain(domain_name=None)
 
     def list_nodes(self):
-        reverse_links = self.get_back_links()
-        interfaces = self.list_ifs().keys()
-        nodes = {}
-        cursor = self._mongo_db['mac'].find()
+        """
+        Returns {'node001': {'mac': mac, 'interfaces': {'eth0': {4: ip}}}}
+        Nodes and MACs are fetched using one query each,
+        IPs are converted using networks cached in the group
+        """
+
+        interfaces = self.list_ifs()
+        group_ifs = self.get('interfaces')
+
+        node_docs = self._mongo_db['node'].find(
+            {'group': self.DBRef}, {'name': 1, 'interfaces': 1})
+        node_docs = list(node_docs)
+
         macs = {}
-        for elem in cursor:
-            macs[elem['node'].id] = str(elem['mac'])
-        for link in reverse_links:
-            if link['collection'] == 'node':
-                node = Node(
-                    id=link['DBRef'].id,
-                    mongo_db=self._mongo_db,
-                    group=self
-                )
-                nodes[node.name] = {}
-                if node.id in macs:
-                    nodes[node.name]['mac'] = macs[node.id]
-                else:
-                    nodes[node.name]['mac'] = None
-                tmp = {}
-                for interface in interfaces:
-                    tmp[interface] = {}
-                    for ver in [4, 6]:
-                        ip = node.get_ip(interface, version=ver, quiet=True)
-                        tmp[interface][ver] = ip
-                nodes[node.name]['interfaces'] = tmp
+        if node_docs:
+            node_dbrefs = [DBRef('node', doc['_id']) for doc in node_docs]
+            cursor = self._mongo_db['mac'].find(
+                {'node': {'$in': node_dbrefs}}, {'mac': 1, 'node': 1})
+            for elem in cursor:
+                macs[elem['node'].id] = str(elem['mac'])
+
+        nodes = {}
+        for doc in node_docs:
+            nodes[doc['name']] = {'mac': macs.get(doc['_id'])}
+            node_ifs = doc.get('interfaces') or {}
+            tmp = {}
+            for interface in interfaces:
+                if_uuid = interfaces[interface]
+                tmp[interface] = {}
+                for ver in [4, 6]:
+                    ipnum = None
+                    if if_uuid in node_ifs:
+                        ipnum = node_ifs[if_uuid][str(ver)]
+                    if not ipnum:
+                        tmp[interface][ver] = False
+                        continue
+                    net_dbref = group_ifs[if_uuid]['network'][str(ver)]
+                    if not net_dbref:
+                        tmp[interface][ver] = None
+                        continue
+                    net_obj = self._get_network(net_dbref.id)
+                    tmp[interface][ver] = utils.ip.reltoa(
+                        net_obj._json['NETWORK'], ipnum, net_obj.version)
+            nodes[doc['name']]['interfaces'] = tmp
+
         return nodes
 
     def _get_network(self, netid=None, netname=None):
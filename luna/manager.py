@@ -23,7 +23,6 @@ along with Luna.  If not, see <http://www.gnu.org/licenses/>.
 import tornado.web
 import tornado.gen
 
-from bson.dbref import DBRef
 
 import luna
 from luna import utils
@@ -37,7 +36,35 @@ class Manager(tornado.web.RequestHandler):
         self.server_port = params['server_port']
         self.mongo = params['mongo_db']
         self.log = params['app_logger']
+        # blocking DB calls are done in executor's threads
+        self.executor = (params.get('executor') or
+                         utils.executor.Executor())
 
+    def prepare(self):
+        self._mongo_ops = 0
+
+    def on_finish(self):
+        step = self.get_argument('step', default='')
+        if step not in ['boot', 'discovery', 'install']:
+            step = 'other'
+        elif step == 'install' and self.get_argument('status', default=''):
+            step = 'status'
+
+        utils.metrics.observe_request(
+            self.request.request_time(), self._mongo_ops,
+            handler='manager', step=step)
+
+    def render_string(self, template_name, **kwargs):
+        # shared loader picks up changed templates and times rendering
+        return utils.templates.render(self.get_template_path(),
+                                      template_name, **kwargs)
+
+    def _counted(self, fn, *args):
+        """Returns result of fn and number of DB operations it did"""
+
+        ops = utils.metrics.thread_ops()
+        result = fn(*args)
+        return result, utils.metrics.thread_ops() - ops
 
     @tornado.web.asynchronous
     @tornado.gen.engine
@@ -45,15 +72,8 @@ class Manager(tornado.web.RequestHandler):
         step = self.get_argument('step')
 
         if step == 'boot':
-            nodes = luna.list('node')
-            p = {
-                'protocol': self.protocol,
-                'server_ip': self.server_ip,
-                'server_port': self.server_port,
-                'nodes': nodes
-            }
-
-            self.render("templ_ipxe.cfg", p=p)
+            args = ()
+            step_fn = self.step_boot
 
         elif step == 'discovery':
             hwdata = self.get_argument('hwdata', default=None)
@@ -66,136 +86,12 @@ class Manager(tornado.web.RequestHandler):
             # Node name selected manualy in ipxe
             req_nodename = self.get_argument('node', default=None)
             if req_nodename:
-                self.log.info("Node '{}' was chosen in iPXE"
-                              .format(req_nodename))
                 req_nodename = str(req_nodename)
-                try:
-                    node = luna.Node(name=req_nodename, mongo_db=self.mongo)
-                except:
-                    self.log.error("No such node '{}' exists"
-                                   .format(req_nodename))
-                    self.send_error(400)
-                    return
-
-                mac = None
-                for mac in macs:
-                    if mac:
-                        mac = str(mac.lower())
-                        self.log.info("Node '{}' trying to set '{}' as mac"
-                                      .format(req_nodename, mac))
-
-                        if node.set_mac(mac):
-                            node.update_status('boot.mac_assigned')
-                            break
-
-                        self.log.error("MAC: '{}' looks wrong.".format(mac))
-
-            # need to find node for given macs.
-            # first step - trying to find in known macs
-            found_node = None
-            for mac in macs:
-                if not mac:
-                    continue
-
-                mac = mac.lower()
-                try:
-                    found_node = self.mongo['mac'].find_one({'mac': mac}, {'_id': 0, 'node': 1})['node']
-                except:
-                    continue
-
-                if found_node:
-                    break
-
-            # second step. now try to find in learned switch macs
-            # if we have switch/port configured
-            if not found_node:
-                mac_from_cache = None
-
-                for mac in macs:
-                    mac_cursor = self.mongo['switch_mac'].find({'mac': mac})
-
-                    # first search mac in switch_mac using
-                    # portnames like 'Gi2/0/26'
-                    for elem in mac_cursor:
-                        switch_id = elem['switch_id']
-                        portname = elem['portname']
-
-                        try:
-                            node_id = self.mongo['node'].find_one({'switch': DBRef('switch', switch_id), 'port': portname}, {})['_id']
-                            mac_from_cache = mac
-                        except:
-                            continue
-
-                        if mac_from_cache:
-                            break
-
-                    if mac_from_cache:
-                        break
-
-                    # now search mac in switch_mac using portnumbers
-                    for elem in mac_cursor:
-                        switch_id = elem['switch_id']
-                        port = elem['port']
-
-                        try:
-                            node_id = self.mongo['node'].find_one({'switch': DBRef('switch', switch_id), 'port': port}, {})['_id']
-                            mac_from_cache = mac
-                        except:
-                            continue
-
-                        if mac_from_cache:
-                            break
-
-                    if mac_from_cache:
-                        break
-
-                if not mac_from_cache:
-                    self.log.info("Cannot find '{}' in learned macs."
-                                  .format("', '".join([mac for mac in macs])))
-                    # did not find in learned macs
-                    self.send_error(404)
-                    return
-
-                # here we should have node_id and mac_from_cache
-                try:
-                    node = luna.Node(id=node_id, mongo_db=self.mongo)
-                    utils.helpers.set_mac_node(mac_from_cache, node.DBRef)
-                    found_node = node.DBRef
-                except:
-                    # should not be here
-                    self.log.info("Cannot create node object for '{}' and '{}'"
-                                  .format(found_name_from_learned, self.mongo))
-                    self.send_error(404)
-                    return
-
-            # here we should have found_node
-            try:
-                node = luna.Node(id=found_node.id, mongo_db=self.mongo)
-            except:
-                # should not be here
-                self.log.info("Cannot create node object for '{}' and '{}'"
-                              .format(found_node, self.mongo))
-                self.send_error(404)
-                return
-
-            # found node finally
-            boot_params = node.boot_params
-
-            boot_params['server_ip'] = self.server_ip
-            boot_params['server_port'] = self.server_port
-            boot_params['protocol'] = self.protocol
 
             boot_type = self.get_argument('type', default='ipxe')
-            if boot_type == 'ipxe':
-                node.update_status('boot.request')
-                self.render("templ_nodeboot.cfg", p=boot_params)
-
-            elif boot_type == 'syslinux':
-                node.update_status('boot.request')
-                self.render("templ_nodeboot_syslinux.cfg", p=boot_params)
 
-            else:
-                self.send_error(404)
+            args = (macs, req_nodename, boot_type)
+            step_fn = self.step_discovery
 
         elif step == 'install':
             node_name = self.get_argument('node', default=None)
@@ -204,34 +100,142 @@ class Manager(tornado.web.RequestHandler):
                 self.send_error(400)
                 return
 
-            node_name = str(node_name)
-
-            try:
-                node = luna.Node(name=node_name, mongo_db=self.mongo)
-            except:
-                self.log.error("No such node '{}' exists".format(node_name))
-                self.send_error(400)
-                return
-
             status = self.get_argument('status', default='')
 
-            if status:
-                node.update_status(status)
-                self.finish()
-                return
+            args = (str(node_name), status)
+            step_fn = self.step_install
 
-            install_params = node.install_params
-            if not install_params['torrent']:
-                self.send_error(404)
-                return
+        else:
+            self.send_error(400)
+            return
 
-            install_params['protocol'] = self.protocol
-            install_params['server_ip'] = self.server_ip
-            install_params['server_port'] = self.server_port
+        result = yield tornado.gen.Task(self.executor.run, self._counted,
+                                        step_fn, *args)
 
-            node.update_status('install.request')
+        if isinstance(result, utils.executor.Failure):
+            self.send_error(500)
+            return
 
-            self.render("templ_install.cfg", p=install_params)
+        (error, template, p), self._mongo_ops = result
 
+        if error:
+            self.send_error(error)
+        elif template:
+            self.render(template, p=p)
+        elif p:
+            self.send_script(*p)
         else:
-            self.send_error(400)
+            self.finish()
+
+    def send_script(self, etag, body):
+        """Send pre-rendered script or 304 if node has it already"""
+
+        self.set_header('Etag', etag)
+
+        if etag in self.request.headers.get('If-None-Match', ''):
+            self.set_status(304)
+            self.finish()
+            return
+
+        self.finish(body)
+
+    # step_* methods are run in executor's thread. They should not
+    # touch the request, but return (error_code, template, params)
+    # or (error_code, None, (etag, script)) for pre-rendered scripts
+
+    @property
+    def server(self):
+        return {'protocol': self.protocol,
+                'server_ip': self.server_ip,
+                'server_port': self.server_port}
+
+    def step_boot(self):
+        nodes = luna.list('node', mongo_db=self.mongo)
+        p = {
+            'protocol': self.protocol,
+            'server_ip': self.server_ip,
+            'server_port': self.server_port,
+            'nodes': nodes
+        }
+
+        return None, "templ_ipxe.cfg", p
+
+    def step_discovery(self, macs, req_nodename, boot_type):
+        if req_nodename:
+            self.log.info("Node '{}' was chosen in iPXE"
+                          .format(req_nodename))
+            try:
+                node = luna.Node(name=req_nodename, mongo_db=self.mongo)
+            except:
+                self.log.error("No such node '{}' exists"
+                               .format(req_nodename))
+                return 400, None, None
+
+            mac = None
+            for mac in macs:
+                if mac:
+                    mac = str(mac.lower())
+                    self.log.info("Node '{}' trying to set '{}' as mac"
+                                  .format(req_nodename, mac))
+
+                    if node.set_mac(mac):
+                        node.update_status('boot.mac_assigned')
+                        break
+
+                    self.log.error("MAC: '{}' looks wrong.".format(mac))
+
+        # need to find node for given macs:
+        # in known macs first, then in learned switch macs
+        # if we have switch/port configured
+        node_id, mac_from_cache = utils.helpers.find_node_by_macs(
+            macs, self.mongo)
+
+        if not node_id:
+            self.log.info("Cannot find '{}' in learned macs."
+                          .format("', '".join([mac for mac in macs])))
+            return 404, None, None
+
+        try:
+            node = luna.Node(id=node_id, mongo_db=self.mongo)
+        except:
+            # should not be here
+            self.log.info("Cannot create node object for '{}' and '{}'"
+                          .format(node_id, self.mongo))
+            return 404, None, None
+
+        if mac_from_cache:
+            utils.helpers.set_mac_node(mac_from_cache, node.DBRef,
+                                       self.mongo)
+
+        # found node finally
+        if boot_type == 'ipxe':
+            script = node.get_script('boot', server=self.server)
+            node.update_status('boot.request')
+            return None, None, script
+
+        elif boot_type == 'syslinux':
+            boot_params = node.get_params('boot')
+            boot_params.update(self.server)
+            node.update_status('boot.request')
+            return None, "templ_nodeboot_syslinux.cfg", boot_params
+
+        return 404, None, None
+
+    def step_install(self, node_name, status):
+        try:
+            node = luna.Node(name=node_name, mongo_db=self.mongo)
+        except:
+            self.log.error("No such node '{}' exists".format(node_name))
+            return 400, None, None
+
+        if status:
+            node.update_status(status)
+            return None, None, None
+
+        script = node.get_script('install', server=self.server)
+        if not script:
+            return 404, None, None
+
+        node.update_status('install.request')
+
+        return None, None, script
@@ -0,0 +1,86 @@
+'''
+Written by Dmitry Chirikov <dmitry@chirikov.ru>
+This file is part of Luna, cluster provisioning tool
+https://github.com/dchirikov/luna
+
+This file is part of Luna.
+
+Luna is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Luna is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Luna.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import tornado.web
+import tornado.gen
+
+from luna import utils
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Reports metrics of all lweb processes in Prometheus text format.
+    Swarm metrics are taken from the peer store of the current process,
+    as it has peers announced to every process
+    """
+
+    def initialize(self, params):
+        self.mongo = params['mongo_db']
+        self.peer_store = params['peer_store']
+        self.max_age = params.get('metrics_max_age', 60)
+        self.executor = (params.get('executor') or
+                         utils.executor.Executor())
+
+    def fetch(self):
+        """DB part of the request. Run in executor's thread"""
+
+        metrics = utils.metrics.collect(self.mongo, self.max_age)
+        osimage_docs = list(self.mongo['osimage'].find(
+            {}, {'name': 1, 'info_hash': 1}))
+
+        return metrics, osimage_docs
+
+    def get_swarm_metrics(self, osimage_docs):
+        osimages = {}
+        for doc in osimage_docs:
+            if doc.get('info_hash'):
+                osimages[doc['info_hash']] = doc['name']
+
+        gauges = {}
+        for info_hash in self.peer_store.get_info_hashes():
+            labels = (('info_hash', info_hash),
+                      ('osimage', osimages.get(info_hash, '')))
+
+            complete, incomplete, _ = self.peer_store.get_counters(info_hash)
+            gauges[('swarm_peers', labels)] = (
+                self.peer_store.get_swarm_size(info_hash))
+            gauges[('swarm_seeders', labels)] = complete
+            gauges[('swarm_leechers', labels)] = incomplete
+            gauges[('swarm_bytes_left', labels)] = (
+                self.peer_store.get_bytes_left(info_hash))
+
+        return gauges
+
+    @tornado.web.asynchronous
+    @tornado.gen.engine
+    def get(self):
+        result = yield tornado.gen.Task(self.executor.run, self.fetch)
+        if isinstance(result, utils.executor.Failure):
+            self.send_error(500)
+            return
+
+        metrics, osimage_docs = result
+        metrics['gauges'].update(self.get_swarm_metrics(osimage_docs))
+
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(utils.metrics.render(metrics))
+        self.finish()
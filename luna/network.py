@@ -34,6 +34,8 @@ class Network(Base):
     """Class for operating with network objects"""
 
     log = logging.getLogger(__name__)
+    _params_dep = True
+    _params_skip_keys = ['freelist', 'comment']
 
     def __init__(self, name=None, mongo_db=None,
                  create=False, id=None, version=None,
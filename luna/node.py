@@ -20,10 +20,12 @@ along with Luna.  If not, see <http://www.gnu.org/licenses/>.
 
 '''
 
-from config import use_key, usedby_key
+from config import use_key, usedby_key, params_collection
 
 import re
+import json
 import logging
+import hashlib
 import datetime
 
 from luna import utils
@@ -31,13 +33,14 @@ from luna.base import Base
 from luna.cluster import Cluster
 from luna.switch import Switch
 from luna.group import Group
-from tornado import template
 
 
 class Node(Base):
     """Class for operating with node objects"""
 
     log = logging.getLogger(__name__)
+    _params_dep = True
+    _params_skip_keys = ['status', 'switch', 'port', 'comment']
 
     def __init__(self, name=None, mongo_db=None, create=False,
                  id=None, group=None, localboot=False, setupbmc=True,
@@ -122,8 +125,7 @@ class Node(Base):
 
             # Link this node to its group and the current cluster
 
-            self.link(self.group)
-            self.link(cluster)
+            self.link_many([self.group, cluster])
 
         if group:
             # check if group specified is the group node belongs to
@@ -607,10 +609,8 @@ class Node(Base):
 
     def show(self):
         def get_value(dbref):
-            mongo_collection = self._mongo_db[dbref.collection]
             try:
-                name = mongo_collection.find_one({'_id': dbref.id})['name']
-                name = '[' + name + ']'
+                name = '[' + names[dbref] + ']'
             except:
                 name = '[id_' + str(dbref.id) + ']'
             return name
@@ -621,12 +621,89 @@ class Node(Base):
             if attr in ['_id', use_key, usedby_key]:
                 json.pop(attr)
 
+        names = self._resolve_names(
+            [json[attr] for attr in ['group', 'switch'] if json[attr]])
+
         json['group'] = get_value(json['group'])
         if json['switch']:
             json['switch'] = get_value(json['switch'])
 
         return json
 
+    def _get_params_deps(self):
+        """
+        Returns ids of the objects boot and install params depend on
+        and MAC address of the node
+        """
+
+        self._get_group()
+
+        deps = [self._id, self.group.id]
+
+        for key in ['osimage', 'bmcsetup', 'domain']:
+            dbref = self.group.get(key)
+            if dbref:
+                deps.append(dbref.id)
+
+        interfaces = self.group.get('interfaces') or {}
+        for if_uuid in interfaces:
+            if 'network' not in interfaces[if_uuid]:
+                continue
+            for ver in ['4', '6']:
+                net_dbref = interfaces[if_uuid]['network'][ver]
+                if net_dbref and net_dbref.id not in deps:
+                    deps.append(net_dbref.id)
+
+        mac = self.get_mac()
+        if mac:
+            deps.append(mac)
+
+        return deps
+
+    def get_params(self, step):
+        """
+        Returns boot_params or install_params for step 'boot' or 'install'
+        Params are stored in DB and recomputed only if node, its group,
+        osimage, bmcsetup or networks were changed
+        """
+
+        if step not in ['boot', 'install']:
+            self.log.error("Step should be 'boot' or 'install'")
+            return None
+
+        mongo_collection = self._mongo_db[params_collection]
+
+        doc = mongo_collection.find_one({'_id': self._id}, {step: 1})
+        if doc and step in doc:
+            return json.loads(doc[step])
+
+        generation = utils.helpers.get_params_generation(self._mongo_db)
+
+        # cached documents could be older than the invalidation
+        with utils.cache.bypass():
+            node = Node(id=self._id, mongo_db=self._mongo_db)
+            if step == 'boot':
+                params = node.boot_params
+            else:
+                params = node.install_params
+            deps = node._get_params_deps()
+
+        # params are stored as json strings,
+        # as interface names can contain dots
+        mongo_collection.update(
+            {'_id': self._id},
+            {'$set': {step: json.dumps(params),
+                      'deps': deps,
+                      'updated': datetime.datetime.utcnow()}},
+            upsert=True)
+
+        if utils.helpers.get_params_generation(self._mongo_db) != generation:
+            # something was changed while params were computed,
+            # invalidation could miss the document written above
+            mongo_collection.remove({'_id': self._id})
+
+        return params
+
     def set_group(self, new_group_name=None):
         """
         Method to change group for node
@@ -864,10 +941,12 @@ class Node(Base):
             mac = self.get_mac()
             self._mongo_db['switch_mac'].remove({'mac': mac})
             self._mongo_db['mac'].remove({'mac': mac})
+            self._invalidate_cache()
 
         elif re.match('(([a-fA-F0-9]{2}:){5}([a-fA-F0-9]{2}))$', mac):
             mac = mac.lower()
-            utils.helpers.set_mac_node(mac, self.DBRef, (self._mongo_db))
+            return utils.helpers.set_mac_node(mac, self.DBRef,
+                                              self._mongo_db)
 
         else:
             self.log.error("Invalid MAC address '{}'".format(mac))
@@ -1040,44 +1119,106 @@ class Node(Base):
 
         return True
 
-    def render_script(self, name):
+    _scripts = {'boot': 'templ_nodeboot.cfg',
+                'install': 'templ_install.cfg'}
 
-        scripts = ['boot', 'install']
+    def _get_server_params(self):
+        """Returns path to templates and frontend params for scripts"""
 
-        if name not in scripts:
+        cluster = Cluster(mongo_db=self._mongo_db)
+
+        if cluster.get('frontend_https'):
+            protocol = 'https'
+        else:
+            protocol = 'http'
+
+        server = {
+            'protocol': protocol,
+            'server_ip': cluster.get('frontend_address'),
+            'server_port': cluster.get('frontend_port'),
+        }
+
+        return cluster.get('path') + '/templates', server
+
+    def render_script(self, name):
+
+        if name not in self._scripts:
 
             self.log.error(
                 "'{}' is not correct script. Valid options are: '{}'"
-                .format(name, scripts)
+                .format(name, sorted(self._scripts))
             )
 
             return None
 
-        cluster = Cluster(mongo_db=self._mongo_db)
+        path, server = self._get_server_params()
         self._get_group()
-        path = cluster.get('path')
-        tloader = template.Loader(path + '/templates')
 
-        if cluster.get('frontend_https'):
-            protocol = 'https'
+        if name == 'boot':
+            p = self.boot_params
         else:
-            protocol = 'http'
+            p = self.install_params
 
-        server_ip = cluster.get('frontend_address')
-        server_port = cluster.get('frontend_port')
+        p.update(server)
 
-        if name == 'boot':
-            p = self.boot_params
-            p['protocol'] = protocol
-            p['server_ip'] = server_ip
-            p['server_port'] = server_port
-            return tloader.load('templ_nodeboot.cfg').generate(p=p)
+        return utils.templates.render(path, self._scripts[name], p=p)
 
-        if name == 'install':
-            p = self.install_params
-            p['protocol'] = protocol
-            p['server_ip'] = server_ip
-            p['server_port'] = server_port
-            res = tloader.load('templ_install.cfg').generate(p=p)
+    def get_script(self, name, server=None):
+        """
+        Returns (etag, script) for 'boot' or 'install'.
+        Rendered script is stored along with node params and dropped
+        on the same changes, so it is rendered once per change.
+        server - dict of protocol, server_ip and server_port to use
+                 instead of the cluster's ones
+        Returns None if osimage of the node is not packed for 'install'
+        """
 
-            return res
+        if name not in self._scripts:
+            self.log.error(
+                "'{}' is not correct script. Valid options are: '{}'"
+                .format(name, sorted(self._scripts))
+            )
+            return None
+
+        path, cluster_server = self._get_server_params()
+        server = server or cluster_server
+        template_name = self._scripts[name]
+
+        # rendered script is valid for the same templates and frontend
+        version = '{}:{}:{}://{}:{}'.format(
+            template_name, utils.templates.version(path, template_name),
+            server['protocol'], server['server_ip'], server['server_port'])
+
+        key = name + '_script'
+        mongo_collection = self._mongo_db[params_collection]
+
+        doc = mongo_collection.find_one({'_id': self._id}, {key: 1})
+        if doc and doc.get(key) and doc[key]['version'] == version:
+            return doc[key]['etag'], doc[key]['body']
+
+        generation = utils.helpers.get_params_generation(self._mongo_db)
+        p = self.get_params(name)
+        if name == 'install' and not p['torrent']:
+            self.log.error("No torrent for node '{}'. Is osimage packed?"
+                           .format(self.name))
+            return None
+
+        p.update(server)
+        body = utils.templates.render(path, template_name, p=p)
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+        # no upsert: params could be dropped by the change
+        # happened while script was rendered
+        mongo_collection.update(
+            {'_id': self._id},
+            {'$set': {key: {'version': version, 'etag': etag, 'body': body}}},
+            multi=False, upsert=False)
+
+        if utils.helpers.get_params_generation(self._mongo_db) != generation:
+            # params were invalidated while script was rendered and
+            # could be recomputed, script rendered from stale ones
+            # should not be stored along with them
+            mongo_collection.update({'_id': self._id}, {'$unset': {key: 1}},
+                                    multi=False, upsert=False)
+
+        return etag, body
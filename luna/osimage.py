@@ -27,9 +27,11 @@ import sys
 import pwd
 import rpm
 import uuid
+import hashlib
 import shutil
 import logging
 import tempfile
+import threading
 import traceback
 import subprocess
 import libtorrent
@@ -44,6 +46,7 @@ class OsImage(Base):
     """Class for operating with osimages records"""
 
     log = logging.getLogger(__name__)
+    _params_dep = True
 
     def __init__(self, name=None, mongo_db=None, create=False, id=None,
                  path='', kernver='', kernopts='', comment='',
@@ -63,7 +66,10 @@ class OsImage(Base):
         self._keylist = {'path': type(''), 'kernver': type(''),
                          'kernopts': type(''), 'kernmodules': type(''),
                          'dracutmodules': type(''), 'tarball': type(''),
-                         'torrent': type(''), 'kernfile': type(''),
+                         'torrent': type(''), 'codec': type(''),
+                         'delta': type(True), 'incremental': type(True),
+                         'stream': type(True),
+                         'format': type(''), 'kernfile': type(''),
                          'initrdfile': type(''), 'grab_exclude_list': type(''),
                          'grab_filesystems': type(''), 'comment': type('')}
 
@@ -119,6 +125,7 @@ class OsImage(Base):
             osimage = {'name': name, 'path': path,
                        'kernver': kernver, 'kernopts': kernopts,
                        'kernfile': '', 'initrdfile': '',
+                       'codec': utils.pack.DEFAULT_CODEC,
                        'dracutmodules': 'luna,-i18n,-plymouth',
                        'kernmodules': 'ipmi_devintf,ipmi_si,ipmi_msghandler',
                        'grab_exclude_list': grab_list_content,
@@ -157,9 +164,314 @@ class OsImage(Base):
 
         return versions
 
-    def create_tarball(self):
+    def set(self, key, value):
+        if key == 'codec' and value not in utils.pack.CODECS:
+            self.log.error("Codec should be one of '{}'"
+                           .format(sorted(utils.pack.CODECS)))
+            return False
+
+        if key == 'format' and value not in utils.pack.FORMATS:
+            self.log.error("Format should be one of '{}'"
+                           .format(utils.pack.FORMATS))
+            return False
+
+        return super(OsImage, self).set(key, value)
+
+    def _check_tracker(self, cluster):
+        if cluster.get('frontend_address') == '':
+            self.log.error("Tracker address needs to be configured.")
+            return False
+
+        if cluster.get('frontend_port') == 0:
+            self.log.error("Tracker port needs to be configured.")
+            return False
+
+        return True
+
+    @staticmethod
+    def _feed(pipe, files):
+        try:
+            pipe.write('\0'.join(files))
+        except IOError:
+            # tar exited, will be reported by the caller
+            pass
+        finally:
+            try:
+                pipe.close()
+            except IOError:
+                pass
+
+    def _run_tar(self, out, hasher, codec, files, progress=False):
+        """
+        Pack files of osimage with tar compressed by codec and write it
+        to out. Files are archived in the order given, without recursion.
+        Raises exception on error
+        """
+
+        # identical trees give identical archives: members are sorted
+        # by the caller, access and change times are not stored and
+        # names of pax headers do not contain PID
+        tar_cmd = ['/usr/bin/tar', '-C', '/', '--one-file-system',
+                   '--xattrs', '--selinux', '--acls', '--format=posix',
+                   '--pax-option=exthdr.name=%d/PaxHeaders/%f,'
+                   'delete=atime,delete=ctime',
+                   '--no-recursion', '--null', '-T', '-', '-c', '-f', '-']
+
+        procs = []
+        feeder = None
+        real_root = os.open("/", os.O_RDONLY)
+        chrooted = False
+
+        try:
+            compress = utils.pack.get_codec(codec)['compress']
+            if compress:
+                # compressor is started from the host
+                procs.append(subprocess.Popen(compress,
+                                              stdin=subprocess.PIPE,
+                                              stdout=subprocess.PIPE,
+                                              close_fds=True))
+
+            # tar is run from the image to use its users and groups
+            os.chroot(self.get('path'))
+            chrooted = True
+
+            tar_out = subprocess.Popen(
+                tar_cmd,
+                stdin=subprocess.PIPE,
+                stdout=procs[0].stdin if procs else subprocess.PIPE,
+                close_fds=True
+            )
+            procs.insert(0, tar_out)
+
+            os.fchdir(real_root)
+            os.chroot(".")
+            chrooted = False
+
+            # list is written by the thread, as tar reads it while
+            # writing the archive
+            feeder = threading.Thread(target=self._feed,
+                                      args=(tar_out.stdin, files))
+            feeder.daemon = True
+            feeder.start()
+
+            if compress:
+                # compressor should get EOF when tar exits
+                procs[1].stdin.close()
+
+            utils.pack.copy_stream(procs[-1].stdout, out, hasher,
+                                   progress=progress)
+
+            for proc in procs:
+                proc.wait()
+            feeder.join()
+
+            # tar returns 1 if some files were changed while being read
+            if tar_out.returncode not in [0, 1]:
+                raise RuntimeError("tar exited with code {}"
+                                   .format(tar_out.returncode))
+
+            if compress and procs[1].returncode != 0:
+                raise RuntimeError("{} exited with code {}"
+                                   .format(compress[0], procs[1].returncode))
+
+        except:
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+
+            if chrooted:
+                os.fchdir(real_root)
+                os.chroot(".")
+
+            raise
+
+        finally:
+            os.close(real_root)
+
+    def _write_tarball(self, tarfile, codec, files=None, groups=None,
+                       old_tarball=None, old_segments=None):
+        """
+        Pack osimage to tarfile compressed by codec.
+        files        - sorted list of the paths to pack, whole tree
+                       by default
+        groups       - [(key, paths)] to pack as independently compressed
+                       segments
+        old_segments - {key: (offset, length)} of the segments of
+                       old_tarball which can be copied instead of packing
+        Returns (PieceHasher, segments) or None.
+        segments - [[key, offset, length]] if groups were specified
+        """
+
+        # tarball is written to its final place directly,
+        # so permissions and selinux contexts will be inherited
+        # from parent folder
+        out = open(tarfile, 'wb')
+        hasher = utils.pack.PieceHasher(workers=utils.pack.hash_workers())
+        segments = None
+        old = None
+
+        try:
+            if groups is None:
+                if files is None:
+                    files = utils.manifest.paths(self.get('path'))
+                self._run_tar(out, hasher, codec, files,
+                              progress=sys.stdout.isatty())
+            else:
+                old_segments = old_segments or {}
+                if old_segments:
+                    old = open(old_tarball, 'rb')
+
+                segments = []
+                reused = 0
+                for key, paths in groups:
+                    offset = hasher.size
+                    if key in old_segments:
+                        old_offset, length = old_segments[key]
+                        old.seek(old_offset)
+                        copied = utils.pack.copy_stream(old, out, hasher,
+                                                        size=length)
+                        if copied != length:
+                            raise RuntimeError("'{}' is truncated"
+                                               .format(old_tarball))
+                        reused += 1
+                    else:
+                        self._run_tar(out, hasher, codec, paths)
+
+                    segments.append([key, offset, hasher.size - offset])
+
+                self.log.info("{} of {} segments were reused."
+                              .format(reused, len(groups)))
+
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            if exc_type == exceptions.KeyboardInterrupt:
+                self.log.error('Keyboard interrupt.')
+            else:
+                self.log.error(exc_value)
+                self.log.debug(traceback.format_exc())
+
+            hasher.close()
+            out.close()
+            if os.path.isfile(tarfile):
+                os.remove(tarfile)
+
+            return None
+
+        finally:
+            if old is not None:
+                old.close()
+
+        out.close()
+
+        hasher.finish()
+
+        return hasher, segments
+
+    def _get_mountpoints(self):
+        """Paths of the filesystems mounted inside osimage"""
+
+        image_path = os.path.abspath(self.get('path'))
+        mountpoints = []
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                mountpoint = line.split()[1].decode('string_escape')
+                if mountpoint.startswith(image_path + '/'):
+                    mountpoints.append(mountpoint[len(image_path) + 1:])
+
+        return sorted(mountpoints)
+
+    def _write_squashfs(self, tarfile, codec):
+        """
+        Pack osimage to squashfs image compressed by codec.
+        Returns (PieceHasher, None) or None
+        """
+
+        # build time is stored in the superblock, fixed one keeps
+        # images of the same tree identical, so tarball_hash matches
+        cmd = ['/usr/sbin/mksquashfs', self.get('path'), tarfile,
+               '-noappend', '-mkfs-time', '0']
+        cmd += utils.pack.SQUASHFS_COMP[codec]
+
+        # like tar --one-file-system: mountpoints are kept, content is not
+        mountpoints = self._get_mountpoints()
+        if mountpoints:
+            cmd += ['-wildcards', '-e']
+            cmd += [mountpoint + '/*' for mountpoint in mountpoints]
+
+        hasher = utils.pack.PieceHasher(workers=utils.pack.hash_workers())
+
+        try:
+            # mksquashfs needs seekable output, so pieces are
+            # hashed after, while image is in page cache
+            proc = subprocess.Popen(cmd, close_fds=True)
+            proc.wait()
+            if proc.returncode != 0:
+                raise RuntimeError("mksquashfs exited with code {}"
+                                   .format(proc.returncode))
+
+            utils.pack.hash_file(tarfile, hasher)
+
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            if exc_type == exceptions.KeyboardInterrupt:
+                self.log.error('Keyboard interrupt.')
+            else:
+                self.log.error(exc_value)
+                self.log.debug(traceback.format_exc())
+
+            hasher.close()
+            if os.path.isfile(tarfile):
+                os.remove(tarfile)
+
+            return None
+
+        hasher.finish()
+
+        return hasher, None
+
+    def _create_delta(self, path_to_store, old_files, files, codec):
+        """
+        Pack files changed since manifest old_files was created.
+        Returns uid of the delta tarball or None
+        """
+
+        changed, removed = utils.manifest.diff(old_files, files)
+        self.log.info("Delta: {} changed and {} removed paths."
+                      .format(len(changed), len(removed)))
+
+        delta_uid = str(uuid.uuid4())
+        res = self._write_tarball(
+            path_to_store + '/' + utils.pack.tarball_name(delta_uid, codec),
+            codec, changed)
+        if res is None:
+            return None
+
+        # paths to remove on the node before unpacking delta
+        with open(path_to_store + '/' + delta_uid + '.removed', 'w') as f:
+            f.write(''.join([path + '\0' for path in removed]))
+
+        hasher = res[0]
+        self._pieces[delta_uid] = {'size': hasher.size,
+                                   'piece_size': hasher.piece_size,
+                                   'hashes': hasher.pieces}
+
+        return delta_uid
+
+    def create_tarball(self, torrent=False):
+        """
+        Pack osimage to the tarball. If torrent is True, torrent
+        is created right after from the piece hashes computed on packing.
+        If 'delta' is enabled, tarball of the files changed since previous
+        pack is created as well.
+        If 'incremental' is enabled, tarball consists of segments and
+        unchanged segments are copied from the previous tarball
+        """
+
         # TODO check if root
         cluster = Cluster(mongo_db=self._mongo_db)
+        if torrent and not self._check_tracker(cluster):
+            return False
+
         path = cluster.get('path')
         user = cluster.get('user')
         user_id = pwd.getpwnam(user).pw_uid
@@ -171,97 +483,164 @@ class OsImage(Base):
             os.chown(path_to_store, user_id, grp_id)
             os.chmod(path_to_store, 0644)
 
-        image_path = self.get('path')
+        codec = self.get('codec') or utils.pack.DEFAULT_CODEC
+        if codec not in utils.pack.CODECS:
+            self.log.error("Unknown codec '{}'".format(codec))
+            return False
 
-        real_root = os.open("/", os.O_RDONLY)
-        os.chroot(image_path)
+        fmt = self.get('format') or utils.pack.DEFAULT_FORMAT
 
         uid = str(uuid.uuid4())
-        tarfile = uid + ".tgz"
+        tarfile = (path_to_store + '/' +
+                   utils.pack.tarball_name(uid, codec, fmt))
+
+        base = self.get('tarball')
+        delta = self.get('delta')
+        incremental = self.get('incremental')
+
+        if fmt == 'squashfs' and (delta or incremental):
+            self.log.warning("Delta and incremental packing are "
+                             "supported for tarballs only.")
+            delta, incremental = False, False
+
+        old = None
+        files = None
+        if delta or incremental:
+            if base:
+                old = utils.manifest.load(path_to_store + '/' + base +
+                                          '.manifest.gz')
+            if old is None:
+                self.log.info("No manifest of the previous tarball. "
+                              "Image will be packed in full.")
+
+            files = utils.manifest.build(self.get('path'),
+                                         old and old['files'])
+
+        groups = None
+        old_tarball = None
+        old_segments = None
+        if incremental:
+            groups = utils.manifest.groups(files)
+
+            # compressed segments can be reused for the same codec only
+            if old and old.get('segments') and old.get('codec') == codec:
+                old_tarball = (path_to_store + '/' +
+                               utils.pack.tarball_name(base, codec))
+                if os.path.isfile(old_tarball):
+                    old_segments = dict([(key, (offset, length))
+                                         for key, offset, length
+                                         in old['segments']])
+
+        if fmt == 'squashfs':
+            res = self._write_squashfs(tarfile, codec)
+        else:
+            res = self._write_tarball(tarfile, codec, groups=groups,
+                                      old_tarball=old_tarball,
+                                      old_segments=old_segments)
+        if res is None:
+            return False
 
-        try:
-            # dirty, but 4 times faster
-            tar_out = subprocess.Popen(
-                [
-                    '/usr/bin/tar',
-                    '-C', '/',
-                    '--one-file-system',
-                    '--xattrs',
-                    '--selinux',
-                    '--acls',
-                    '--checkpoint=100',
-                    '--exclude=./tmp/' + tarfile,
-                    '--use-compress-program=/usr/bin/pigz',
-                    '-c', '-f', '/tmp/' + tarfile, '.'
-                ],
-                stderr=subprocess.PIPE
-            )
+        hasher, segments = res
+        pieces = {'size': hasher.size, 'piece_size': hasher.piece_size,
+                  'hashes': hasher.pieces}
+        tarball_hash = utils.pack.tarball_hash(hasher)
 
-            stat_symb = ['\\', '|', '/', '-']
-            i = 0
-            while True:
-                line = tar_out.stderr.readline()
-                if line == '':
-                    break
-                i = i + 1
-                sys.stdout.write(stat_symb[i % len(stat_symb)])
-                sys.stdout.write('\r')
+        old_fmt = self.get('tarball_format') or utils.pack.DEFAULT_FORMAT
+        if (base and self.get('tarball_hash') == tarball_hash and
+                self.get('tarball_codec') == codec and old_fmt == fmt and
+                os.path.isfile(path_to_store + '/' +
+                               utils.pack.tarball_name(base, codec, fmt))):
+            # same tarball gives the same info_hash, so nodes and
+            # ltorrent keep using current torrent
+            self.log.info("Image was not changed since last pack.")
+            os.remove(tarfile)
 
-        except:
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            if exc_type == exceptions.KeyboardInterrupt:
-                self.log.error('Keyboard interrupt.')
-            else:
-                self.log.error(exc_value)
-                self.log.debug(traceback.format_exc())
+            self._pieces = {base: pieces}
+            if torrent and not self.get('torrent'):
+                return self.create_torrent()
 
-            if os.path.isfile('/tmp/' + tarfile):
-                os.remove('/tmp/' + tarfile)
+            return True
 
-            sys.stdout.write('\r')
+        # create_torrent will not read tarballs again
+        self._pieces = {uid: pieces}
 
-            os.fchdir(real_root)
-            os.chroot(".")
-            os.close(real_root)
+        created = [utils.pack.tarball_name(uid, codec, fmt)]
 
-            return False
+        if files is not None:
+            utils.manifest.save(path_to_store + '/' + uid + '.manifest.gz',
+                                files, codec=codec, segments=segments)
+            created.append(uid + '.manifest.gz')
 
-        os.fchdir(real_root)
-        os.chroot(".")
-        os.close(real_root)
+        delta_uid = None
+        if delta and old is not None:
+            # nodes can be installed from full tarball anyway
+            try:
+                delta_uid = self._create_delta(path_to_store, old['files'],
+                                               files, codec)
+            except:
+                self.log.error("Unable to create delta: {}"
+                               .format(sys.exc_info()[1]))
+                self.log.debug(traceback.format_exc())
+
+        if delta_uid:
+            created += [utils.pack.tarball_name(delta_uid, codec),
+                        delta_uid + '.removed']
+
+        # node reads them before the tarball, which can be streamed
+        accounts = False
+        if fmt == 'tar':
+            try:
+                accounts = utils.pack.write_accounts(
+                    self.get('path'),
+                    path_to_store + '/' + utils.pack.accounts_name(uid))
+            except (IOError, OSError):
+                self.log.warning("Unable to store users and groups of the "
+                                 "image: {}".format(sys.exc_info()[1]))
+
+        if accounts:
+            created.append(utils.pack.accounts_name(uid))
+
+        for filename in created:
+            os.chown(path_to_store + '/' + filename, user_id, grp_id)
+            os.chmod(path_to_store + '/' + filename, 0644)
 
-        # copy image, so permissions and selinux contexts
-        # will be inherited from parent folder
-        shutil.copy(image_path + '/tmp/' + tarfile, path_to_store)
-        os.remove(image_path + '/tmp/' + tarfile)
-        os.chown(path_to_store + '/' + tarfile, user_id, grp_id)
-        os.chmod(path_to_store + '/' + tarfile, 0644)
         self.set('tarball', str(uid))
+        self.set('tarball_codec', codec)
+        self.set('tarball_format', fmt)
+        self.set('tarball_hash', tarball_hash)
+        # segments are separated by end-of-archive blocks
+        self.set('tarball_segmented', segments is not None)
+        self.set('tarball_accounts', accounts)
+
+        if delta_uid:
+            self.set('delta_base', str(base))
+            self.set('delta_tarball', delta_uid)
+        else:
+            self.set('delta_base', '')
+            self.set('delta_tarball', '')
+        self.set('delta_torrent', '')
+
+        if torrent:
+            return self.create_torrent()
 
         return True
 
-    def create_torrent(self):
-        # TODO check if root
-        tarball_uid = self.get('tarball')
-        if not tarball_uid:
-            self.log.error("No tarball in DB.")
-            return False
+    def _make_torrent(self, cluster, tarball_uid):
+        """
+        Create .torrent for the tarball in ~luna/torrents
+        Returns (uid, info_hash) of the torrent or None
+        """
 
-        cluster = Cluster(mongo_db=self._mongo_db)
-        tarball = cluster.get('path') + "/torrents/" + tarball_uid + ".tgz"
+        tarball = (cluster.get('path') + "/torrents/" +
+                   utils.pack.tarball_name(tarball_uid,
+                                           self.get('tarball_codec'),
+                                           self.get('tarball_format')))
         if not os.path.exists(tarball):
             self.log.error("Wrong path in DB.")
-            return False
+            return None
 
         tracker_address = cluster.get('frontend_address')
-        if tracker_address == '':
-            self.log.error("Tracker address needs to be configured.")
-            return False
-
         tracker_port = cluster.get('frontend_port')
-        if tracker_port == 0:
-            self.log.error("Tracker port needs to be configured.")
-            return False
 
         user = cluster.get('user')
         user_id = pwd.getpwnam(user).pw_uid
@@ -273,27 +652,73 @@ class OsImage(Base):
         uid = str(uuid.uuid4())
         torrentfile = cluster.get('path') + "/torrents/" + uid + ".torrent"
 
+        # pieces hashed during create_tarball
+        pieces = getattr(self, '_pieces', {}).get(tarball_uid)
+        if pieces and pieces['size'] != os.path.getsize(tarball):
+            pieces = None
+
         fs = libtorrent.file_storage()
         libtorrent.add_files(fs, os.path.basename(tarball))
-        t = libtorrent.create_torrent(fs)
+        if pieces:
+            t = libtorrent.create_torrent(fs, pieces['piece_size'])
+        else:
+            t = libtorrent.create_torrent(fs)
         if cluster.get('frontend_https'):
             proto = 'https'
         else:
             proto = 'http'
+        tier = 0
+        udp_port = cluster.get('tracker_udp_port')
+        if udp_port:
+            t.add_tracker(("udp://" + str(tracker_address) +
+                           ":" + str(udp_port) + "/announce"), tier)
+            tier += 1
         t.add_tracker((proto + "://" + str(tracker_address) +
-                       ":" + str(tracker_port) + "/announce"))
+                       ":" + str(tracker_port) + "/announce"), tier)
 
         t.set_creator(torrent_key)
         t.set_comment(uid)
-        libtorrent.set_piece_hashes(t, ".")
+        if pieces:
+            for i, piece_hash in enumerate(pieces['hashes']):
+                t.set_hash(i, libtorrent.sha1_hash(piece_hash))
+        else:
+            libtorrent.set_piece_hashes(t, ".")
 
+        torrent = t.generate()
         f = open(torrentfile, 'w')
-        f.write(libtorrent.bencode(t.generate()))
+        f.write(libtorrent.bencode(torrent))
         f.close()
         os.chown(torrentfile, user_id, grp_id)
+        os.chdir(old_cwd)
+
+        info_hash = hashlib.sha1(libtorrent.bencode(torrent['info']))
 
+        return uid, info_hash.hexdigest()
+
+    def create_torrent(self):
+        # TODO check if root
+        tarball_uid = self.get('tarball')
+        if not tarball_uid:
+            self.log.error("No tarball in DB.")
+            return False
+
+        cluster = Cluster(mongo_db=self._mongo_db)
+        if not self._check_tracker(cluster):
+            return False
+
+        res = self._make_torrent(cluster, tarball_uid)
+        if res is None:
+            return False
+
+        uid, info_hash = res
         self.set('torrent', str(uid))
-        os.chdir(old_cwd)
+        self.set('info_hash', info_hash)
+
+        delta_uid = self.get('delta_tarball')
+        if delta_uid:
+            res = self._make_torrent(cluster, delta_uid)
+            # nodes will get full tarball
+            self.set('delta_torrent', str(res[0]) if res else '')
 
         return True
 
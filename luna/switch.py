@@ -100,8 +100,7 @@ class Switch(Base):
 
             # Link this switch to its dependencies and the current cluster
 
-            self.link(cluster)
-            self.link(net)
+            self.link_many([cluster, net])
 
         self.log = logging.getLogger('switch.' + self._name)
 
@@ -26,24 +26,704 @@ along with Luna.  If not, see <http://www.gnu.org/licenses/>.
 # http://foobarnbaz.com
 #
 
+import hmac
+import time
+import errno
 import random
+import socket
+import hashlib
 import logging
 import binascii
 import datetime
+import functools
+import pymongo
 import tornado.web
-import tornado.gen
+import tornado.ioloop
 
-from struct import pack
-from socket import inet_aton
+from struct import pack, unpack, calcsize
+from socket import inet_aton, inet_ntoa, inet_pton, AF_INET6
 from httplib import responses
 from libtorrent import bencode
 
 import luna
+from luna import utils
+
+
+class Swarm(object):
+    """
+    Peers of the torrent.
+    Active peers are kept in lists of pre-packed compact entries
+    (6 bytes for IPv4, 18 bytes for IPv6), so random sample
+    of the peers costs O(numwant).
+    Active peers can also be placed to zones (switch, group, etc.),
+    so sample can prefer peers from the given zones
+    """
+
+    def __init__(self):
+        # {(ip, port): peer}
+        self.peers = {}
+        # {4: [(ip, port)], 6: [(ip, port)]}
+        self.active = {4: [], 6: []}
+        # {4: [compact], 6: [compact]}
+        self.compact = {4: [], 6: []}
+        # {(ip, port): (version, index)}
+        self.positions = {}
+        # {zone: [(ip, port)]}
+        self.zones = {}
+        # {(ip, port): (zone, )}
+        self.peer_zones = {}
+        # {(zone, (ip, port)): index}
+        self.zone_positions = {}
+        # active peers having 'completed' and 'started' status
+        self.complete = 0
+        self.incomplete = 0
+        # number of times peers reported 'completed' event
+        self.downloaded = 0
+
+    def __len__(self):
+        return len(self.peers)
+
+    def _count(self, peer, sign):
+        status = peer.get('status')
+        if status == 'completed':
+            self.complete += sign
+        elif status == 'started':
+            self.incomplete += sign
+
+    def _zone_add(self, zone, key):
+        keys = self.zones.setdefault(zone, [])
+        self.zone_positions[(zone, key)] = len(keys)
+        keys.append(key)
+
+    def _zone_remove(self, zone, key):
+        keys = self.zones[zone]
+        index = self.zone_positions.pop((zone, key))
+
+        last_key = keys.pop()
+        if last_key != key:
+            keys[index] = last_key
+            self.zone_positions[(zone, last_key)] = index
+
+        if not keys:
+            self.zones.pop(zone)
+
+    def set_zones(self, key, zones):
+        """Place active peer to zones"""
+
+        if key not in self.positions:
+            return
+
+        zones = tuple(zones)
+        old_zones = self.peer_zones.get(key, ())
+        if zones == old_zones:
+            return
+
+        for zone in old_zones:
+            self._zone_remove(zone, key)
+
+        for zone in zones:
+            self._zone_add(zone, key)
+
+        if zones:
+            self.peer_zones[key] = zones
+        else:
+            self.peer_zones.pop(key, None)
+
+    def set(self, key, peer, zones=()):
+        """Add or replace peer and mark it active"""
+
+        old_peer = self.peers.get(key) or {}
+        if (peer.get('status') == 'completed' and
+                old_peer.get('status') != 'completed'):
+            self.downloaded += 1
+
+        if key in self.positions:
+            self._count(self.peers[key], -1)
+        else:
+            ip, port = key
+            try:
+                if ':' in ip:
+                    version = 6
+                    compact = inet_pton(AF_INET6, ip) + pack('>H', port)
+                else:
+                    version = 4
+                    compact = inet_aton(ip) + pack('>H', port)
+            except:
+                compact = None
+
+            if compact:
+                self.positions[key] = (version, len(self.active[version]))
+                self.active[version].append(key)
+                self.compact[version].append(compact)
+
+        self.peers[key] = peer
+        if key in self.positions:
+            self._count(peer, 1)
+            self.set_zones(key, zones)
+
+    def deactivate(self, key):
+        """Exclude peer from the peer lists"""
+
+        if key not in self.positions:
+            return
+
+        self.set_zones(key, ())
+
+        self._count(self.peers[key], -1)
+        version, index = self.positions.pop(key)
+
+        # swap with the last entry to remove in O(1)
+        active, compact = self.active[version], self.compact[version]
+        last_key, last_compact = active.pop(), compact.pop()
+        if last_key != key:
+            active[index], compact[index] = last_key, last_compact
+            self.positions[last_key] = (version, index)
+
+    def remove(self, key):
+        self.deactivate(key)
+        self.peers.pop(key, None)
+
+    def _pick(self, size, get_key, numwant, peers, chosen):
+        """Append up to numwant - len(peers) random peers not in chosen"""
+
+        need = numwant - len(peers)
+        if need <= 0 or not size:
+            return
+
+        # every chosen peer can be drawn once more, so oversample
+        n = need + len(chosen)
+        if n >= size:
+            indexes = xrange(size)
+        else:
+            indexes = random.sample(xrange(size), n)
+
+        for i in indexes:
+            key = get_key(i)
+            if key in chosen:
+                continue
+
+            chosen.add(key)
+            version, index = self.positions[key]
+            peers.append((key[0], key[1], self.compact[version][index]))
+
+            if len(peers) >= numwant:
+                return
+
+    def sample(self, numwant, zones=(), exclude=None):
+        """
+        Returns random [(ip, port, compact)] of active peers.
+        Peers from zones are taken first, in the order zones are listed
+        """
+
+        peers = []
+        chosen = set()
+        if exclude:
+            chosen.add(exclude)
+
+        for zone in zones:
+            keys = self.zones.get(zone)
+            if keys:
+                self._pick(len(keys), keys.__getitem__,
+                           numwant, peers, chosen)
+
+        active4, active6 = self.active[4], self.active[6]
+        n4 = len(active4)
+
+        def get_key(i):
+            if i < n4:
+                return active4[i]
+            return active6[i - n4]
+
+        self._pick(n4 + len(active6), get_key, numwant, peers, chosen)
+
+        return peers
+
+
+class AnnounceInterval(object):
+    """
+    Announce intervals scaled by the number of active peers in the swarm.
+    Swarms bigger than swarm_size announce proportionally slower, so
+    the tracker receives about swarm_size announces per interval from
+    every swarm. Jitter spreads re-announces of the peers booted together
+    """
+
+    def __init__(self, interval, min_interval, max_interval=0,
+                 swarm_size=0, jitter=0):
+        """
+        interval     - interval for swarms up to swarm_size peers
+        min_interval - min interval for swarms up to swarm_size peers
+        max_interval - upper bound of the scaled interval. 0 - no bound
+        swarm_size   - number of peers to start scaling at. 0 - no scaling
+        jitter       - percent of random deviation of the interval
+        """
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.swarm_size = swarm_size
+        self.jitter = jitter
+
+    @property
+    def longest(self):
+        """Upper bound of the interval or None if it is unbound"""
+
+        if self.swarm_size and not self.max_interval:
+            return None
+
+        interval = self.interval
+        if self.swarm_size:
+            interval = max(self.max_interval, self.interval)
+
+        return int(interval * (1 + self.jitter / 100.0)) + 1
+
+    def _scaled(self, n_peers):
+        interval = float(self.interval)
+        if self.swarm_size and n_peers > self.swarm_size:
+            interval *= float(n_peers) / self.swarm_size
+
+        if self.max_interval:
+            interval = min(interval, max(self.max_interval, self.interval))
+
+        return interval
+
+    def bound(self, n_peers):
+        """Upper bound of the interval given to the swarm of n_peers"""
+
+        return int(self._scaled(n_peers) * (1 + self.jitter / 100.0)) + 1
+
+    def get(self, n_peers):
+        """Returns (interval, min_interval) for the swarm of n_peers"""
+
+        interval = self._scaled(n_peers)
+
+        min_interval = int(self.min_interval * interval / self.interval)
+
+        if self.jitter:
+            interval *= 1 + random.uniform(-self.jitter, self.jitter) / 100.0
+
+        return max(int(round(interval)), min_interval, 1), min_interval
+
+
+class PeerStore(object):
+    """
+    In-process storage of the peers announced to the tracker.
+    Announces are answered from memory. sync() writes changed peers
+    to MongoDB in one batch and loads peers announced to the other
+    lweb processes, so Node.get_status can still use 'tracker' collection.
+    With 'topology' policy peers are given to the node in following order:
+    luna seeders, peers on the same switch, peers in the same group, others
+    """
+
+    log = logging.getLogger(__name__)
+
+    # peer_id of ltorrent seeding images from the server
+    luna_peer_id = binascii.hexlify('lunalunalunalunaluna')
+
+    def __init__(self, mongo_db, age=60, ttl=3600, policy='random',
+                 topology_ttl=60, announce_interval=None):
+        """
+        mongo_db     - DB to persist peers to
+        age          - seconds peer is given to others after last announce
+        announce_interval - AnnounceInterval. If given, peer is given to
+                       others until it misses two announces, according
+                       to the size of its swarm; age is not used
+        ttl          - seconds to keep peer which stopped announcing
+        policy       - peer selection policy: 'random' or 'topology'
+        topology_ttl - seconds between re-reading nodes' switches and groups
+        """
+        self.mongo_db = mongo_db
+        self.age = age
+        self.ttl = ttl
+        self.policy = policy
+        self.topology_ttl = topology_ttl
+        self.announce_interval = announce_interval
+
+        # {info_hash: Swarm}
+        self.swarms = {}
+        # (info_hash, ip, port) of the peers to persist
+        self.dirty = set()
+        self.last_load = None
+        # {ip: (('switch', switch_id), ('group', group_id))}
+        self.topology = {}
+        self.last_topology = None
+        self.syncing = False
+
+    def _get_zones(self, ip, peer):
+        if self.policy != 'topology':
+            return ()
+
+        zones = self.topology.get(ip, ())
+        if peer.get('peer_id') == self.luna_peer_id:
+            zones = (('seeder', ), ) + zones
+
+        return zones
+
+    def update(self, info_hash, peer_id, ip, port, status, uploaded,
+               downloaded, left):
+        """Store the information about the peer"""
+
+        swarm = self.swarms.setdefault(info_hash, Swarm())
+        peer = swarm.peers.get((ip, port), {}).copy()
+
+        peer['peer_id'] = peer_id
+        peer['updated'] = datetime.datetime.utcnow()
+        peer['uploaded'] = uploaded
+        peer['downloaded'] = downloaded
+        peer['left'] = left
+
+        if status:
+            peer['status'] = status
+
+        swarm.set((ip, port), peer, self._get_zones(ip, peer))
+
+        self.dirty.add((info_hash, ip, port))
+
+    def get_peer(self, info_hash, ip, port):
+        try:
+            return self.swarms[info_hash].peers[(ip, port)]
+        except KeyError:
+            return None
+
+    def get_peers(self, info_hash, numwant, ip=None, port=None):
+        """
+        Returns random [(ip, port, compact)] of the active peers (see
+        expire). Luna seeders are kept regardless of age.
+        ip and port are of the requesting peer, it is never returned itself
+        """
+
+        if info_hash not in self.swarms:
+            return []
+
+        swarm = self.swarms[info_hash]
+        exclude = (ip, port) if ip else None
+
+        if self.policy != 'topology':
+            return swarm.sample(numwant, exclude=exclude)
+
+        zones = (('seeder', ), ) + self.topology.get(ip, ())
+
+        return swarm.sample(numwant, zones, exclude)
+
+    def get_counters(self, info_hash):
+        """
+        Returns (complete, incomplete, downloaded).
+        complete and incomplete are for the active peers only
+        """
+
+        if info_hash not in self.swarms:
+            return (0, 0, 0)
+
+        swarm = self.swarms[info_hash]
+        return (swarm.complete, swarm.incomplete, swarm.downloaded)
+
+    def get_swarm_size(self, info_hash):
+        """Returns number of the active peers"""
+
+        if info_hash not in self.swarms:
+            return 0
+
+        return len(self.swarms[info_hash].positions)
+
+    def get_bytes_left(self, info_hash):
+        """Returns sum of 'left' of the active peers"""
+
+        if info_hash not in self.swarms:
+            return 0
+
+        swarm = self.swarms[info_hash]
+        return sum([swarm.peers[key].get('left') or 0
+                    for key in swarm.positions])
+
+    def get_info_hashes(self):
+        return self.swarms.keys()
+
+    def _upsert_many(self, collection, updates):
+        """
+        Send [(spec, update)] as one unordered bulk operation if
+        pymongo supports it, one by one otherwise
+        """
+
+        mongo_collection = self.mongo_db[collection]
+
+        # Collection.__getattr__ returns subcollection, so check version
+        if pymongo.version_tuple >= (3, 0):
+            from pymongo import UpdateOne
+            mongo_collection.bulk_write(
+                [UpdateOne(spec, update, upsert=True)
+                 for spec, update in updates],
+                ordered=False)
+
+        elif pymongo.version_tuple >= (2, 7):
+            bulk = mongo_collection.initialize_unordered_bulk_op()
+            for spec, update in updates:
+                bulk.find(spec).upsert().update_one(update)
+            bulk.execute()
+
+        else:
+            for spec, update in updates:
+                mongo_collection.update(spec, update, upsert=True)
+
+    def _take_dirty(self):
+        """Returns (dirty, updates) for peers changed since last call"""
+
+        dirty, self.dirty = self.dirty, set()
+        synced = datetime.datetime.utcnow()
+
+        updates = []
+        for info_hash, ip, port in dirty:
+            json = self.get_peer(info_hash, ip, port)
+            if json is None:
+                continue
+
+            json = json.copy()
+            json['synced'] = synced
+            updates.append(({'info_hash': info_hash, 'ip': ip, 'port': port},
+                            {'$set': json}))
+
+        return dirty, updates
+
+    def flush(self):
+        """
+        Write peers changed since last flush to MongoDB.
+        Announces of the peer are coalesced, so only the last state
+        is written. Peers are kept dirty if write failed
+        """
+
+        dirty, updates = self._take_dirty()
+        if not updates:
+            return
+
+        try:
+            self._upsert_many('tracker', updates)
+        except:
+            self.dirty.update(dirty)
+            raise
+
+    def _load_query(self):
+        now = datetime.datetime.utcnow()
+
+        if self.last_load:
+            # MongoDB stores time with ms precision
+            query = {'synced': {'$gte': self.last_load -
+                                datetime.timedelta(seconds=1)}}
+        else:
+            query = {'updated': {'$gte': now -
+                                 datetime.timedelta(seconds=self.ttl)}}
+
+        return query, now
+
+    def _get_age(self, swarm):
+        """Seconds peer of the swarm is given to others"""
+
+        if self.announce_interval is None:
+            return self.age
+
+        return self.announce_interval.bound(len(swarm.positions)) * 2
+
+    def _apply_loaded(self, docs, now):
+        time_ages = {}
+
+        for doc in docs:
+            doc.pop('_id', None)
+            doc.pop('synced', None)
+            try:
+                info_hash = doc.pop('info_hash')
+                key = (doc.pop('ip'), doc.pop('port'))
+                updated = doc['updated']
+            except KeyError:
+                continue
+
+            swarm = self.swarms.setdefault(info_hash, Swarm())
+            if key in swarm.peers and swarm.peers[key]['updated'] >= updated:
+                continue
+
+            swarm.set(key, doc, self._get_zones(key[0], doc))
+
+            # computed once per swarm and load
+            if info_hash not in time_ages:
+                time_ages[info_hash] = now - datetime.timedelta(
+                    seconds=self._get_age(swarm))
+
+            if not self._is_active(key, doc, time_ages[info_hash]):
+                swarm.deactivate(key)
+
+        self.last_load = now
+
+    def load(self):
+        """Load peers written by the other processes since last load"""
+
+        query, now = self._load_query()
+        self._apply_loaded(self.mongo_db['tracker'].find(query), now)
+
+    def _fetch_topology(self):
+        """Returns docs of networks, groups and nodes. Three queries"""
+
+        networks = list(self.mongo_db['network'].find(
+            {}, {'NETWORK': 1, 'version': 1}))
+        groups = list(self.mongo_db['group'].find({}, {'interfaces': 1}))
+        nodes = list(self.mongo_db['node'].find(
+            {}, {'group': 1, 'switch': 1, 'interfaces': 1}))
+
+        return networks, groups, nodes
+
+    def _apply_topology(self, network_docs, group_docs, node_docs):
+        networks = {}
+        for doc in network_docs:
+            networks[doc['_id']] = (doc['NETWORK'], doc['version'])
+
+        group_nets = {}
+        for doc in group_docs:
+            group_ifs = doc.get('interfaces') or {}
+            group_nets[doc['_id']] = {}
+            for if_uuid in group_ifs:
+                group_nets[doc['_id']][if_uuid] = (
+                    group_ifs[if_uuid].get('network') or {})
+
+        topology = {}
+        for doc in node_docs:
+
+            if not doc.get('group'):
+                continue
+
+            group_id = doc['group'].id
+            zones = (('group', group_id), )
+            if doc.get('switch'):
+                zones = (('switch', doc['switch'].id), ) + zones
+
+            if_nets = group_nets.get(group_id, {})
+            node_ifs = doc.get('interfaces') or {}
+            for if_uuid in node_ifs:
+                for ver in ['4', '6']:
+                    ipnum = node_ifs[if_uuid].get(ver)
+                    net_dbref = if_nets.get(if_uuid, {}).get(ver)
+                    if not ipnum or not net_dbref:
+                        continue
+
+                    if net_dbref.id not in networks:
+                        continue
+
+                    num_net, version = networks[net_dbref.id]
+                    ip = utils.ip.reltoa(num_net, ipnum, version)
+                    topology[ip] = zones
+
+        self.topology = topology
+        self.last_topology = datetime.datetime.utcnow()
+
+        for swarm in self.swarms.values():
+            for key in swarm.positions.keys():
+                swarm.set_zones(key, self._get_zones(key[0],
+                                                     swarm.peers[key]))
+
+    def load_topology(self):
+        """
+        Read switches and groups of the nodes and map nodes' IPs to them.
+        Three queries are used: nodes, groups and networks
+        """
+
+        self._apply_topology(*self._fetch_topology())
+
+    def _is_active(self, key, peer, time_age):
+        if peer['updated'] >= time_age:
+            return True
+
+        return peer['peer_id'] == self.luna_peer_id and key[1] != 0
+
+    def expire(self):
+        """
+        Exclude peers which have not announced for 'age' seconds
+        from peer lists, forget them after ttl seconds
+        """
+
+        now = datetime.datetime.utcnow()
+        time_ttl = now - datetime.timedelta(seconds=self.ttl)
+
+        for info_hash in self.swarms.keys():
+            swarm = self.swarms[info_hash]
+            time_age = now - datetime.timedelta(seconds=self._get_age(swarm))
+            for key in swarm.peers.keys():
+                peer = swarm.peers[key]
+                if peer['updated'] < time_ttl:
+                    swarm.remove(key)
+                elif not self._is_active(key, peer, time_age):
+                    swarm.deactivate(key)
+
+            if not swarm:
+                self.swarms.pop(info_hash)
+
+    def _need_topology(self):
+        if self.policy != 'topology':
+            return False
+
+        if self.last_topology is None:
+            return True
+
+        return (datetime.datetime.utcnow() - self.last_topology >
+                datetime.timedelta(seconds=self.topology_ttl))
+
+    def _sync_io(self, updates, query, need_topology):
+        """DB part of sync. Can be run in executor's thread"""
+
+        if updates:
+            self._upsert_many('tracker', updates)
+
+        docs = list(self.mongo_db['tracker'].find(query))
+
+        topology_docs = None
+        if need_topology:
+            topology_docs = self._fetch_topology()
+
+        return docs, topology_docs
+
+    def sync(self, executor=None):
+        """
+        Persist and refresh peers. Supposed to be called periodically.
+        If executor is given, DB is queried in its thread and
+        in-memory state is updated in the callback. Sync is skipped
+        if the previous one is still running
+        """
+
+        if self.syncing:
+            return
+
+        dirty, updates = self._take_dirty()
+        query, now = self._load_query()
+
+        def sync_done(result):
+            self.syncing = False
+
+            if isinstance(result, utils.executor.Failure):
+                self.dirty.update(dirty)
+                self.log.error("Unable to sync tracker peers with MongoDB")
+                return
+
+            docs, topology_docs = result
+            try:
+                if topology_docs:
+                    self._apply_topology(*topology_docs)
+                self._apply_loaded(docs, now)
+                self.expire()
+            except:
+                self.log.error("Unable to sync tracker peers with MongoDB")
+
+        self.syncing = True
+        (executor or utils.executor.Executor()).run(
+            self._sync_io, updates, query, self._need_topology(),
+            callback=sync_done)
 
 
 class BaseHandler(tornado.web.RequestHandler):
     """info_hach and peer_id can contain non-unicode symbols"""
 
+    metrics_name = 'tracker'
+
+    def prepare(self):
+        self._mongo_ops = utils.metrics.thread_ops()
+
+    def on_finish(self):
+        utils.metrics.observe_request(
+            self.request.request_time(),
+            utils.metrics.thread_ops() - self._mongo_ops,
+            handler=self.metrics_name)
+
     def decode_argument(self, value, name):
         # info_hash is raw_bytes, hexify it.
         if name in ['info_hash', 'peer_id']:
@@ -55,6 +735,8 @@ class BaseHandler(tornado.web.RequestHandler):
 class AnnounceHandler(BaseHandler):
     """Track the torrents. Respond with the peer-list"""
 
+    metrics_name = 'announce'
+
     def initialize(self, params):
         self.PEER_INCREASE_LIMIT = 30
         self.DEFAULT_ALLOWED_PEERS = 50
@@ -89,92 +771,53 @@ class AnnounceHandler(BaseHandler):
         self.tracker_min_interval = params['luna_tracker_min_interval']
         self.tracker_maxpeers = params['luna_tracker_maxpeers']
         self.mongo_db = params['mongo_db']
+        self.peer_store = params['peer_store']
+        self.announce_interval = (
+            params.get('announce_interval') or
+            AnnounceInterval(self.tracker_interval, self.tracker_min_interval)
+        )
 
-    @tornado.web.asynchronous
-    @tornado.gen.engine
     def update_peers(self, info_hash, peer_id, ip, port, status, uploaded,
                      downloaded, left):
         """Store the information about the peer"""
 
-        updated = datetime.datetime.utcnow()
-        json = {'peer_id': peer_id, 'updated': updated,
-                'uploaded': uploaded, 'downloaded': downloaded, 'left': left}
-
-        if status:
-            json['status'] = status
-
-        self.mongo_db['tracker'].find_and_modify({'info_hash': info_hash,
-                                                  'ip': ip, 'port': port},
-                                                 {'$set': json}, upsert=True)
+        self.peer_store.update(info_hash, peer_id, ip, port, status,
+                               uploaded, downloaded, left)
 
-    @tornado.web.asynchronous
-    @tornado.gen.engine
-    def get_peers(self, info_hash, numwant, compact, no_peer_id, age):
-        time_age = datetime.datetime.utcnow() - datetime.timedelta(seconds=age)
-        peer_tuple_list = []
-        n_leechers = 0
-        n_seeders = 0
-
-        nodes = self.mongo_db['tracker'].find({'info_hash': info_hash,
-                                               'updated': {'$gte': time_age}},
-                                              {'peer_id': 1, 'ip': 1,
-                                               'port': 1, 'status': 1})
-        for doc in nodes:
-            peer_tuple_list.append((binascii.unhexlify(doc['peer_id']),
-                                    doc['ip'], doc['port']))
-
-            try:
-                n_leechers += int(doc['status'] == 'started')
-                n_seeders += int(doc['status'] == 'completed')
-            except:
-                pass
-
-        peer_id = binascii.hexlify('lunalunalunalunaluna')
-        servers = self.mongo_db['tracker'].find({'info_hash': info_hash,
-                                                 'peer_id': peer_id,
-                                                 'port': {'$ne': 0}},
-                                                {'peer_id': 1, 'ip': 1,
-                                                 'port': 1, 'status': 1})
-        for doc in servers:
-            peer_tuple_list.append((binascii.unhexlify(doc['peer_id']),
-                                    doc['ip'], doc['port']))
-
-            try:
-                n_leechers += int(doc['status'] == 'started')
-                n_seeders += int(doc['status'] == 'completed')
-            except:
-                pass
-
-        # It's believed it will get better 'cohesion'
-        if numwant > len(peer_tuple_list):
-            numwant = len(peer_tuple_list)
+    def get_peers(self, info_hash, numwant, compact, no_peer_id,
+                  peer_ip=None, peer_port=None):
+        n_seeders, n_leechers, _ = self.peer_store.get_counters(info_hash)
 
         peers = []
-        compact_peers = b''
-        random_peer_list = random.sample(peer_tuple_list, numwant)
-        for peer_info in random_peer_list:
+        compact_peers = []
+        compact_peers6 = []
+        for ip, port, compact_peer in self.peer_store.get_peers(
+                info_hash, numwant, peer_ip, peer_port):
             if compact:
-                try:
-                    ip = inet_aton(peer_info[1])
-                    port = pack('>H', int(peer_info[2]))
-                    compact_peers += (ip+port)
-                except:
-                    pass
+                if len(compact_peer) == 6:
+                    compact_peers.append(compact_peer)
+                else:
+                    compact_peers6.append(compact_peer)
 
                 continue
 
-            p = {}
-            p['peer_id'], p['ip'], p['port'] = peer_info
+            p = {'ip': ip, 'port': port}
+            if not no_peer_id:
+                peer = self.peer_store.get_peer(info_hash, ip, port)
+                p['peer id'] = binascii.unhexlify(peer['peer_id'])
             peers.append(p)
 
         self.response['complete'] = n_seeders
         self.response['incomplete'] = n_leechers
 
         if compact:
+            compact_peers = b''.join(compact_peers)
             logging.debug('compact peer list: %r' % compact_peers)
-            peers = compact_peers
             self.response['peers'] = compact_peers
 
+            if compact_peers6:
+                self.response['peers6'] = b''.join(compact_peers6)
+
         else:
             logging.debug('peer list: %r' % peers)
             self.response['peers'] = peers
@@ -237,17 +880,21 @@ class AnnounceHandler(BaseHandler):
 
         self.update_peers(info_hash, peer_id, ip, port, event,
                           uploaded, downloaded, left)
+        utils.metrics.inc('announces_total', protocol='http')
 
         # generate response
         self.response = {}
 
+        interval, min_interval = self.announce_interval.get(
+            self.peer_store.get_swarm_size(info_hash))
+
         # Interval in seconds that the client should wait between sending
         # regular requests to the tracker.
-        self.response['interval'] = self.tracker_interval
+        self.response['interval'] = interval
 
         # Minimum announce interval. If present clients must not re-announce
         # more frequently than this.
-        self.response['min interval'] = self.tracker_min_interval
+        self.response['min interval'] = min_interval
 
         self.response['tracker id'] = tracker_id
 
@@ -257,8 +904,7 @@ class AnnounceHandler(BaseHandler):
         if warning_message:
             self.response['warning message'] = warning_message
 
-        self.get_peers(info_hash, numwant, compact, no_peer_id,
-                       self.tracker_interval * 2)
+        self.get_peers(info_hash, numwant, compact, no_peer_id, ip, port)
 
         self.set_header('Content-Type', 'text/plain')
         self.write(bencode(self.response))
@@ -268,27 +914,234 @@ class AnnounceHandler(BaseHandler):
 class ScrapeHandler(AnnounceHandler):
     """Returns the state of all torrents this tracker is managing"""
 
+    metrics_name = 'scrape'
+
     @tornado.web.asynchronous
-    @tornado.gen.engine
     def get(self):
-        response = {}
+        info_hashes = self.get_arguments('info_hash', strip=False)
+        if not info_hashes:
+            info_hashes = self.peer_store.get_info_hashes()
 
-        info_hashes = self.get_arguments('info_hash')
+        files = {}
         for info_hash in info_hashes:
             info_hash = str(info_hash)
-            response[info_hash] = {}
-            numwant = 100
-            compact = True
-            no_peer_id = 1
+            if len(info_hash) != self.INFO_HASH_LEN:
+                self.send_error(self.INVALID_INFO_HASH)
+                return
 
-            complete, incomplete, _ = self.get_peers(info_hash, numwant,
-                                                     compact, no_peer_id,
-                                                     self.tracker_interval * 2)
+            complete, incomplete, downloaded = \
+                self.peer_store.get_counters(info_hash)
 
-            response[info_hash]['complete'] = complete
-            response[info_hash]['downloaded'] = complete
-            response[info_hash]['incomplete'] = incomplete
+            files[binascii.unhexlify(info_hash)] = {
+                'complete': complete,
+                'downloaded': downloaded,
+                'incomplete': incomplete,
+            }
 
-        self.set_header('content-type', 'text/plain')
-        self.write(bencode(response))
+        self.set_header('Content-Type', 'text/plain')
+        self.write(bencode({'files': files}))
         self.finish()
+
+
+def bind_udp_sockets(port, address=None):
+    """
+    Creates non-blocking UDP sockets bound to the given address and port.
+    Sockets are supposed to be created before tornado forks, so every
+    child process receives datagrams from the same port
+    """
+
+    sockets = []
+    if address == "":
+        address = None
+
+    for res in set(socket.getaddrinfo(address, port, socket.AF_UNSPEC,
+                                      socket.SOCK_DGRAM, 0,
+                                      socket.AI_PASSIVE)):
+        af, socktype, proto, canonname, sockaddr = res
+        sock = socket.socket(af, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if af == socket.AF_INET6 and hasattr(socket, "IPPROTO_IPV6"):
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        sockets.append(sock)
+
+    return sockets
+
+
+class UDPTracker(object):
+    """
+    UDP tracker protocol (BEP 15): connect, announce and scrape.
+    Uses the same peer store as AnnounceHandler.
+    Connection IDs are derived from the client address and the current
+    minute, signed with the secret, so any lweb process can validate them
+    """
+
+    log = logging.getLogger(__name__)
+
+    PROTOCOL_ID = 0x41727101980
+
+    ACTION_CONNECT = 0
+    ACTION_ANNOUNCE = 1
+    ACTION_SCRAPE = 2
+    ACTION_ERROR = 3
+
+    EVENTS = {0: '', 1: 'completed', 2: 'started', 3: 'stopped'}
+
+    HEADER = '>QII'
+    ANNOUNCE = '>QII20s20sQQQIIIiH'
+    MAX_SCRAPE = 74
+    DEFAULT_ALLOWED_PEERS = 50
+
+    def __init__(self, params):
+        """
+        params - the same dict which is given to AnnounceHandler.
+                 'udp_secret' is shared by the lweb processes
+        """
+
+        self.tracker_interval = params['luna_tracker_interval']
+        self.tracker_maxpeers = params['luna_tracker_maxpeers']
+        self.peer_store = params['peer_store']
+        self.secret = params['udp_secret']
+        self.announce_interval = (
+            params.get('announce_interval') or
+            AnnounceInterval(self.tracker_interval,
+                             params['luna_tracker_min_interval'])
+        )
+
+    def connection_id(self, addr, minute=None):
+        if minute is None:
+            minute = int(time.time() / 60)
+
+        digest = hmac.new(self.secret,
+                          '{}:{}:{}'.format(addr[0], addr[1], minute),
+                          hashlib.sha1).digest()
+
+        return unpack('>Q', digest[:8])[0]
+
+    def check_connection_id(self, connection_id, addr):
+        """Connection ID is valid for 1 to 2 minutes"""
+
+        minute = int(time.time() / 60)
+        return connection_id in [self.connection_id(addr, minute),
+                                 self.connection_id(addr, minute - 1)]
+
+    def error(self, transaction_id, message):
+        return pack('>II', self.ACTION_ERROR, transaction_id) + message
+
+    def handle(self, data, addr):
+        """Returns response to the datagram or None if it should be ignored"""
+
+        if len(data) < calcsize(self.HEADER):
+            return None
+
+        connection_id, action, transaction_id = unpack(
+            self.HEADER, data[:calcsize(self.HEADER)])
+
+        if action == self.ACTION_CONNECT:
+            if connection_id != self.PROTOCOL_ID:
+                return None
+
+            return pack('>IIQ', self.ACTION_CONNECT, transaction_id,
+                        self.connection_id(addr))
+
+        if not self.check_connection_id(connection_id, addr):
+            return self.error(transaction_id, 'Connection ID mismatch')
+
+        if action == self.ACTION_ANNOUNCE:
+            return self.announce(data, addr, transaction_id)
+
+        if action == self.ACTION_SCRAPE:
+            return self.scrape(data, transaction_id)
+
+        return self.error(transaction_id, 'Invalid action')
+
+    def announce(self, data, addr, transaction_id):
+        if len(data) < calcsize(self.ANNOUNCE):
+            return self.error(transaction_id, 'Malformed announce')
+
+        (_, _, _, info_hash, peer_id, downloaded, left, uploaded, event,
+         announce_ip, _, numwant, port) = unpack(
+            self.ANNOUNCE, data[:calcsize(self.ANNOUNCE)])
+
+        ip = addr[0]
+        if ip.startswith('::ffff:') and '.' in ip:
+            ip = ip[len('::ffff:'):]
+
+        if announce_ip and ':' not in ip:
+            ip = inet_ntoa(pack('>I', announce_ip))
+
+        if numwant < 0:
+            numwant = self.DEFAULT_ALLOWED_PEERS
+        numwant = min(numwant, self.tracker_maxpeers)
+
+        info_hash = binascii.hexlify(info_hash)
+        self.peer_store.update(info_hash, binascii.hexlify(peer_id), ip,
+                               port, self.EVENTS.get(event, ''), uploaded,
+                               downloaded, left)
+        utils.metrics.inc('announces_total', protocol='udp')
+
+        # peers of the family of the request only
+        compact_len = 18 if ':' in ip else 6
+        peers = [compact for _, _, compact in
+                 self.peer_store.get_peers(info_hash, numwant, ip, port)
+                 if len(compact) == compact_len]
+
+        complete, incomplete, _ = self.peer_store.get_counters(info_hash)
+        interval, _ = self.announce_interval.get(
+            self.peer_store.get_swarm_size(info_hash))
+
+        return (pack('>IIIII', self.ACTION_ANNOUNCE, transaction_id,
+                     interval, incomplete, complete) +
+                b''.join(peers))
+
+    def scrape(self, data, transaction_id):
+        offset = calcsize(self.HEADER)
+        info_hashes = [data[i:i + 20]
+                       for i in range(offset, len(data) - 19, 20)]
+
+        response = pack('>II', self.ACTION_SCRAPE, transaction_id)
+        for info_hash in info_hashes[:self.MAX_SCRAPE]:
+            complete, incomplete, downloaded = self.peer_store.get_counters(
+                binascii.hexlify(info_hash))
+            response += pack('>III', complete, downloaded, incomplete)
+
+        return response
+
+    def start(self, sockets, io_loop=None):
+        """Listen for datagrams on the sockets using tornado IOLoop"""
+
+        io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        for sock in sockets:
+            io_loop.add_handler(sock.fileno(),
+                                functools.partial(self._on_read, sock),
+                                io_loop.READ)
+
+    def _on_read(self, sock, fd, events):
+        while True:
+            try:
+                data, addr = sock.recvfrom(2048)
+            except socket.error as e:
+                # datagram can be received by the other lweb process
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                raise
+
+            start = time.time()
+            try:
+                response = self.handle(data, addr)
+                utils.metrics.observe('request_seconds', time.time() - start,
+                                      handler='udp')
+            except:
+                self.log.error("Unable to handle UDP tracker request from {}"
+                               .format(addr[0]))
+                continue
+
+            if response is None:
+                continue
+
+            try:
+                sock.sendto(response, addr)
+            except socket.error:
+                self.log.error("Unable to send UDP tracker response to {}"
+                               .format(addr[0]))
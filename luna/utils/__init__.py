@@ -1,5 +1,12 @@
-__all__ = ['freelist', 'ip', 'utils']
+__all__ = ['freelist', 'ip', 'utils', 'cache', 'metrics', 'executor',
+           'templates', 'pack', 'manifest']
 
 import ip
 import freelist
 import helpers
+import cache
+import metrics
+import executor
+import templates
+import pack
+import manifest
@@ -0,0 +1,156 @@
+'''
+Written by Dmitry Chirikov <dmitry@chirikov.ru>
+This file is part of Luna, cluster provisioning tool
+https://github.com/dchirikov/luna
+
+This file is part of Luna.
+
+Luna is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Luna is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Luna.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+# Read-through cache of the documents luna objects are built from.
+# Documents are stored per database and keyed by (collection, _id);
+# names are mapped to _id, so lookups by name are served as well.
+# Base.set/link/unlink/delete invalidate the entries they touch.
+# Long-running daemons should configure ttl, so changes done by
+# other processes (luna CLI, for instance) will be picked up.
+
+import copy
+import time
+import weakref
+import threading
+import contextlib
+
+_enabled = True
+_ttl = None
+_lock = threading.RLock()
+# depth of bypass() per thread
+_local = threading.local()
+
+# {mongo_db: {'docs': {(collection, _id): (doc, timestamp)},
+#             'names': {(collection, name): _id}}}
+_dbs = weakref.WeakKeyDictionary()
+
+
+def configure(enabled=True, ttl=None):
+    """
+    enabled - cache documents or not
+    ttl     - seconds to keep document in cache. None - forever
+    """
+    global _enabled, _ttl
+
+    with _lock:
+        _enabled = bool(enabled)
+        _ttl = ttl or None
+        if not _enabled:
+            _dbs.clear()
+
+
+@contextlib.contextmanager
+def bypass():
+    """
+    Documents are read from DB by the current thread within the block.
+    Documents read are cached as usual
+    """
+
+    depth = getattr(_local, 'bypass', 0)
+    _local.bypass = depth + 1
+    try:
+        yield
+    finally:
+        _local.bypass = depth
+
+
+def _get_db_cache(mongo_db):
+    try:
+        db_cache = _dbs[mongo_db]
+    except KeyError:
+        db_cache = {'docs': {}, 'names': {}}
+        _dbs[mongo_db] = db_cache
+
+    return db_cache
+
+
+def get(mongo_db, collection, id=None, name=None):
+    """Returns copy of the cached document or None"""
+
+    if not _enabled or mongo_db is None or getattr(_local, 'bypass', 0):
+        return None
+
+    with _lock:
+        db_cache = _get_db_cache(mongo_db)
+
+        if id is None and name is not None:
+            id = db_cache['names'].get((collection, name))
+
+        if id is None:
+            return None
+
+        try:
+            doc, timestamp = db_cache['docs'][(collection, id)]
+        except KeyError:
+            return None
+
+        if _ttl and time.time() - timestamp > _ttl:
+            invalidate(mongo_db, collection, id)
+            return None
+
+        return copy.deepcopy(doc)
+
+
+def put(mongo_db, collection, doc):
+    """Stores copy of the document"""
+
+    if not _enabled or mongo_db is None or not doc or '_id' not in doc:
+        return None
+
+    with _lock:
+        db_cache = _get_db_cache(mongo_db)
+        db_cache['docs'][(collection, doc['_id'])] = (copy.deepcopy(doc),
+                                                     time.time())
+        if 'name' in doc:
+            db_cache['names'][(collection, doc['name'])] = doc['_id']
+
+
+def invalidate(mongo_db, collection, id):
+    """Drops document from cache"""
+
+    if mongo_db is None:
+        return None
+
+    with _lock:
+        if mongo_db not in _dbs:
+            return None
+
+        db_cache = _dbs[mongo_db]
+
+        try:
+            doc, _ = db_cache['docs'].pop((collection, id))
+        except KeyError:
+            return None
+
+        name_key = (collection, doc.get('name'))
+        if db_cache['names'].get(name_key) == id:
+            db_cache['names'].pop(name_key)
+
+
+def clear(mongo_db=None):
+    """Drops cached documents for mongo_db or for every database"""
+
+    with _lock:
+        if mongo_db is None:
+            _dbs.clear()
+        elif mongo_db in _dbs:
+            del _dbs[mongo_db]
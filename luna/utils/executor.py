@@ -0,0 +1,117 @@
+'''
+Written by Dmitry Chirikov <dmitry@chirikov.ru>
+This file is part of Luna, cluster provisioning tool
+https://github.com/dchirikov/luna
+
+This file is part of Luna.
+
+Luna is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Luna is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Luna.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+# Pool of threads running blocking calls (pymongo, mostly) for tornado
+# handlers, so IOLoop can serve other requests while DB is queried.
+# Callbacks are always called in IOLoop thread, so they can safely touch
+# handlers and in-memory state. Executor with no workers runs calls
+# in place, which is handy for tests and tools.
+
+import sys
+import Queue
+import logging
+import threading
+import functools
+import traceback
+
+log = logging.getLogger(__name__)
+
+
+class Failure(object):
+    """Passed to callback instead of result if call raised an exception"""
+
+    def __init__(self, exc_info):
+        self.exc_type, self.exc_value, self.exc_tb = exc_info
+
+    def __repr__(self):
+        return "Failure({!r})".format(self.exc_value)
+
+
+class Executor(object):
+
+    def __init__(self, workers=0, io_loop=None):
+        """
+        workers - number of threads. 0 - run calls in caller's thread
+        io_loop - tornado IOLoop to run callbacks in.
+                  Should be created after fork_processes
+        """
+        self.workers = workers
+        self.io_loop = io_loop
+        self.queue = Queue.Queue()
+        self.threads = []
+
+        if self.workers and self.io_loop is None:
+            import tornado.ioloop
+            self.io_loop = tornado.ioloop.IOLoop.instance()
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker,
+                                      name='executor-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _call(self, fn, args, kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except:
+            log.error("Call of {} failed: {}"
+                      .format(getattr(fn, '__name__', fn),
+                              traceback.format_exc()))
+            return Failure(sys.exc_info())
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            fn, args, kwargs, callback = item
+            result = self._call(fn, args, kwargs)
+            if callback is not None:
+                self.io_loop.add_callback(functools.partial(callback, result))
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs) and pass result to 'callback'.
+        Compatible with tornado.gen.Task:
+            result = yield tornado.gen.Task(executor.run, fn, arg)
+        """
+
+        callback = kwargs.pop('callback', None)
+
+        if not self.workers:
+            result = self._call(fn, args, kwargs)
+            if callback is not None:
+                callback(result)
+            return
+
+        self.queue.put((fn, args, kwargs, callback))
+
+    def shutdown(self):
+        for thread in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
@@ -20,10 +20,11 @@ along with Luna.  If not, see <http://www.gnu.org/licenses/>.
 
 '''
 
-from luna.config import db_name
+from luna.config import db_name, params_collection
 import logging
 import pymongo
 import ConfigParser
+import threading
 import urllib
 import sys
 import os
@@ -31,27 +32,135 @@ import errno
 import subprocess
 import ssl
 
+from bson.dbref import DBRef
+
+# Process-wide MongoDB connection registry.
+# MongoClient keeps its own socket pool, so every object in the process
+# should share a single client instead of opening a new one.
+# Client is bound to the PID it was created in: after fork() the child
+# drops the inherited client and connects again.
+_con_options = None
+_mongo_client = None
+_mongo_client_pid = None
+_mongo_db = None
+_mongo_lock = threading.RLock()
+
+
+# document of node params collection counting invalidations
+_params_generation = {'_id': 'generation'}
+
+
+def get_params_generation(mongo_db):
+    doc = mongo_db[params_collection].find_one(_params_generation)
+    return doc and doc.get('generation') or 0
+
+
+def invalidate_params(mongo_db, deps):
+    """
+    Drop stored node params depending on any of deps.
+    Generation is increased first, so params computed at the same
+    time are not stored (see Node.get_params)
+    """
+
+    mongo_db[params_collection].update(_params_generation,
+                                       {'$inc': {'generation': 1}},
+                                       upsert=True)
+    mongo_db[params_collection].remove({'deps': {'$in': deps}})
+
 
 def set_mac_node(mac, node, mongo_db=None):
     logging.basicConfig(level=logging.INFO)
 #    logging.basicConfig(level=logging.DEBUG)
     logger = logging.getLogger(__name__)
     if not mongo_db:
-        try:
-            mongo_client = pymongo.MongoClient(**get_con_options())
-        except:
-            err_msg = "Unable to connect to MongoDB."
-            logger.error(err_msg)
-            raise RuntimeError, err_msg
-        logger.debug("Connection to MongoDB was successful.")
-        mongo_db = mongo_client[db_name]
+        mongo_db = get_mongo_db()
     mongo_collection = mongo_db['mac']
-    mongo_collection.remove({'mac': mac})
     mongo_collection.remove({'node': node})
-    mongo_collection.insert({'mac': mac, 'node': node})
+    # mac is a unique key, so concurrent discoveries of the same MAC
+    # update one document. Losing upsert gets DuplicateKeyError
+    ret = True
+    for attempt in range(3):
+        try:
+            mongo_collection.update({'mac': mac}, {'$set': {'node': node}},
+                                    upsert=True)
+            break
+        except pymongo.errors.DuplicateKeyError:
+            logger.debug("MAC '{}' was inserted concurrently".format(mac))
+    else:
+        logger.error("Unable to assign MAC '{}' to node '{}'"
+                     .format(mac, node.id))
+        ret = False
+
+    # node params depend on MAC address. Invalidated after the change,
+    # like in Base.set, so params computed meanwhile are not kept
+    invalidate_params(mongo_db, [mac, node.id])
+
+    return ret
+
 
+def find_node_by_macs(macs, mongo_db=None):
+    """
+    Returns (node_id, mac) for the node having one of the given MACs.
+    Known MACs are checked first, then MACs learned from switches.
+    mac is returned only if node was found using switch and port
+    """
+    if not mongo_db:
+        mongo_db = get_mongo_db()
+
+    macs = list(set([str(mac).lower() for mac in macs if mac]))
+    if not macs:
+        return (None, None)
+
+    doc = mongo_db['mac'].find_one({'mac': {'$in': macs}},
+                                   {'_id': 0, 'node': 1})
+    if doc and doc['node']:
+        return (doc['node'].id, None)
+
+    learned = mongo_db['switch_mac'].find(
+        {'mac': {'$in': macs}},
+        {'_id': 0, 'mac': 1, 'switch_id': 1, 'port': 1, 'portname': 1})
+    learned = list(learned)
+
+    conditions = []
+    for elem in learned:
+        switch = DBRef('switch', elem['switch_id'])
+        for key in ['portname', 'port']:
+            if elem.get(key):
+                conditions.append({'switch': switch, 'port': elem[key]})
+
+    if not conditions:
+        return (None, None)
+
+    nodes = {}
+    for doc in mongo_db['node'].find({'$or': conditions},
+                                     {'switch': 1, 'port': 1}):
+        nodes[(doc['switch'].id, doc['port'])] = doc['_id']
+
+    # portnames like 'Gi2/0/26' take precedence over portnumbers
+    for key in ['portname', 'port']:
+        for elem in learned:
+            node_id = nodes.get((elem['switch_id'], elem.get(key)))
+            if node_id:
+                return (node_id, elem['mac'])
+
+    return (None, None)
 
-def get_con_options():
+
+def get_con_options(reread=False):
+    """
+    Returns connection options parsed from /etc/luna.conf
+    File is parsed once per process. Use reread=True to force parsing
+    """
+    global _con_options
+
+    with _mongo_lock:
+        if _con_options is None or reread:
+            _con_options = _read_con_options()
+
+        return _con_options.copy()
+
+
+def _read_con_options():
     con_options = {'host': 'mongodb://'}
     conf_defaults = {'server': 'localhost', 'replicaset': None,
                     'authdb': None, 'user': None, 'password': None,
@@ -91,6 +200,67 @@ def get_con_options():
     return con_options
 
 
+def get_mongo_client():
+    """
+    Returns MongoClient shared by the whole process.
+    Client is created on first call and re-created in forked children
+    """
+    global _mongo_client, _mongo_client_pid, _mongo_db
+
+    logger = logging.getLogger(__name__)
+
+    with _mongo_lock:
+        pid = os.getpid()
+
+        if _mongo_client is not None and _mongo_client_pid == pid:
+            return _mongo_client
+
+        _mongo_db = None
+
+        try:
+            _mongo_client = pymongo.MongoClient(**get_con_options())
+        except:
+            _mongo_client = None
+            _mongo_client_pid = None
+            err_msg = "Unable to connect to MongoDB."
+            logger.error(err_msg)
+            raise RuntimeError, err_msg
+
+        _mongo_client_pid = pid
+        logger.debug("Connection to MongoDB was successful.")
+
+        return _mongo_client
+
+
+def get_mongo_db():
+    """Returns luna database using shared MongoClient"""
+    global _mongo_db
+
+    with _mongo_lock:
+        client = get_mongo_client()
+
+        if _mongo_db is None:
+            _mongo_db = client[db_name]
+
+        return _mongo_db
+
+
+def reset_mongo_client():
+    """
+    Drops shared MongoClient. Should be called in child processes
+    right after fork(), so sockets of the parent will not be reused
+    """
+    global _mongo_client, _mongo_client_pid, _mongo_db
+
+    with _mongo_lock:
+        if _mongo_client is not None and _mongo_client_pid == os.getpid():
+            _mongo_client.close()
+
+        _mongo_client = None
+        _mongo_client_pid = None
+        _mongo_db = None
+
+
 def clone_dirs(path1=None, path2=None):
 
     if not path1 or not path2:
@@ -316,14 +486,7 @@ def list_cached_macs(switch_id=None, mongo_db=None):
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger(__name__)
     if not mongo_db:
-        try:
-            mongo_client = pymongo.MongoClient(**get_con_options())
-        except:
-            err_msg = "Unable to connect to MongoDB."
-            logger.error(err_msg)
-            raise RuntimeError, err_msg
-        logger.debug("Connection to MongoDB was successful.")
-        mongo_db = mongo_client[db_name]
+        mongo_db = get_mongo_db()
     mongo_collection = mongo_db['switch_mac']
     if switch_id:
         cursor = mongo_collection.find({'switch_id': switch_id})
@@ -345,14 +508,7 @@ def list_node_macs(mongo_db=None):
     logger = logging.getLogger(__name__)
 
     if not mongo_db:
-        try:
-            mongo_client = pymongo.MongoClient(**get_con_options())
-        except:
-            err_msg = "Unable to connect to MongoDB."
-            logger.error(err_msg)
-            raise RuntimeError, err_msg
-        logger.debug("Connection to MongoDB was successful.")
-        mongo_db = mongo_client[db_name]
+        mongo_db = get_mongo_db()
 
     cursor = mongo_db['mac'].find()
     node_macs = {}
@@ -368,14 +524,7 @@ def find_duplicate_net(num_net, mongo_db=None):
     logger = logging.getLogger(__name__)
 
     if mongo_db is None:
-        try:
-            mongo_client = pymongo.MongoClient(**get_con_options())
-        except:
-            err_msg = "Unable to connect to MongoDB."
-            logger.error(err_msg)
-            raise RuntimeError, err_msg
-        logger.debug("Connection to MongoDB was successful.")
-        mongo_db = mongo_client[db_name]
+        mongo_db = get_mongo_db()
     mongo_collection = mongo_db['network']
     net_doc = mongo_collection.find_one({'NETWORK': num_net})
     if net_doc is None:
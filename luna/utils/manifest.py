@@ -0,0 +1,261 @@
+'''
+Written by Dmitry Chirikov <dmitry@chirikov.ru>
+This file is part of Luna, cluster provisioning tool
+https://github.com/dchirikov/luna
+
+This file is part of Luna.
+
+Luna is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Luna is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Luna.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+# Manifest of the osimage: one entry per file, directory, link, etc. with
+# SHA-1 of the content for regular files. Comparing manifests of two packs
+# gives the list of changed and removed files, so only changed files are
+# sent to the nodes which already have previous version of the image.
+# Inode, size, mtime and ctime are used to take hashes of unchanged files
+# from the previous manifest instead of reading them again. Times are
+# stored in nanoseconds: a file rewritten within the same second keeps
+# int(st_mtime). Changing xattrs, ACLs or SELinux labels updates ctime,
+# so such files are not considered unchanged either.
+# Paths are also split to groups, packed as independently compressed
+# segments of the tarball. Boundaries of the groups depend on the paths
+# only, so adding or removing the file does not shift other groups and
+# unchanged segments can be copied from the previous tarball.
+
+import os
+import stat
+import json
+import gzip
+import hashlib
+
+BUF_SIZE = 1024 * 1024
+
+# paths are byte strings which are not always valid UTF-8
+ENCODING = 'latin-1'
+
+# average number of paths in the group
+GROUP_PATHS = 1024
+
+# limits size of the segment to repack if one file is changed
+GROUP_MAX_SIZE = 256 * 1024 * 1024
+
+# used by tar to store owner names in every header
+ACCOUNTS = ['./etc/passwd', './etc/group']
+
+# fields used only to find unchanged files
+_LOCAL_KEYS = ['inode']
+
+# manifests of other versions are not comparable with the current one
+VERSION = 2
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(BUF_SIZE)
+            if not data:
+                break
+            sha1.update(data)
+
+    return sha1.hexdigest()
+
+
+def _ns(t):
+    return int(round(t * 1000000000))
+
+
+def get_entry(path, st, previous=None):
+    """
+    Returns entry for path.
+    previous - entry of the same path in the previous manifest
+    """
+
+    entry = {'mode': st.st_mode, 'uid': st.st_uid, 'gid': st.st_gid,
+             'mtime': _ns(st.st_mtime), 'ctime': _ns(st.st_ctime)}
+
+    if stat.S_ISREG(st.st_mode):
+        entry['size'] = st.st_size
+        entry['inode'] = st.st_ino
+        keys = ['size', 'mtime', 'ctime', 'inode']
+        if (previous and previous.get('hash') and
+                [previous.get(k) for k in keys] == [entry[k] for k in keys]):
+            entry['hash'] = previous['hash']
+        else:
+            entry['hash'] = file_hash(path)
+    elif stat.S_ISLNK(st.st_mode):
+        entry['link'] = os.readlink(path)
+    elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+        entry['rdev'] = st.st_rdev
+
+    return entry
+
+
+def walk(image_path):
+    """
+    Yields ('./relative/path', path, stat) for the tree under image_path.
+    Like tar --one-file-system, mountpoints are listed, but not their content
+    """
+
+    image_path = os.path.abspath(image_path)
+    st = os.lstat(image_path)
+    root_dev = st.st_dev
+    yield '.', image_path, st
+
+    for dirpath, dirnames, filenames in os.walk(image_path):
+        rel_dir = '.' + dirpath[len(image_path):]
+
+        descend = []
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            yield rel_dir + '/' + name, path, st
+
+            if stat.S_ISDIR(st.st_mode) and st.st_dev == root_dev:
+                descend.append(name)
+
+        dirnames[:] = descend
+
+
+def paths(image_path):
+    """Sorted paths of the tree under image_path, parents go first"""
+
+    return sorted([rel_path for rel_path, _, _ in walk(image_path)])
+
+
+def build(image_path, previous=None):
+    """
+    Returns {'./relative/path': entry} for the tree under image_path.
+    previous - files of the previous manifest to take hashes from
+    """
+
+    previous = previous or {}
+    manifest = {}
+    for rel_path, path, st in walk(image_path):
+        manifest[rel_path] = get_entry(path, st, previous.get(rel_path))
+
+    return manifest
+
+
+def _content(entry):
+    return dict([(k, v) for k, v in entry.items() if k not in _LOCAL_KEYS])
+
+
+def diff(old, new):
+    """
+    Returns (changed, removed) sorted lists of paths.
+    changed - new or changed paths of the new manifest, parents go first
+    removed - paths to remove before changed are applied on top of old
+    """
+
+    changed = sorted([path for path in new
+                      if path not in old or
+                      _content(old[path]) != _content(new[path])])
+
+    removed = []
+    for path in sorted(old):
+        if path in new and (stat.S_IFMT(old[path]['mode']) ==
+                            stat.S_IFMT(new[path]['mode'])):
+            continue
+
+        # content of the removed directory goes with it
+        if removed and path.startswith(removed[-1] + '/'):
+            continue
+
+        removed.append(path)
+
+    return changed, removed
+
+
+def _is_boundary(path):
+    return int(hashlib.sha1(path).hexdigest()[:8], 16) % GROUP_PATHS == 0
+
+
+def groups(manifest):
+    """
+    Returns [(key, paths)] with sorted paths of the manifest split to groups.
+    Key is the same for groups of the same paths having the same content
+    """
+
+    # names of owners are taken from these files by tar
+    accounts = hashlib.sha1()
+    for path in ACCOUNTS:
+        accounts.update(json.dumps([path, manifest.get(path, {}).get('hash')]))
+    accounts = accounts.digest()
+
+    result = []
+    key, paths, size = None, [], 0
+    for path in sorted(manifest):
+        if key is None:
+            key = hashlib.sha1(accounts)
+
+        key.update(json.dumps([path, _content(manifest[path])],
+                              sort_keys=True, encoding=ENCODING))
+        paths.append(path)
+        size += manifest[path].get('size', 0)
+
+        if size >= GROUP_MAX_SIZE or _is_boundary(path):
+            result.append((key.hexdigest(), paths))
+            key, paths, size = None, [], 0
+
+    if paths:
+        result.append((key.hexdigest(), paths))
+
+    return result
+
+
+def save(filename, files, **info):
+    """
+    Store manifest. info - other data to store along with files,
+    like segments of the tarball
+    """
+
+    info['files'] = files
+    info['version'] = VERSION
+
+    f = gzip.open(filename, 'wb')
+    try:
+        json.dump(info, f, encoding=ENCODING)
+    finally:
+        f.close()
+
+
+def load(filename):
+    """
+    Returns dict with 'files' and other data passed to save()
+    or None if file does not exist or was saved by other version
+    """
+
+    if not os.path.isfile(filename):
+        return None
+
+    f = gzip.open(filename, 'rb')
+    try:
+        info = json.load(f)
+    finally:
+        f.close()
+
+    if info.get('version') != VERSION:
+        return None
+
+    files = {}
+    for path, entry in info.pop('files').items():
+        if 'link' in entry:
+            entry['link'] = entry['link'].encode(ENCODING)
+        files[path.encode(ENCODING)] = entry
+
+    info['files'] = files
+
+    return info
@@ -0,0 +1,292 @@
+'''
+Written by Dmitry Chirikov <dmitry@chirikov.ru>
+This file is part of Luna, cluster provisioning tool
+https://github.com/dchirikov/luna
+
+This file is part of Luna.
+
+Luna is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Luna is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Luna.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+# Runtime metrics of the lweb process.
+# Counters, gauges and histograms are plain dicts: every tornado child
+# has its own copy. Both the IOLoop thread and the executor threads
+# update them, so every change is done under the lock. publish() writes
+# a snapshot of the process to MongoDB periodically and collect() merges
+# snapshots of all alive processes, so any child can report metrics of
+# the whole lweb.
+
+import os
+import time
+import bisect
+import socket
+import datetime
+import threading
+
+collection = 'lweb_metrics'
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1.0, 2.5, 5.0, 10.0)
+OPS_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# {(name, labels): value}
+_counters = {}
+_gauges = {}
+# {(name, labels): [buckets, [count per bucket and +Inf], sum]}
+_histograms = {}
+# {(name, labels): (value, timestamp)} of counters at last publish
+_published = {}
+
+# metrics are updated from executor threads too
+_lock = threading.RLock()
+_local = threading.local()
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def value(name, **labels):
+    return _counters.get(_key(name, labels), 0)
+
+
+def thread_ops():
+    """DB operations done by the current thread"""
+
+    return getattr(_local, 'ops', 0)
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, buckets=TIME_BUCKETS, **labels):
+    key = _key(name, labels)
+    with _lock:
+        try:
+            histogram = _histograms[key]
+        except KeyError:
+            histogram = [buckets, [0] * (len(buckets) + 1), 0]
+            _histograms[key] = histogram
+
+        histogram[1][bisect.bisect_left(histogram[0], value)] += 1
+        histogram[2] += value
+
+
+def observe_request(seconds, mongo_ops, **labels):
+    """Account request served by the handler"""
+
+    inc('requests_total', **labels)
+    observe('request_seconds', seconds, **labels)
+    observe('request_mongo_ops', mongo_ops, buckets=OPS_BUCKETS, **labels)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+        _published.clear()
+
+
+def _update_rates(now):
+    """Set '<name>_per_second' gauges for '<name>_total' counters"""
+
+    for key, current in _counters.items():
+        name, labels = key
+        if not name.endswith('_total'):
+            continue
+
+        prev, timestamp = _published.get(key, (0, None))
+        _published[key] = (current, now)
+        if timestamp is None or now <= timestamp:
+            continue
+
+        rate_key = (name[:-len('_total')] + '_per_second', labels)
+        _gauges[rate_key] = float(current - prev) / (now - timestamp)
+
+
+def snapshot():
+    """Metrics of the process in the form suitable for MongoDB"""
+
+    with _lock:
+        return _snapshot()
+
+
+def _snapshot():
+    return {
+        'counters': [[name, [list(l) for l in labels], val]
+                     for (name, labels), val in _counters.items()],
+        'gauges': [[name, [list(l) for l in labels], val]
+                   for (name, labels), val in _gauges.items()],
+        'histograms': [[name, [list(l) for l in labels],
+                        list(h[0]), list(h[1]), h[2]]
+                       for (name, labels), h in _histograms.items()],
+    }
+
+
+def _instance_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def publish(mongo_db):
+    """Write snapshot of the process to MongoDB"""
+
+    with _lock:
+        _update_rates(time.time())
+
+    doc = snapshot()
+    doc['updated'] = datetime.datetime.utcnow()
+    mongo_db[collection].update({'_id': _instance_id()}, {'$set': doc},
+                                upsert=True)
+
+
+def _merge(merged, snap):
+    for name, labels, val in snap['counters']:
+        key = (name, tuple(tuple(l) for l in labels))
+        merged['counters'][key] = merged['counters'].get(key, 0) + val
+
+    for name, labels, val in snap['gauges']:
+        key = (name, tuple(tuple(l) for l in labels))
+        merged['gauges'][key] = merged['gauges'].get(key, 0) + val
+
+    for name, labels, buckets, counts, total in snap['histograms']:
+        key = (name, tuple(tuple(l) for l in labels))
+        if key not in merged['histograms']:
+            merged['histograms'][key] = [list(buckets), list(counts), total]
+            continue
+
+        histogram = merged['histograms'][key]
+        if histogram[0] != list(buckets):
+            continue
+        histogram[1] = [a + b for a, b in zip(histogram[1], counts)]
+        histogram[2] += total
+
+
+def collect(mongo_db=None, max_age=60):
+    """
+    Returns metrics merged across the processes which published them
+    during last max_age seconds. Current process is taken as is
+    """
+
+    merged = {'counters': {}, 'gauges': {}, 'histograms': {}}
+
+    if mongo_db is not None:
+        time_age = (datetime.datetime.utcnow() -
+                    datetime.timedelta(seconds=max_age))
+        instance_id = _instance_id()
+        for doc in mongo_db[collection].find({'updated': {'$gte': time_age}}):
+            if doc['_id'] != instance_id:
+                _merge(merged, doc)
+
+    _merge(merged, snapshot())
+
+    return merged
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join(['{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                           for k, v in labels]) + '}'
+
+
+def render(metrics, prefix='luna_'):
+    """Format merged metrics as Prometheus text exposition"""
+
+    lines = []
+
+    for kind in ['counters', 'gauges']:
+        metric_type = 'counter' if kind == 'counters' else 'gauge'
+        typed = set()
+        for (name, labels), val in sorted(metrics[kind].items()):
+            if name not in typed:
+                lines.append('# TYPE {}{} {}'.format(prefix, name,
+                                                     metric_type))
+                typed.add(name)
+            lines.append('{}{}{} {}'.format(prefix, name,
+                                            _format_labels(labels), val))
+
+    typed = set()
+    for (name, labels), h in sorted(metrics['histograms'].items()):
+        buckets, counts, total = h
+        if name not in typed:
+            lines.append('# TYPE {}{} histogram'.format(prefix, name))
+            typed.add(name)
+
+        cumulative = 0
+        for le, count in zip(list(buckets) + ['+Inf'], counts):
+            cumulative += count
+            lines.append('{}{}_bucket{} {}'.format(
+                prefix, name,
+                _format_labels(list(labels) + [('le', le)]), cumulative))
+
+        lines.append('{}{}_sum{} {}'.format(prefix, name,
+                                            _format_labels(labels), total))
+        lines.append('{}{}_count{} {}'.format(prefix, name,
+                                              _format_labels(labels),
+                                              cumulative))
+
+    return '\n'.join(lines) + '\n'
+
+
+class CountingCollection(object):
+    """Proxy of pymongo Collection counting calls in 'mongo_ops_total'"""
+
+    ops = set(['find', 'find_one', 'find_and_modify', 'insert', 'update',
+               'remove', 'save', 'count', 'distinct', 'aggregate',
+               'bulk_write', 'initialize_unordered_bulk_op'])
+
+    def __init__(self, mongo_collection):
+        self._mongo_collection = mongo_collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._mongo_collection, name)
+        if name not in self.ops:
+            return attr
+
+        def counted(*args, **kwargs):
+            inc('mongo_ops_total')
+            _local.ops = thread_ops() + 1
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+class CountingDatabase(object):
+    """Proxy of pymongo Database returning CountingCollection"""
+
+    def __init__(self, mongo_db):
+        self._mongo_db = mongo_db
+        self._collections = {}
+
+    def __getitem__(self, name):
+        try:
+            return self._collections[name]
+        except KeyError:
+            mongo_collection = CountingCollection(self._mongo_db[name])
+            self._collections[name] = mongo_collection
+            return mongo_collection
+
+    def __getattr__(self, name):
+        return getattr(self._mongo_db, name)
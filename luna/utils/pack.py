@@ -0,0 +1,245 @@
+'''
+Written by Dmitry Chirikov <dmitry@chirikov.ru>
+This file is part of Luna, cluster provisioning tool
+https://github.com/dchirikov/luna
+
+This file is part of Luna.
+
+Luna is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Luna is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Luna.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+# Helpers to pack osimage into a tarball.
+# Output of tar (and compressor) is read by luna through the pipe,
+# written to the final place and hashed for the torrent at the same
+# time, so the image is read from disk only once.
+# hashlib releases GIL while hashing, so complete pieces are hashed
+# by the pool of threads if the compressor is faster than one core.
+
+import os
+import sys
+import tarfile
+import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# compressors are run from the host, not from the osimage.
+# Output should depend on input only, so no names and timestamps in headers
+CODECS = {
+    'pigz': {'ext': '.tgz',
+             'compress': ['/usr/bin/pigz', '-n', '-c'],
+             'tar_flags': '-z'},
+    'zstd': {'ext': '.tar.zst',
+             'compress': ['/usr/bin/zstd', '-T0', '-q', '-c'],
+             'tar_flags': '-I zstd'},
+    'none': {'ext': '.tar',
+             'compress': None,
+             'tar_flags': ''},
+}
+
+DEFAULT_CODEC = 'pigz'
+
+# squashfs image is mounted or unpacked by the node instead of tarball
+FORMATS = ['tar', 'squashfs']
+
+DEFAULT_FORMAT = 'tar'
+
+# mksquashfs options for the codecs
+SQUASHFS_COMP = {
+    'pigz': ['-comp', 'gzip'],
+    'zstd': ['-comp', 'zstd'],
+    'none': ['-noI', '-noD', '-noF', '-noX'],
+}
+
+# files of the image needed on the node before unpacking tarball,
+# to map names of the users and groups in ACLs
+ACCOUNTS = ['./etc/passwd', './etc/group']
+
+# 4MB pieces keep .torrent of 20GB image about 100KB
+PIECE_SIZE = 4 * 1024 * 1024
+
+BUF_SIZE = 1024 * 1024
+
+# SHA-1 is about 500MB/s per core, no need in many threads
+MAX_HASH_WORKERS = 4
+
+
+def hash_workers():
+    try:
+        return min(MAX_HASH_WORKERS, multiprocessing.cpu_count())
+    except NotImplementedError:
+        return 1
+
+
+def _sha1(data):
+    return hashlib.sha1(data).digest()
+
+
+def get_codec(codec):
+    """Returns description of the codec. Tarballs packed before have none"""
+
+    return CODECS[codec or DEFAULT_CODEC]
+
+
+def tarball_name(uid, codec=None, fmt=None):
+    if fmt == 'squashfs':
+        return uid + '.squashfs'
+
+    return uid + get_codec(codec)['ext']
+
+
+def accounts_name(uid):
+    return uid + '.accounts.tar'
+
+
+def write_accounts(root, filename):
+    """
+    Write ACCOUNTS of the image in root to the uncompressed tar filename.
+    Returns False if image has none of them
+    """
+
+    if not all([os.path.isfile(os.path.join(root, path))
+                for path in ACCOUNTS]):
+        return False
+
+    tar = tarfile.open(filename, 'w', format=tarfile.PAX_FORMAT)
+    try:
+        for path in ACCOUNTS:
+            tar.add(os.path.join(root, path), arcname=path)
+    finally:
+        tar.close()
+
+    return True
+
+
+def tarball_hash(hasher):
+    """Identifies content of the tarball by hashes of its pieces"""
+
+    sha1 = hashlib.sha1('{}:{}:'.format(hasher.size, hasher.piece_size))
+    for piece in hasher.pieces:
+        sha1.update(piece)
+
+    return sha1.hexdigest()
+
+
+class PieceHasher(object):
+    """
+    SHA-1 of the torrent pieces of the data passed to update().
+    If workers > 1 pieces are hashed by the pool of threads
+    """
+
+    def __init__(self, piece_size=PIECE_SIZE, workers=1):
+        self.piece_size = piece_size
+        self.size = 0
+        self.pieces = []
+        self._piece = hashlib.sha1()
+        self._chunks = []
+        self._piece_len = 0
+
+        self._pool = None
+        self._pending = []
+        if workers > 1:
+            self._pool = ThreadPool(workers)
+            # limits memory used by the pieces waiting for hashing
+            self._max_pending = workers * 2
+
+    def _piece_done(self):
+        if self._pool is None:
+            self.pieces.append(self._piece.digest())
+            self._piece = hashlib.sha1()
+        else:
+            data = ''.join(self._chunks)
+            self._chunks = []
+            self._pending.append(self._pool.apply_async(_sha1, (data, )))
+            # pieces are taken in order they were submitted
+            while len(self._pending) > self._max_pending:
+                self.pieces.append(self._pending.pop(0).get())
+
+        self._piece_len = 0
+
+    def update(self, data):
+        self.size += len(data)
+
+        while data:
+            chunk = data[:self.piece_size - self._piece_len]
+            data = data[len(chunk):]
+
+            if self._pool is None:
+                self._piece.update(chunk)
+            else:
+                self._chunks.append(chunk)
+            self._piece_len += len(chunk)
+
+            if self._piece_len == self.piece_size:
+                self._piece_done()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+            self._pending = []
+
+    def finish(self):
+        """Returns hashes of all pieces, including the last short one"""
+
+        if self._piece_len:
+            self._piece_done()
+
+        while self._pending:
+            self.pieces.append(self._pending.pop(0).get())
+
+        self.close()
+
+        return self.pieces
+
+
+def hash_file(filename, hasher):
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(BUF_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+
+
+def copy_stream(src, dst, hasher=None, progress=False, size=None):
+    """
+    Copy file object src to dst until EOF or size bytes are copied,
+    passing data to hasher.
+    Returns number of bytes copied
+    """
+
+    copied = 0
+    while size is None or copied < size:
+        chunk = BUF_SIZE
+        if size is not None:
+            chunk = min(chunk, size - copied)
+
+        data = src.read(chunk)
+        if not data:
+            break
+
+        dst.write(data)
+        if hasher is not None:
+            hasher.update(data)
+
+        copied += len(data)
+        if progress:
+            sys.stdout.write('{} MB\r'.format(copied / 1024 / 1024))
+            sys.stdout.flush()
+
+    if progress:
+        sys.stdout.write('\n')
+
+    return copied
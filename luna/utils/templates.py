@@ -0,0 +1,145 @@
+'''
+Written by Dmitry Chirikov <dmitry@chirikov.ru>
+This file is part of Luna, cluster provisioning tool
+https://github.com/dchirikov/luna
+
+This file is part of Luna.
+
+Luna is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Luna is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Luna.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+# Compiled templates shared by the process.
+# tornado.template.Loader compiles every template once and keeps it,
+# so one loader per templates directory is created. Modification times
+# of the template and of every template compiled by the loaders of the
+# directory ({% include %}, {% extends %}) are checked on every load and
+# the loaders are reset if any file was changed, so edited templates are
+# picked up by daemons.
+
+import os
+import time
+import hashlib
+import threading
+
+from tornado import template
+
+from luna.utils import metrics
+
+_DEFAULT = 'xhtml_escape'
+
+_lock = threading.Lock()
+
+# {(path, autoescape): tornado.template.Loader}
+_loaders = {}
+
+# {(path, name): mtime}
+_mtimes = {}
+
+
+def get_loader(path, autoescape=_DEFAULT):
+    """Returns shared loader for templates directory"""
+
+    path = os.path.abspath(path)
+
+    with _lock:
+        try:
+            return _loaders[(path, autoescape)]
+        except KeyError:
+            loader = template.Loader(path, autoescape=autoescape)
+            _loaders[(path, autoescape)] = loader
+            return loader
+
+
+def _mtime(path, name):
+    try:
+        return os.stat(os.path.join(path, name)).st_mtime
+    except OSError:
+        return None
+
+
+def _compiled(path):
+    """Names of templates compiled by the loaders of path. Needs _lock"""
+
+    names = set()
+    for (loader_path, _), loader in _loaders.items():
+        if loader_path == path:
+            with loader.lock:
+                names.update(loader.templates.keys())
+
+    return names
+
+
+def load(path, name, autoescape=_DEFAULT):
+    """Returns compiled template"""
+
+    path = os.path.abspath(path)
+    loader = get_loader(path, autoescape)
+
+    with _lock:
+        changed = False
+        for template_name in _compiled(path) | set([name]):
+            mtime = _mtime(path, template_name)
+            if _mtimes.get((path, template_name)) != mtime:
+                _mtimes[(path, template_name)] = mtime
+                changed = True
+
+        if changed:
+            # compiled templates include each other, so all of them
+            # are dropped for every loader of the path
+            for (loader_path, _), other in _loaders.items():
+                if loader_path == path:
+                    other.reset()
+
+        template = loader.load(name)
+
+        # included and extended templates are compiled along
+        for template_name in _compiled(path):
+            if (path, template_name) not in _mtimes:
+                _mtimes[(path, template_name)] = _mtime(path, template_name)
+
+    return template
+
+
+def version(path, name, autoescape=_DEFAULT):
+    """
+    Returns digest of modification times of the template and of all
+    templates compiled for the directory, included and extended ones
+    among them. Can be used to check if output rendered before is
+    still valid
+    """
+
+    path = os.path.abspath(path)
+    load(path, name, autoescape)
+
+    with _lock:
+        mtimes = sorted([(template_name, mtime)
+                         for (loader_path, template_name), mtime
+                         in _mtimes.items() if loader_path == path])
+
+    return hashlib.sha1(repr(mtimes)).hexdigest()
+
+
+def render(path, template_name, autoescape=_DEFAULT, **kwargs):
+    start = time.time()
+    ret = load(path, template_name, autoescape).generate(**kwargs)
+    metrics.observe('template_render_seconds', time.time() - start,
+                    template=template_name)
+    return ret
+
+
+def reset():
+    with _lock:
+        _loaders.clear()
+        _mtimes.clear()
@@ -0,0 +1,446 @@
+'''
+Written by Dmitry Chirikov <dmitry@chirikov.ru>
+This file is part of Luna, cluster provisioning tool
+https://github.com/dchirikov/luna
+
+This file is part of Luna.
+
+Luna is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Luna is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Luna.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+"""
+Boot storm benchmark for lweb.
+
+Seeds sandboxed DB with networks, groups and nodes, starts lweb handlers
+on a local port and replays the requests every node does during
+installation:
+
+    step=boot, step=discovery, step=install, status updates,
+    announces to the tracker, final status update
+
+Nodes are replayed concurrently. Latency of every step, throughput
+and MongoDB operations per request are reported.
+
+to run:
+
+    $ tox -e benchmark -- --nodes 500 --concurrency 100
+
+    or
+
+    $ python tests/benchmark/bootstorm.py --nodes 500 --concurrency 100
+"""
+
+import os
+import sys
+import json
+import time
+import mock
+import socket
+import urllib
+import getpass
+import logging
+import argparse
+import functools
+
+import tornado.gen
+import tornado.web
+import tornado.ioloop
+import tornado.netutil
+import tornado.httpserver
+import tornado.httpclient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'unittests'))
+
+import luna
+from luna import utils
+from helper_utils import Sandbox
+
+log = logging.getLogger('bootstorm')
+
+STEPS = ['boot', 'discovery', 'install', 'status', 'announce']
+
+# statuses node reports before and after downloading the image
+STATUSES_BEFORE = ['install.prescript', 'install.partscript',
+                   'install.download']
+STATUSES_AFTER = ['install.postscript', 'install.success']
+
+
+def percentile(values, perc):
+    """Nearest-rank percentile of sorted values"""
+
+    if not values:
+        return 0.0
+
+    rank = int(round(perc / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class BootStorm(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.sandbox = None
+        self.nodes = []
+        self.latency = dict([(step, []) for step in STEPS])
+        self.errors = dict([(step, 0) for step in STEPS])
+        self.info_hash = os.urandom(20)
+        self.image_size = 1024 ** 3
+
+    @mock.patch('rpm.TransactionSet')
+    @mock.patch('rpm.addMacro')
+    def seed(self, mock_rpm_addmacro, mock_rpm_transactionset):
+        """Create objects in sandboxed DB"""
+
+        packages = [
+            {'VERSION': '3.10', 'RELEASE': '999-el0', 'ARCH': 'x86_64'},
+        ]
+        mock_rpm_addmacro.return_value = True
+        mock_rpm_transactionset.return_value.dbMatch.return_value = packages
+
+        self.sandbox = Sandbox(dbtype=self.args.dbtype)
+        db = self.sandbox.db
+        path = self.sandbox.path
+
+        cluster = luna.Cluster(mongo_db=db, create=True, path=path,
+                               user=getpass.getuser())
+        cluster.set('path', path)
+        cluster.set('frontend_address', '127.0.0.1')
+
+        osimage = luna.OsImage(name='compute', path=path, mongo_db=db,
+                               create=True)
+        osimage.set('kernfile', 'compute-vmlinuz-3.10-999-el0.x86_64')
+        osimage.set('initrdfile', 'compute-initramfs-3.10-999-el0.x86_64')
+        osimage.set('torrent', 'bootstorm')
+        osimage.set('info_hash', self.info_hash.encode('hex'))
+
+        groups = []
+        for i in range(self.args.groups):
+            net = luna.Network(name='net{:02d}'.format(i), mongo_db=db,
+                               create=True,
+                               NETWORK='10.{}.0.0'.format(100 + i),
+                               PREFIX=16)
+
+            group = luna.Group(name='group{:02d}'.format(i),
+                               osimage=osimage.name, mongo_db=db,
+                               interfaces=['BOOTIF'], create=True)
+            group.set_net_to_if('BOOTIF', net.name)
+            groups.append(group)
+
+        for i in range(self.args.nodes):
+            group = groups[i % len(groups)]
+            node = luna.Node(group=group.name, mongo_db=db, create=True)
+
+            mac = '02:00:00:{:02x}:{:02x}:{:02x}'.format(
+                (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+            if self.sandbox.dbtype == 'mongo':
+                node.set_mac(mac)
+            else:
+                # mim is unable to compare DBRefs in set_mac's queries
+                db['mac'].insert({'mac': mac, 'node': node.DBRef})
+
+            self.nodes.append({
+                'name': node.name,
+                'mac': mac,
+                'ip': '10.255.{}.{}'.format(i // 250, i % 250 + 1),
+                'peer_id': '%20s' % node.name,
+            })
+
+        log.info("Seeded {} nodes in {} groups".format(len(self.nodes),
+                                                       len(groups)))
+
+    def start_lweb(self):
+        """Start lweb handlers on the unused local port"""
+
+        counting_db = utils.metrics.CountingDatabase(self.sandbox.db)
+
+        db_threads = self.args.db_threads
+        if self.sandbox.dbtype != 'mongo':
+            # mim is not thread-safe
+            db_threads = 0
+        self.executor = utils.executor.Executor(workers=db_threads)
+
+        announce_interval = luna.AnnounceInterval(30, 20, max_interval=120,
+                                                  swarm_size=100, jitter=10)
+        self.peer_store = luna.PeerStore(
+            counting_db, announce_interval=announce_interval,
+            policy=self.args.policy)
+
+        tracker_params = {
+            'luna_tracker_interval': 30,
+            'luna_tracker_min_interval': 20,
+            'luna_tracker_maxpeers': 200,
+            'announce_interval': announce_interval,
+            'mongo_db': counting_db,
+            'peer_store': self.peer_store,
+        }
+
+        manager_params = {
+            'protocol': 'http',
+            'server_ip': '127.0.0.1',
+            'server_port': 7050,
+            'app_logger': log,
+            'mongo_db': counting_db,
+            'executor': self.executor,
+        }
+
+        app = tornado.web.Application([
+            (r"/announce.*",
+                luna.AnnounceHandler, dict(params=tracker_params)),
+            (r"/luna.*",
+                luna.Manager, dict(params=manager_params)),
+        ], template_path=self.sandbox.path + '/templates')
+
+        sockets = tornado.netutil.bind_sockets(0, address='127.0.0.1',
+                                               family=socket.AF_INET)
+        self.port = sockets[0].getsockname()[1]
+
+        self.http_server = tornado.httpserver.HTTPServer(app)
+        self.http_server.add_sockets(sockets)
+
+        self.sync = tornado.ioloop.PeriodicCallback(
+            functools.partial(self.peer_store.sync, self.executor),
+            self.args.sync_interval)
+        self.sync.start()
+
+    def url(self, path, **query):
+        return 'http://127.0.0.1:{}/{}?{}'.format(self.port, path,
+                                                  urllib.urlencode(query))
+
+    @tornado.gen.engine
+    def request(self, step, url, callback):
+        start = time.time()
+        response = yield tornado.gen.Task(self.client.fetch, url)
+        self.latency[step].append(time.time() - start)
+
+        if response.code not in [200, 304]:
+            self.errors[step] += 1
+            log.debug("{} returned {}".format(url, response.code))
+
+        callback(response)
+
+    @tornado.gen.engine
+    def replay_node(self, node, callback):
+        """Requests of the node from PXE boot to installed OS"""
+
+        yield tornado.gen.Task(self.request, 'boot',
+                               self.url('luna', step='boot'))
+
+        yield tornado.gen.Task(
+            self.request, 'discovery',
+            self.url('luna', step='discovery', type='ipxe',
+                     hwdata='|' + node['mac'] + '|'))
+
+        yield tornado.gen.Task(
+            self.request, 'install',
+            self.url('luna', step='install', node=node['name']))
+
+        for status in STATUSES_BEFORE:
+            yield tornado.gen.Task(
+                self.request, 'status',
+                self.url('luna', step='install', node=node['name'],
+                         status=status))
+
+        announces = max(self.args.announces, 2)
+        for i in range(announces):
+            if i == 0:
+                event = 'started'
+            elif i == announces - 1:
+                event = 'completed'
+            else:
+                event = ''
+
+            done = self.image_size * i / (announces - 1)
+            yield tornado.gen.Task(
+                self.request, 'announce',
+                self.url('announce', info_hash=self.info_hash,
+                         peer_id=node['peer_id'], ip=node['ip'], port=6881,
+                         uploaded=0, downloaded=done,
+                         left=self.image_size - done, event=event,
+                         compact=1, numwant=50))
+
+            if self.args.announce_delay and i < announces - 1:
+                yield tornado.gen.Task(
+                    self.io_loop.add_timeout,
+                    time.time() + self.args.announce_delay / 1000.0)
+
+        for status in STATUSES_AFTER:
+            yield tornado.gen.Task(
+                self.request, 'status',
+                self.url('luna', step='install', node=node['name'],
+                         status=status))
+
+        callback(None)
+
+    @tornado.gen.engine
+    def worker(self, queue, callback):
+        while queue:
+            node = queue.pop()
+            yield tornado.gen.Task(self.replay_node, node)
+
+        callback(None)
+
+    @tornado.gen.engine
+    def replay(self, callback):
+        queue = list(reversed(self.nodes))
+
+        yield [tornado.gen.Task(self.worker, queue)
+               for _ in range(min(self.args.concurrency, len(self.nodes)))]
+
+        callback(None)
+
+    def run(self):
+        self.seed()
+
+        # ops done during seeding are not interesting
+        utils.metrics.reset()
+
+        self.io_loop = tornado.ioloop.IOLoop.instance()
+        self.client = tornado.httpclient.AsyncHTTPClient(
+            self.io_loop, max_clients=self.args.concurrency)
+        self.start_lweb()
+
+        start = time.time()
+        self.replay(lambda _: self.io_loop.stop())
+        self.io_loop.start()
+        self.elapsed = time.time() - start
+
+        self.sync.stop()
+        self.peer_store.sync()
+        self.executor.shutdown()
+        self.http_server.stop()
+
+        return self.report()
+
+    def report(self):
+        """Returns results as dict"""
+
+        histograms = utils.metrics.collect()['histograms']
+
+        def mongo_ops(step):
+            if step == 'announce':
+                labels = (('handler', 'announce'), )
+            else:
+                labels = (('handler', 'manager'), ('step', step))
+
+            histogram = histograms.get(('request_mongo_ops', labels))
+            if not histogram or not sum(histogram[1]):
+                return 0.0
+
+            return float(histogram[2]) / sum(histogram[1])
+
+        results = {'nodes': len(self.nodes),
+                   'concurrency': self.args.concurrency,
+                   'seconds': self.elapsed,
+                   'steps': {}}
+
+        requests = 0
+        for step in STEPS:
+            latency = sorted(self.latency[step])
+            requests += len(latency)
+            results['steps'][step] = {
+                'requests': len(latency),
+                'errors': self.errors[step],
+                'p50': percentile(latency, 50),
+                'p99': percentile(latency, 99),
+                'max': latency[-1] if latency else 0.0,
+                'mongo_ops': mongo_ops(step),
+            }
+
+        results['requests'] = requests
+        results['requests_per_second'] = requests / self.elapsed
+        results['mongo_ops'] = utils.metrics.value('mongo_ops_total')
+
+        return results
+
+    def cleanup(self):
+        if self.sandbox:
+            self.sandbox.cleanup()
+
+
+def print_report(results):
+    print("Nodes: {nodes}, concurrency: {concurrency}, "
+          "requests: {requests}, time: {seconds:.2f} s, "
+          "throughput: {requests_per_second:.1f} req/s, "
+          "mongo ops: {mongo_ops}".format(**results))
+    print('')
+    print("{:<10} {:>8} {:>7} {:>10} {:>10} {:>10} {:>10}".format(
+        'step', 'requests', 'errors', 'p50, ms', 'p99, ms', 'max, ms',
+        'mongo ops'))
+
+    for step in STEPS:
+        res = results['steps'][step]
+        print("{:<10} {:>8} {:>7} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}"
+              .format(step, res['requests'], res['errors'],
+                      res['p50'] * 1000, res['p99'] * 1000,
+                      res['max'] * 1000, res['mongo_ops']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Boot storm benchmark for lweb')
+
+    parser.add_argument('--nodes', '-n', type=int, default=100,
+                        help='Number of nodes booting simultaneously')
+    parser.add_argument('--groups', '-g', type=int, default=2,
+                        help='Number of groups (and networks)')
+    parser.add_argument('--concurrency', '-c', type=int, default=50,
+                        help='Nodes doing requests at the same time')
+    parser.add_argument('--announces', '-a', type=int, default=5,
+                        help='Announces of every node. 2 minimum')
+    parser.add_argument('--announce-delay', type=int, default=0,
+                        dest='announce_delay',
+                        help='Milliseconds between announces of the node')
+    parser.add_argument('--db-threads', '-t', type=int, default=8,
+                        dest='db_threads',
+                        help='Threads to query DB (lweb_db_threads). '
+                             'Ignored for ming')
+    parser.add_argument('--sync-interval', type=int, default=1000,
+                        dest='sync_interval',
+                        help='Milliseconds between tracker syncs')
+    parser.add_argument('--policy', choices=['random', 'topology'],
+                        default='topology', help='Tracker policy')
+    parser.add_argument('--dbtype', '-d', default='auto',
+                        choices=['auto', 'mongo', 'ming'],
+                        help='Backend DB')
+    parser.add_argument('--json', action='store_true',
+                        help='Print results in JSON')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Show luna log')
+
+    args = parser.parse_args()
+
+    # tornado logs every request to the root logger
+    logging.basicConfig()
+    logging.getLogger().setLevel(
+        logging.DEBUG if args.verbose else logging.CRITICAL)
+
+    bench = BootStorm(args)
+    try:
+        results = bench.run()
+    finally:
+        bench.cleanup()
+
+    if args.json:
+        print(json.dumps(results, indent=4, sort_keys=True))
+    else:
+        print_report(results)
+
+    errors = sum([res['errors'] for res in results['steps'].values()])
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+import mock
+import unittest
+
+import luna
+import getpass
+from helper_utils import Sandbox
+
+
+class BaseLinkTests(unittest.TestCase):
+
+    def setUp(self):
+
+        print
+
+        self.sandbox = Sandbox()
+        self.db = self.sandbox.db
+        self.path = self.sandbox.path
+
+        self.cluster = luna.Cluster(mongo_db=self.db, create=True,
+                                    path=self.path, user=getpass.getuser())
+
+        self.net1 = luna.Network(name='net1', mongo_db=self.db, create=True,
+                                 NETWORK='172.16.1.0', PREFIX=24)
+
+        self.net2 = luna.Network(name='net2', mongo_db=self.db, create=True,
+                                 NETWORK='172.16.2.0', PREFIX=24)
+
+        self.net3 = luna.Network(name='net3', mongo_db=self.db, create=True,
+                                 NETWORK='172.16.3.0', PREFIX=24)
+
+    def tearDown(self):
+        self.sandbox.cleanup()
+
+    def get_doc(self, net):
+        return self.db['network'].find_one({'_id': net._id})
+
+    def test_link(self):
+        self.assertTrue(self.net1.link(self.net2))
+        self.assertTrue(self.net1.link(self.net2))
+
+        self.assertEqual(
+            self.get_doc(self.net1)['_use_']['network'],
+            {str(self.net2._id): 2}
+        )
+        self.assertEqual(
+            self.get_doc(self.net2)['_usedby_']['network'],
+            {str(self.net1._id): 2}
+        )
+
+    def test_link_first_concurrent(self):
+        mongo_collection = self.db['network']
+        net2, net3 = self.net2, self.net3
+        raced = []
+
+        class RacingCollection(object):
+            """Another writer adds the first link after our $inc"""
+
+            def update(self, query, update, **kwargs):
+                ret = mongo_collection.update(query, update, **kwargs)
+                if '$inc' in update and not raced:
+                    raced.append(ret['n'])
+                    net3.link(net2)
+                return ret
+
+            def find_one(self, *args, **kwargs):
+                return mongo_collection.find_one(*args, **kwargs)
+
+        self.assertEqual(
+            self.net1._add_links(RacingCollection(), [self.net2._id],
+                                 '_usedby_', self.net1.DBRef),
+            1
+        )
+
+        self.assertEqual(raced, [0])
+        self.assertEqual(
+            self.get_doc(self.net2)['_usedby_']['network'],
+            {str(self.net1._id): 1, str(self.net3._id): 1}
+        )
+
+    def test_link_itself(self):
+        self.assertIsNone(self.net1.link(self.net1))
+
+    def test_unlink(self):
+        self.net1.link(self.net2)
+        self.net1.link(self.net2)
+        self.net1.link(self.net3)
+
+        self.assertTrue(self.net1.unlink(self.net2))
+        self.assertEqual(
+            self.get_doc(self.net1)['_use_']['network'],
+            {str(self.net2._id): 1, str(self.net3._id): 1}
+        )
+
+        self.assertTrue(self.net1.unlink(self.net2))
+        self.assertEqual(
+            self.get_doc(self.net1)['_use_']['network'],
+            {str(self.net3._id): 1}
+        )
+        self.assertNotIn('network', self.get_doc(self.net2)['_usedby_'])
+
+        self.assertTrue(self.net1.unlink(self.net3))
+        self.assertNotIn('network', self.get_doc(self.net1)['_use_'])
+
+    def test_unlink_not_linked(self):
+        self.assertIsNone(self.net1.unlink(self.net2))
+
+    def test_link_many(self):
+        self.assertTrue(
+            self.net1.link_many([self.net2, self.net3, self.net3])
+        )
+
+        self.assertEqual(
+            self.get_doc(self.net1)['_use_']['network'],
+            {str(self.net2._id): 1, str(self.net3._id): 2}
+        )
+        self.assertEqual(
+            self.get_doc(self.net3)['_usedby_']['network'],
+            {str(self.net1._id): 2}
+        )
+
+        self.assertTrue(self.net1.link_many([self.net2]))
+        self.assertEqual(
+            self.get_doc(self.net2)['_usedby_']['network'],
+            {str(self.net1._id): 2}
+        )
+
+    def test_unlink_many(self):
+        self.net1.link_many([self.net2, self.net3, self.net3])
+
+        self.assertTrue(self.net1.unlink_many([self.net2, self.net3]))
+        self.assertEqual(
+            self.get_doc(self.net1)['_use_']['network'],
+            {str(self.net3._id): 1}
+        )
+        self.assertNotIn('network', self.get_doc(self.net2)['_usedby_'])
+
+        self.assertTrue(self.net1.unlink_many([self.net3]))
+        self.assertNotIn('network', self.get_doc(self.net1)['_use_'])
+        self.assertNotIn('network', self.get_doc(self.net3)['_usedby_'])
+
+    def test_unlink_many_not_linked(self):
+        self.net1.link(self.net2)
+
+        self.assertIsNone(self.net1.unlink_many([self.net2, self.net3]))
+        self.assertEqual(
+            self.get_doc(self.net1)['_use_']['network'],
+            {str(self.net2._id): 1}
+        )
+        self.assertEqual(
+            self.get_doc(self.net2)['_usedby_']['network'],
+            {str(self.net1._id): 1}
+        )
+
+    def test_get_links_resolve(self):
+        self.net1.link_many([self.net2, self.net3])
+
+        find = self.db['network'].find
+        with mock.patch.object(self.db['network'], 'find',
+                               wraps=find) as mock_find:
+            links = self.net1.get_links(resolve=True)
+
+        queries = [call[0][0] for call in mock_find.call_args_list
+                   if '$in' in str(call[0][0])]
+        self.assertEqual(len(queries), 1)
+
+        self.assertEqual(
+            sorted([link['name'] for link in links
+                    if link['collection'] == 'network']),
+            ['net2', 'net3']
+        )
+
+    def test_get_back_links_resolve(self):
+        self.net2.link(self.net1)
+        self.net3.link(self.net1)
+
+        back_links = self.net1.get_back_links(resolve=True)
+
+        self.assertEqual(
+            sorted([link['name'] for link in back_links
+                    if link['collection'] == 'network']),
+            ['net2', 'net3']
+        )
+
+    def test_get_links_unresolved(self):
+        self.net1.link(self.net2)
+
+        links = [link for link in self.net1.get_links()
+                 if link['collection'] == 'network']
+
+        self.assertEqual(links[0]['name'], str(self.net2._id))
+        self.assertEqual(links[0]['DBRef'], self.net2.DBRef)
+
+
+if __name__ == '__main__':
+    unittest.main()
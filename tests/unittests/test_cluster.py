@@ -20,11 +20,19 @@ expected = {'name': 'general',
             'tracker_interval': 10,
             'tracker_min_interval': 5,
             'tracker_maxpeers': 200,
+            'tracker_policy': 'topology',
+            'tracker_udp_port': 7050,
+            'tracker_sync_interval': 1000,
+            'tracker_max_interval': 120,
+            'tracker_swarm_size': 100,
+            'tracker_jitter': 10,
             'torrent_listen_port_min': 7052,
             'torrent_listen_port_max': 7200,
             'torrent_pidfile': '/run/luna/ltorrent.pid',
             'lweb_pidfile': '/run/luna/lweb.pid',
             'lweb_num_proc': 0,
+            'lweb_db_threads': 8,
+            'cache_ttl': 5,
             'named_include_file': '/etc/named.luna.zones',
             'named_zone_dir': '/var/named',
             'dhcp_net': None,
@@ -734,6 +734,52 @@ class GroupConfigTests(unittest.TestCase):
             [{'start': '3', 'end': '18446744073709551613'}]
         )
 
+    def test_list_nodes(self):
+        if self.sandbox.dbtype != 'mongo':
+            raise unittest.SkipTest(
+                'This test can be run only with MongoDB as a backend.'
+            )
+        self.group.set_net_to_if('eth0', self.net1.name)
+        self.group.set_net_to_if('eth0', self.net6.name)
+
+        node1 = luna.Node(group=self.group.name, mongo_db=self.db,
+                          create=True)
+        node2 = luna.Node(group=self.group.name, mongo_db=self.db,
+                          create=True)
+        node1.set_mac('00:11:22:33:44:55')
+
+        nodes = self.group.list_nodes()
+
+        self.assertEqual(
+            nodes,
+            {
+                node1.name: {
+                    'mac': '00:11:22:33:44:55',
+                    'interfaces': {'eth0': {4: '10.11.0.1', 6: 'fe80::1'}},
+                },
+                node2.name: {
+                    'mac': None,
+                    'interfaces': {'eth0': {4: '10.11.0.2', 6: 'fe80::2'}},
+                },
+            }
+        )
+
+    def test_list_nodes_no_net(self):
+        if self.sandbox.dbtype != 'mongo':
+            raise unittest.SkipTest(
+                'This test can be run only with MongoDB as a backend.'
+            )
+        node = luna.Node(group=self.group.name, mongo_db=self.db,
+                         create=True)
+
+        nodes = self.group.list_nodes()
+
+        self.assertEqual(
+            nodes,
+            {node.name: {'mac': None,
+                         'interfaces': {'eth0': {4: False, 6: False}}}}
+        )
+
 
 class GroupBootInstallParamsTests(unittest.TestCase):
 
@@ -825,10 +871,13 @@ class GroupBootInstallParamsTests(unittest.TestCase):
                 mock.patch('os.chdir'), \
                 mock.patch('shutil.move'), \
                 mock.patch('libtorrent.add_files'), \
-                mock.patch('libtorrent.set_piece_hashes'):
+                mock.patch('libtorrent.set_piece_hashes'), \
+                mock.patch('luna.utils.manifest.paths'), \
+                mock.patch('luna.utils.pack.write_accounts') as mock_accounts:
 
-            (mock_subprocess_popen.return_value
-                .stderr.readline.return_value) = ''
+            mock_subprocess_popen.return_value.stdout.read.return_value = ''
+            mock_subprocess_popen.return_value.returncode = 0
+            mock_accounts.return_value = False
 
             self.osimage.copy_boot()
             self.osimage.create_tarball()
@@ -841,6 +890,12 @@ class GroupBootInstallParamsTests(unittest.TestCase):
             'torrent_if': '',
             'partscript': group_json['partscript'],
             'tarball': osimage_json['tarball'] + '.tgz',
+            'tar_flags': '-z',
+            'image_format': 'tar',
+            'accounts': '',
+            'stream': False,
+            'tarball_id': osimage_json['tarball'],
+            'delta': {},
             'bmcsetup': {},
             'interfaces': {
                 'BOOTIF': {
@@ -928,6 +983,22 @@ class GroupBootInstallParamsTests(unittest.TestCase):
 
         self.assertEqual(self.group.install_params, self.install_expected_dict)
 
+    def test_install_params_stream(self):
+        self.maxDiff = None
+
+        self.osimage.set('stream', True)
+        self.assertFalse(self.group.install_params['stream'])
+
+        self.osimage.set('tarball_accounts', True)
+        self.install_expected_dict['accounts'] = (
+            self.osimage.get('tarball') + '.accounts.tar')
+        self.install_expected_dict['stream'] = True
+
+        self.assertEqual(self.group.install_params, self.install_expected_dict)
+
+        self.osimage.set('tarball_format', 'squashfs')
+        self.assertFalse(self.group.install_params['stream'])
+
     def test_install_params_w_wrong_torrent_if(self):
 
         self.group.set('torrent_if', 'eth0')
@@ -0,0 +1,100 @@
+import mock
+import logging
+import unittest
+import tornado.web
+import tornado.testing
+
+import luna
+import getpass
+from luna import utils
+from helper_utils import Sandbox
+
+
+class ManagerTests(tornado.testing.AsyncHTTPTestCase):
+
+    # steps are run in place
+    workers = 0
+
+    def setUp(self):
+
+        print
+
+        self.sandbox = Sandbox()
+        self.db = self.sandbox.db
+        self.path = self.sandbox.path
+
+        self.cluster = luna.Cluster(mongo_db=self.db, create=True,
+                                    path=self.path, user=getpass.getuser())
+
+        super(ManagerTests, self).setUp()
+
+    def tearDown(self):
+        super(ManagerTests, self).tearDown()
+        self.executor.shutdown()
+        self.sandbox.cleanup()
+
+    def get_app(self):
+        self.executor = utils.executor.Executor(workers=self.workers,
+                                                io_loop=self.io_loop)
+        params = {
+            'protocol': 'http',
+            'server_ip': '127.0.0.1',
+            'server_port': 7050,
+            'app_logger': logging.getLogger(__name__),
+            'mongo_db': self.db,
+            'executor': self.executor,
+        }
+
+        return tornado.web.Application([
+            (r"/luna.*", luna.Manager, dict(params=params)),
+        ], template_path=self.path + '/templates')
+
+    def test_boot(self):
+        response = self.fetch('/luna?step=boot')
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body.split()[0], '#!ipxe')
+
+    def test_wrong_step(self):
+        with mock.patch.object(luna.Manager,
+                               '_handle_request_exception') as mock_handle:
+            response = self.fetch('/luna?step=wrong')
+
+        self.assertEqual(response.code, 400)
+        self.assertFalse(mock_handle.called)
+
+    def test_step_failed(self):
+        with mock.patch.object(luna.Manager, 'step_boot',
+                               side_effect=RuntimeError('DB is down')):
+            response = self.fetch('/luna?step=boot')
+
+        self.assertEqual(response.code, 500)
+
+    def test_step_error(self):
+        response = self.fetch('/luna?step=install&node=unknown')
+
+        self.assertEqual(response.code, 400)
+
+    def test_install_script(self):
+        script = (None, None, ('"etag"', '#!/bin/bash'))
+        with mock.patch.object(luna.Manager, 'step_install',
+                               return_value=script):
+            response = self.fetch('/luna?step=install&node=node001')
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.body, '#!/bin/bash')
+            self.assertEqual(response.headers['Etag'], '"etag"')
+
+            response = self.fetch('/luna?step=install&node=node001',
+                                  headers={'If-None-Match': '"etag"'})
+            self.assertEqual(response.code, 304)
+
+
+class ManagerThreadsTests(ManagerTests):
+
+    # steps are run in executor's thread, results are passed
+    # to the handler in IOLoop thread
+    workers = 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,8 @@ import luna
 import copy
 import mock
 import getpass
+import hashlib
+import binascii
 import datetime
 
 from helper_utils import Sandbox
@@ -605,6 +607,25 @@ class NodeChangeTests(unittest.TestCase):
             'install.download (66.67% / last update '
         )
 
+    def test_get_status_peer_store(self):
+        name = "%20s" % self.node.name
+        peer_id = binascii.hexlify(name)
+        self.assertTrue(self.node.update_status('install.download'))
+
+        store = luna.PeerStore(self.db)
+        for downloaded in [1, 2]:
+            store.update(binascii.hexlify('h' * 20), peer_id, '10.0.0.1',
+                         6881, '', 0, downloaded, 3 - downloaded)
+        store.get_peer(binascii.hexlify('h' * 20),
+                       '10.0.0.1', 6881)['updated'] += \
+            datetime.timedelta(seconds=1)
+        store.flush()
+
+        self.assertEqual(
+            self.node.get_status()['status'][:39],
+            'install.download (66.67% / last update '
+        )
+
 
 class NodeBootInstallTests(unittest.TestCase):
 
@@ -701,6 +722,12 @@ class NodeBootInstallTests(unittest.TestCase):
             'partscript': 'mount -t tmpfs tmpfs /sysroot',
             'name': 'node001',
             'tarball': '',
+            'tar_flags': '-z',
+            'image_format': 'tar',
+            'accounts': '',
+            'stream': False,
+            'tarball_id': '',
+            'delta': {},
             'bmcsetup': {},
             'interfaces': {
                 'BOOTIF': {
@@ -882,6 +909,91 @@ class NodeBootInstallTests(unittest.TestCase):
             self.install_expected_dict,
         )
 
+    def test_get_params_stored(self):
+        self.assertEqual(
+            self.node.get_params('boot'),
+            self.boot_expected_dict,
+        )
+
+        doc = self.db['node_params'].find_one({'_id': self.node._id})
+        self.assertIn(self.group._id, doc['deps'])
+        self.assertIn(self.osimage._id, doc['deps'])
+
+        with mock.patch.object(luna.Node, 'boot_params',
+                               new_callable=mock.PropertyMock) as boot_params:
+            params = self.node.get_params('boot')
+            self.assertFalse(boot_params.called)
+
+        self.assertEqual(params, self.boot_expected_dict)
+
+    def test_get_params_wrong_step(self):
+        self.assertIsNone(self.node.get_params('wrong'))
+
+    def test_get_params_invalidated(self):
+        self.install_expected_dict['interfaces'].pop('BOOTIF')
+        self.node.get_params('install')
+
+        self.group.set_net_to_if('eth0', self.net1.name)
+        self.assertIsNone(
+            self.db['node_params'].find_one({'_id': self.node._id}))
+
+        self.node = luna.Node(
+            name=self.node.name,
+            mongo_db=self.db,
+        )
+
+        self.install_expected_dict['interfaces']['eth0']['4'] = {
+            'ip': '10.50.0.1',
+            'netmask': '255.255.0.0',
+            'prefix': '16',
+        }
+
+        self.assertEqual(
+            self.node.get_params('install'),
+            self.install_expected_dict,
+        )
+
+        self.net1.rename('testnet1_new')
+        self.assertIsNone(
+            self.db['node_params'].find_one({'_id': self.node._id}))
+
+    def test_get_params_changed_while_computed(self):
+        get_params_deps = luna.Node._get_params_deps
+        group = self.group
+
+        def change_group(node):
+            group.set('prescript', 'echo changed')
+            return get_params_deps(node)
+
+        with mock.patch.object(luna.Node, '_get_params_deps', autospec=True,
+                               side_effect=change_group):
+            self.node.get_params('install')
+
+        # stale params should not survive the invalidation
+        self.assertIsNone(
+            self.db['node_params'].find_one({'_id': self.node._id}))
+
+        self.assertEqual(self.node.get_params('install')['prescript'],
+                         'echo changed')
+
+    def test_get_params_not_cached(self):
+        self.node.get_params('install')
+
+        # group is changed by other process
+        self.db['group'].update({'_id': self.group._id},
+                                {'$set': {'prescript': 'echo other'}})
+        luna.utils.helpers.invalidate_params(self.db, [self.group._id])
+
+        self.assertEqual(self.node.get_params('install')['prescript'],
+                         'echo other')
+
+    def test_get_params_status_update(self):
+        self.node.get_params('boot')
+        self.node.update_status('install.request')
+
+        self.assertIsNotNone(
+            self.db['node_params'].find_one({'_id': self.node._id}))
+
     def test_install_scripts(self):
         self.assertIsNone(self.node.render_script('non_exist'))
         self.assertEqual(self.node.render_script('boot').split()[0], '#!ipxe')
@@ -890,5 +1002,66 @@ class NodeBootInstallTests(unittest.TestCase):
             '#!/bin/bash'
         )
 
+    def test_get_script_stored(self):
+        etag, script = self.node.get_script('boot')
+
+        self.assertEqual(script.split()[0], '#!ipxe')
+        self.assertEqual(etag, '"{}"'.format(hashlib.sha1(script).hexdigest()))
+
+        with mock.patch('luna.utils.templates.render') as mock_render:
+            self.assertEqual(self.node.get_script('boot'), (etag, script))
+            self.assertFalse(mock_render.called)
+
+        self.assertIsNone(self.node.get_script('non_exist'))
+
+    def test_get_script_invalidated(self):
+        self.assertIsNone(self.node.get_script('install'))
+
+        self.osimage.set('torrent', 'c6b5c7a1-52dc-4cf4-8fc5-ab1b2c3d4e5f')
+        etag, script = self.node.get_script('install')
+        self.assertEqual(script.split()[0], '#!/bin/bash')
+
+        self.group.set('prescript', 'echo prescript_marker')
+        self.node = luna.Node(name=self.node.name, mongo_db=self.db)
+        new_etag, script = self.node.get_script('install')
+
+        self.assertNotEqual(etag, new_etag)
+        self.assertIn('prescript_marker', script)
+
+    def test_get_script_changed_while_rendered(self):
+        self.osimage.set('torrent', 'c6b5c7a1-52dc-4cf4-8fc5-ab1b2c3d4e5f')
+        render = luna.utils.templates.render
+        node = self.node
+        group = self.group
+
+        def change_group(*args, **kwargs):
+            # other request recomputes params while script is rendered
+            group.set('prescript', 'echo prescript_marker')
+            luna.Node(name=node.name, mongo_db=node._mongo_db) \
+                .get_params('install')
+            return render(*args, **kwargs)
+
+        with mock.patch('luna.utils.templates.render',
+                        side_effect=change_group):
+            _, script = self.node.get_script('install')
+        self.assertNotIn('prescript_marker', script)
+
+        # fresh params are kept, stale script is not
+        doc = self.db['node_params'].find_one({'_id': self.node._id})
+        self.assertIn('install', doc)
+        self.assertNotIn('install_script', doc)
+
+        _, script = self.node.get_script('install')
+        self.assertIn('prescript_marker', script)
+
+    def test_get_script_server(self):
+        _, script = self.node.get_script('boot')
+        self.assertIn('127.0.0.1', script)
+
+        _, script = self.node.get_script(
+            'boot', server={'protocol': 'https', 'server_ip': '10.50.0.254',
+                            'server_port': 7050})
+        self.assertIn('https://10.50.0.254:7050', script)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,8 @@
 import unittest
+import os
+import time
 import mock
+import hashlib
 
 import luna
 import getpass
@@ -209,10 +212,268 @@ class OsimageMethodsTests(unittest.TestCase):
                                  mock_shutil_copy,
                                  ):
 
-        mock_subprocess_popen.return_value.stderr.readline.return_value = ''
+        mock_subprocess_popen.return_value.stdout.read.side_effect = [
+            'tarball', '']
+        mock_subprocess_popen.return_value.returncode = 0
 
         self.assertTrue(self.osimage.create_tarball())
 
+        tarball = self.osimage.get('tarball')
+        self.assertEqual(self.osimage.get('tarball_codec'), 'pigz')
+
+        with open(self.path + '/torrents/' + tarball + '.tgz') as f:
+            self.assertEqual(f.read(), 'tarball')
+
+        self.assertEqual(self.osimage._pieces[tarball]['hashes'],
+                         [hashlib.sha1('tarball').digest()])
+
+    @mock.patch('os.fchdir')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('os.chroot')
+    def test_pack_unchanged(self,
+                            mock_os_chroot,
+                            mock_subprocess_popen,
+                            mock_os_fchdir,
+                            ):
+
+        mock_subprocess_popen.return_value.stdout.read.side_effect = [
+            'tarball', '', 'tarball', '']
+        mock_subprocess_popen.return_value.returncode = 0
+
+        image = self.path + '/image'
+        os.makedirs(image + '/etc')
+        self.osimage.set('path', image)
+
+        self.assertTrue(self.osimage.create_tarball())
+        tarball = self.osimage.get('tarball')
+
+        # members are passed to tar sorted
+        mock_subprocess_popen.return_value.stdin.write.assert_called_with(
+            '.\0./etc')
+        tar_cmd = mock_subprocess_popen.call_args_list[-1][0][0]
+        self.assertIn('--format=posix', tar_cmd)
+
+        self.assertTrue(self.osimage.create_tarball())
+        self.assertEqual(self.osimage.get('tarball'), tarball)
+        self.assertEqual(os.listdir(self.path + '/torrents'),
+                         [tarball + '.tgz'])
+
+    @mock.patch('os.fchdir')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('os.chroot')
+    def test_pack_delta(self,
+                        mock_os_chroot,
+                        mock_subprocess_popen,
+                        mock_os_fchdir,
+                        ):
+
+        mock_subprocess_popen.return_value.stdout.read.side_effect = [
+            'full', '', 'full2', '', 'delta', '']
+        mock_subprocess_popen.return_value.returncode = 0
+
+        self.osimage.set('delta', True)
+        with open(self.path + '/oldfile', 'w') as f:
+            f.write('old')
+
+        self.assertTrue(self.osimage.create_tarball())
+        base = self.osimage.get('tarball')
+        self.assertFalse(self.osimage.get('delta_tarball'))
+        self.assertTrue(os.path.isfile(
+            self.path + '/torrents/' + base + '.manifest.gz'))
+
+        os.remove(self.path + '/oldfile')
+        self.assertTrue(self.osimage.create_tarball())
+
+        self.assertEqual(self.osimage.get('delta_base'), base)
+        delta = self.osimage.get('delta_tarball')
+        self.assertTrue(delta)
+
+        with open(self.path + '/torrents/' + delta + '.removed') as f:
+            self.assertEqual(f.read(), './oldfile\0')
+        with open(self.path + '/torrents/' + delta + '.tgz') as f:
+            self.assertEqual(f.read(), 'delta')
+
+        tar_cmd = mock_subprocess_popen.call_args_list[-1][0][0]
+        self.assertIn('--no-recursion', tar_cmd)
+
+    @mock.patch('os.fchdir')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('os.chroot')
+    def test_pack_delta_ctime(self,
+                              mock_os_chroot,
+                              mock_subprocess_popen,
+                              mock_os_fchdir,
+                              ):
+
+        mock_subprocess_popen.return_value.stdout.read.side_effect = [
+            'full', '', 'full2', '', 'delta', '']
+        mock_subprocess_popen.return_value.returncode = 0
+
+        image = self.path + '/image'
+        os.makedirs(image + '/usr/bin')
+        with open(image + '/usr/bin/ping', 'w') as f:
+            f.write('ping')
+
+        self.osimage.set('path', image)
+        self.osimage.set('delta', True)
+        self.assertTrue(self.osimage.create_tarball())
+
+        # same content and mtime, only ctime is changed, like on setcap
+        time.sleep(0.01)
+        ping = image + '/usr/bin/ping'
+        os.chmod(ping, os.stat(ping).st_mode)
+
+        write_tarball = self.osimage._write_tarball
+        with mock.patch.object(self.osimage, '_write_tarball',
+                               wraps=write_tarball) as mock_write:
+            self.assertTrue(self.osimage.create_tarball())
+
+        self.assertTrue(self.osimage.get('delta_tarball'))
+        # full tarball and delta
+        self.assertEqual(mock_write.call_count, 2)
+        self.assertEqual(mock_write.call_args[0][2], ['./usr/bin/ping'])
+
+    @mock.patch('os.fchdir')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('os.chroot')
+    def test_pack_incremental(self,
+                              mock_os_chroot,
+                              mock_subprocess_popen,
+                              mock_os_fchdir,
+                              ):
+
+        mock_subprocess_popen.return_value.stdout.read.side_effect = [
+            'segment', '', 'changed', '']
+        mock_subprocess_popen.return_value.returncode = 0
+
+        # tarballs are stored in sandbox, they should not be in the image
+        image = self.path + '/image'
+        os.makedirs(image + '/etc')
+        with open(image + '/etc/hostname', 'w') as f:
+            f.write('node001')
+
+        self.osimage.set('path', image)
+        self.osimage.set('incremental', True)
+
+        def tarball():
+            with open(self.path + '/torrents/' +
+                      self.osimage.get('tarball') + '.tgz') as f:
+                return f.read()
+
+        self.assertTrue(self.osimage.create_tarball())
+        self.assertTrue(self.osimage.get('tarball_segmented'))
+        # compressor and tar
+        self.assertEqual(mock_subprocess_popen.call_count, 2)
+
+        self.assertTrue(self.osimage.create_tarball())
+        self.assertEqual(mock_subprocess_popen.call_count, 2)
+        self.assertEqual(tarball(), 'segment')
+
+        with open(image + '/etc/hostname', 'w') as f:
+            f.write('node002')
+        os.utime(image + '/etc/hostname', (1, 1))
+
+        self.assertTrue(self.osimage.create_tarball())
+        self.assertEqual(mock_subprocess_popen.call_count, 4)
+        self.assertEqual(tarball(), 'changed')
+
+    @mock.patch('os.remove')
+    @mock.patch('os.close')
+    @mock.patch('os.fchdir')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('os.chroot')
+    @mock.patch('os.open')
+    def test_pack_tar_failed(self,
+                             mock_os_open,
+                             mock_os_chroot,
+                             mock_subprocess_popen,
+                             mock_os_fchdir,
+                             mock_os_close,
+                             mock_os_remove,
+                             ):
+
+        mock_subprocess_popen.return_value.stdout.read.return_value = ''
+        mock_subprocess_popen.return_value.returncode = 2
+
+        self.assertFalse(self.osimage.create_tarball())
+        self.assertFalse(self.osimage.get('tarball'))
+        self.assertTrue(mock_os_remove.called)
+
+    @mock.patch('os.open')
+    def test_pack_wo_tracker(self, mock_os_open):
+        self.assertFalse(self.osimage.create_tarball(torrent=True))
+        self.assertFalse(mock_os_open.called)
+
+    @mock.patch('subprocess.Popen')
+    def test_pack_squashfs(self, mock_subprocess_popen):
+
+        def mksquashfs(cmd, **kwargs):
+            with open(cmd[2], 'w') as f:
+                f.write('squashfs')
+            return mock.MagicMock(returncode=0)
+
+        mock_subprocess_popen.side_effect = mksquashfs
+
+        image = self.path + '/image'
+        os.makedirs(image)
+        self.osimage.set('path', image)
+        self.osimage.set('format', 'squashfs')
+        self.osimage.set('codec', 'zstd')
+
+        self.assertTrue(self.osimage.create_tarball())
+
+        tarball = self.osimage.get('tarball')
+        self.assertEqual(self.osimage.get('tarball_format'), 'squashfs')
+        self.assertEqual(os.listdir(self.path + '/torrents'),
+                         [tarball + '.squashfs'])
+        self.assertEqual(self.osimage._pieces[tarball]['hashes'],
+                         [hashlib.sha1('squashfs').digest()])
+
+        cmd = mock_subprocess_popen.call_args[0][0]
+        self.assertEqual(cmd[:3], ['/usr/sbin/mksquashfs', image,
+                                   self.path + '/torrents/' + tarball +
+                                   '.squashfs'])
+        self.assertIn('zstd', cmd)
+
+    @mock.patch('subprocess.Popen')
+    def test_pack_squashfs_reproducible(self, mock_subprocess_popen):
+
+        def mksquashfs(cmd, **kwargs):
+            # superblock stores build time unless it is given
+            mkfs_time = str(time.time())
+            if '-mkfs-time' in cmd:
+                mkfs_time = cmd[cmd.index('-mkfs-time') + 1]
+            with open(cmd[2], 'w') as f:
+                f.write('squashfs ' + mkfs_time)
+            return mock.MagicMock(returncode=0)
+
+        mock_subprocess_popen.side_effect = mksquashfs
+
+        image = self.path + '/image'
+        os.makedirs(image)
+        self.osimage.set('path', image)
+        self.osimage.set('format', 'squashfs')
+
+        self.assertTrue(self.osimage.create_tarball())
+        tarball = self.osimage.get('tarball')
+        tarball_hash = self.osimage.get('tarball_hash')
+
+        time.sleep(0.01)
+        self.assertTrue(self.osimage.create_tarball())
+        self.assertEqual(self.osimage.get('tarball'), tarball)
+        self.assertEqual(self.osimage.get('tarball_hash'), tarball_hash)
+        self.assertEqual(os.listdir(self.path + '/torrents'),
+                         [tarball + '.squashfs'])
+
+    def test_set_format(self):
+        self.assertTrue(self.osimage.set('format', 'squashfs'))
+        self.assertFalse(self.osimage.set('format', 'cpio'))
+
+    def test_set_codec(self):
+        self.assertTrue(self.osimage.set('codec', 'zstd'))
+        self.assertEqual(self.osimage.get('codec'), 'zstd')
+        self.assertFalse(self.osimage.set('codec', 'bzip2'))
+
     def test_create_torrent_wo_tarball(self):
 
         self.assertFalse(self.osimage.create_torrent())
@@ -260,7 +521,6 @@ class OsimageMethodsTests(unittest.TestCase):
     @mock.patch('os.path.exists')
     def test_create_torrent_default(*args):
         self = args[0]
-        args[5].return_value.stderr.readline.return_value = ''
         self.osimage.set('tarball', 'UUID')
         self.cluster.set('frontend_address', '127.0.0.1')
         self.cluster.set('frontend_port', 7050)
@@ -0,0 +1,593 @@
+import mock
+import socket
+import struct
+import urllib
+import unittest
+import tornado.web
+import tornado.testing
+
+import luna
+import getpass
+import binascii
+import datetime
+from helper_utils import Sandbox
+from libtorrent import bdecode
+
+
+class SwarmTests(unittest.TestCase):
+
+    def setUp(self):
+        print
+        self.swarm = luna.Swarm()
+
+    def test_set(self):
+        self.swarm.set(('10.0.0.1', 6881), {'status': 'started'})
+        self.swarm.set(('fe80::1', 6881), {'status': 'completed'})
+
+        self.assertEqual(len(self.swarm), 2)
+        self.assertEqual(self.swarm.complete, 1)
+        self.assertEqual(self.swarm.incomplete, 1)
+        self.assertEqual(
+            self.swarm.compact[4],
+            [socket.inet_aton('10.0.0.1') + '\x1a\xe1']
+        )
+        self.assertEqual(
+            self.swarm.compact[6],
+            [socket.inet_pton(socket.AF_INET6, 'fe80::1') + '\x1a\xe1']
+        )
+
+        self.swarm.set(('10.0.0.1', 6881), {'status': 'completed'})
+
+        self.assertEqual(self.swarm.complete, 2)
+        self.assertEqual(self.swarm.incomplete, 0)
+        self.assertEqual(len(self.swarm.active[4]), 1)
+
+    def test_deactivate(self):
+        for i in range(1, 4):
+            self.swarm.set(('10.0.0.%d' % i, 6881), {'status': 'started'})
+
+        self.swarm.deactivate(('10.0.0.1', 6881))
+        self.swarm.deactivate(('10.0.0.1', 6881))
+
+        self.assertEqual(self.swarm.incomplete, 2)
+        self.assertEqual(len(self.swarm), 3)
+        self.assertEqual(
+            sorted(self.swarm.active[4]),
+            [('10.0.0.2', 6881), ('10.0.0.3', 6881)]
+        )
+        for key in self.swarm.active[4]:
+            version, index = self.swarm.positions[key]
+            self.assertEqual(self.swarm.active[version][index], key)
+            self.assertEqual(self.swarm.compact[version][index],
+                             socket.inet_aton(key[0]) + '\x1a\xe1')
+
+        self.swarm.remove(('10.0.0.2', 6881))
+        self.assertEqual(len(self.swarm), 2)
+        self.assertEqual(self.swarm.active[4], [('10.0.0.3', 6881)])
+
+    def test_sample(self):
+        for i in range(1, 101):
+            self.swarm.set(('10.0.0.%d' % i, 6881), {})
+        self.swarm.set(('fe80::1', 6881), {})
+
+        peers = self.swarm.sample(10)
+        self.assertEqual(len(peers), 10)
+        self.assertEqual(len(set(peers)), 10)
+
+        peers = self.swarm.sample(200)
+        self.assertEqual(len(peers), 101)
+        self.assertIn(
+            ('fe80::1', 6881,
+             socket.inet_pton(socket.AF_INET6, 'fe80::1') + '\x1a\xe1'),
+            peers
+        )
+
+    def test_downloaded(self):
+        self.swarm.set(('10.0.0.1', 6881), {'status': 'started'})
+        self.swarm.set(('10.0.0.1', 6881), {'status': 'completed'})
+        self.swarm.set(('10.0.0.1', 6881), {'status': 'completed'})
+        self.swarm.set(('10.0.0.2', 6881), {'status': 'completed'})
+
+        self.swarm.deactivate(('10.0.0.1', 6881))
+
+        self.assertEqual(self.swarm.downloaded, 2)
+        self.assertEqual(self.swarm.complete, 1)
+
+    def test_zones(self):
+        for i in range(1, 5):
+            self.swarm.set(('10.0.0.%d' % i, 6881), {}, [('switch', 1)])
+        self.swarm.set(('10.0.0.5', 6881), {}, [('switch', 2)])
+
+        self.swarm.deactivate(('10.0.0.1', 6881))
+        self.swarm.set_zones(('10.0.0.2', 6881), [('switch', 2)])
+
+        self.assertEqual(
+            sorted(self.swarm.zones[('switch', 1)]),
+            [('10.0.0.3', 6881), ('10.0.0.4', 6881)]
+        )
+        for zone, keys in self.swarm.zones.items():
+            for index, key in enumerate(keys):
+                self.assertEqual(self.swarm.zone_positions[(zone, key)],
+                                 index)
+
+        self.swarm.deactivate(('10.0.0.3', 6881))
+        self.swarm.deactivate(('10.0.0.4', 6881))
+        self.assertNotIn(('switch', 1), self.swarm.zones)
+
+    def test_sample_zones(self):
+        for i in range(1, 101):
+            self.swarm.set(('10.0.0.%d' % i, 6881), {})
+        for i in range(1, 4):
+            self.swarm.set(('10.0.1.%d' % i, 6881), {}, [('switch', 1)])
+        self.swarm.set(('10.0.2.1', 6881), {}, [('seeder', )])
+
+        peers = self.swarm.sample(10, [('seeder', ), ('switch', 1)],
+                                  ('10.0.1.1', 6881))
+        ips = [ip for ip, _, _ in peers]
+
+        self.assertEqual(len(ips), 10)
+        self.assertEqual(len(set(ips)), 10)
+        self.assertEqual(ips[0], '10.0.2.1')
+        self.assertEqual(sorted(ips[1:3]), ['10.0.1.2', '10.0.1.3'])
+        self.assertNotIn('10.0.1.1', ips)
+
+
+class AnnounceIntervalTests(unittest.TestCase):
+
+    def setUp(self):
+        print
+
+    def test_fixed(self):
+        interval = luna.AnnounceInterval(10, 5)
+
+        self.assertEqual(interval.get(0), (10, 5))
+        self.assertEqual(interval.get(10000), (10, 5))
+        self.assertEqual(interval.longest, 11)
+
+    def test_scaled(self):
+        interval = luna.AnnounceInterval(10, 5, max_interval=120,
+                                         swarm_size=100)
+
+        self.assertEqual(interval.get(50), (10, 5))
+        self.assertEqual(interval.get(400), (40, 20))
+        self.assertEqual(interval.get(5000), (120, 60))
+        self.assertEqual(interval.longest, 121)
+
+        interval.max_interval = 0
+        self.assertEqual(interval.get(5000), (500, 250))
+        self.assertIsNone(interval.longest)
+
+    def test_bound(self):
+        interval = luna.AnnounceInterval(10, 5, max_interval=120,
+                                         swarm_size=100, jitter=10)
+
+        self.assertEqual(interval.bound(50), 12)
+        self.assertEqual(interval.bound(400), 45)
+        self.assertEqual(interval.bound(5000), interval.longest)
+
+        for i in range(100):
+            self.assertTrue(interval.get(400)[0] <= interval.bound(400))
+
+    def test_jitter(self):
+        interval = luna.AnnounceInterval(100, 50, jitter=10)
+
+        intervals = set()
+        for i in range(100):
+            value, min_value = interval.get(1)
+            self.assertTrue(90 <= value <= 110)
+            self.assertEqual(min_value, 50)
+            intervals.add(value)
+
+        self.assertTrue(len(intervals) > 1)
+
+
+class PeerStoreTests(unittest.TestCase):
+
+    def setUp(self):
+
+        print
+
+        self.sandbox = Sandbox()
+        self.db = self.sandbox.db
+
+        self.store = luna.PeerStore(self.db)
+        self.info_hash = binascii.hexlify('h' * 20)
+        self.peer_id = binascii.hexlify('p' * 20)
+
+    def tearDown(self):
+        self.sandbox.cleanup()
+
+    def make_old(self, seconds):
+        old = datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds)
+        for peer in self.store.swarms[self.info_hash].peers.values():
+            peer['updated'] = old
+
+    def test_update_get_peers(self):
+        self.store.update(self.info_hash, self.peer_id, '10.0.0.1', 6881,
+                          'started', 0, 10, 90)
+        self.store.update(self.info_hash, self.peer_id, '10.0.0.1', 6881,
+                          '', 0, 20, 80)
+
+        peers = self.store.get_peers(self.info_hash, 50)
+
+        self.assertEqual([(ip, port) for ip, port, _ in peers],
+                         [('10.0.0.1', 6881)])
+
+        peer = self.store.get_peer(self.info_hash, '10.0.0.1', 6881)
+        self.assertEqual(peer['status'], 'started')
+        self.assertEqual(peer['downloaded'], 20)
+
+        self.assertEqual(self.store.get_counters(self.info_hash), (0, 1, 0))
+        self.assertEqual(self.store.get_peers('unknown', 50), [])
+        self.assertEqual(self.store.get_swarm_size(self.info_hash), 1)
+        self.assertEqual(self.store.get_swarm_size('unknown'), 0)
+        self.assertEqual(self.store.get_counters('unknown'), (0, 0, 0))
+
+    def test_expire(self):
+        self.store.update(self.info_hash, self.peer_id, '10.0.0.1', 6881,
+                          'started', 0, 10, 90)
+        self.store.update(self.info_hash, self.store.luna_peer_id,
+                          '10.0.0.254', 6881, 'completed', 0, 100, 0)
+
+        self.store.expire()
+        self.assertEqual(len(self.store.get_peers(self.info_hash, 50)), 2)
+
+        self.make_old(120)
+        self.store.expire()
+
+        peers = self.store.get_peers(self.info_hash, 50)
+        self.assertEqual([(ip, port) for ip, port, _ in peers],
+                         [('10.0.0.254', 6881)])
+        self.assertEqual(self.store.get_counters(self.info_hash), (1, 0, 1))
+
+        self.make_old(7200)
+        self.store.expire()
+        self.assertNotIn(self.info_hash, self.store.swarms)
+
+    def test_expire_per_swarm(self):
+        self.store = luna.PeerStore(
+            self.db, announce_interval=luna.AnnounceInterval(
+                10, 5, max_interval=120, swarm_size=2))
+        big_hash = binascii.hexlify('b' * 20)
+
+        self.store.update(self.info_hash, self.peer_id, '10.0.0.1', 6881,
+                          'started', 0, 10, 90)
+        for i in range(4):
+            self.store.update(big_hash, self.peer_id, '10.0.1.%d' % i, 6881,
+                              'started', 0, 10, 90)
+
+        # small swarm announces every 10s and big one every 20s
+        old = datetime.datetime.utcnow() - datetime.timedelta(seconds=30)
+        for swarm in self.store.swarms.values():
+            for peer in swarm.peers.values():
+                peer['updated'] = old
+
+        self.store.expire()
+
+        self.assertEqual(self.store.get_swarm_size(self.info_hash), 0)
+        self.assertEqual(self.store.get_swarm_size(big_hash), 4)
+
+    def test_flush(self):
+        self.store.update(self.info_hash, self.peer_id, '10.0.0.1', 6881,
+                          'started', 0, 10, 90)
+
+        self.assertIsNone(self.db['tracker'].find_one())
+
+        self.store.flush()
+
+        doc = self.db['tracker'].find_one({'info_hash': self.info_hash})
+        self.assertEqual(doc['peer_id'], self.peer_id)
+        self.assertEqual(doc['ip'], '10.0.0.1')
+        self.assertEqual(doc['port'], 6881)
+        self.assertEqual(doc['downloaded'], 10)
+        self.assertEqual(doc['left'], 90)
+        self.assertEqual(self.store.dirty, set())
+
+    def test_flush_coalesce(self):
+        for downloaded in range(10):
+            self.store.update(self.info_hash, self.peer_id, '10.0.0.1', 6881,
+                              '', 0, downloaded, 10 - downloaded)
+        self.store.update(self.info_hash, self.peer_id, '10.0.0.2', 6881,
+                          'started', 0, 0, 10)
+
+        with mock.patch.object(self.store, '_upsert_many',
+                               wraps=self.store._upsert_many) as upsert:
+            self.store.flush()
+            self.store.flush()
+
+        self.assertEqual(upsert.call_count, 1)
+        self.assertEqual(len(upsert.call_args[0][1]), 2)
+        self.assertEqual(self.db['tracker'].find().count(), 2)
+
+        doc = self.db['tracker'].find_one({'ip': '10.0.0.1'})
+        self.assertEqual(doc['downloaded'], 9)
+
+    def test_flush_failure(self):
+        self.store.update(self.info_hash, self.peer_id, '10.0.0.1', 6881,
+                          'started', 0, 10, 90)
+
+        with mock.patch.object(self.store, '_upsert_many') as upsert:
+            upsert.side_effect = Exception
+            self.assertRaises(Exception, self.store.flush)
+
+        self.assertEqual(self.store.dirty,
+                         set([(self.info_hash, '10.0.0.1', 6881)]))
+
+        self.store.flush()
+        self.assertIsNotNone(self.db['tracker'].find_one())
+
+    @mock.patch('pymongo.version_tuple', (2, 8, 0))
+    def test_upsert_many_bulk(self):
+        store = luna.PeerStore(mock.MagicMock())
+        collection = store.mongo_db['tracker']
+
+        store._upsert_many('tracker', [({'ip': '10.0.0.1'}, {'$set': {}}),
+                                       ({'ip': '10.0.0.2'}, {'$set': {}})])
+
+        bulk = collection.initialize_unordered_bulk_op.return_value
+        self.assertEqual(bulk.find.call_count, 2)
+        self.assertEqual(bulk.execute.call_count, 1)
+        self.assertEqual(collection.update.call_count, 0)
+
+    def test_load(self):
+        other_store = luna.PeerStore(self.db)
+        self.store.load()
+
+        other_store.update(self.info_hash, self.peer_id, '10.0.0.2', 6881,
+                           'started', 0, 10, 90)
+        other_store.flush()
+
+        self.store.load()
+
+        peers = self.store.get_peers(self.info_hash, 50)
+        self.assertEqual([(ip, port) for ip, port, _ in peers],
+                         [('10.0.0.2', 6881)])
+        self.assertEqual(self.store.get_counters(self.info_hash), (0, 1, 0))
+
+        self.assertEqual(self.store.dirty, set())
+
+    def test_load_keeps_newer(self):
+        other_store = luna.PeerStore(self.db)
+        other_store.update(self.info_hash, self.peer_id, '10.0.0.1', 6881,
+                           'started', 0, 10, 90)
+        other_store.flush()
+
+        self.store.update(self.info_hash, self.peer_id, '10.0.0.1', 6881,
+                          '', 0, 50, 50)
+        self.store.load()
+
+        peer = self.store.get_peer(self.info_hash, '10.0.0.1', 6881)
+        self.assertEqual(peer['downloaded'], 50)
+
+    def test_topology(self):
+        self.store.policy = 'topology'
+        self.store.topology = {
+            '10.0.0.1': (('switch', 1), ('group', 1)),
+            '10.0.0.2': (('switch', 1), ('group', 1)),
+            '10.0.0.3': (('switch', 2), ('group', 1)),
+        }
+
+        for i in range(4, 100):
+            self.store.update(self.info_hash, self.peer_id, '10.0.1.%d' % i,
+                              6881, 'started', 0, 10, 90)
+        for i in range(1, 4):
+            self.store.update(self.info_hash, self.peer_id, '10.0.0.%d' % i,
+                              6881, 'started', 0, 10, 90)
+        self.store.update(self.info_hash, self.store.luna_peer_id,
+                          '10.0.0.254', 6881, 'completed', 0, 100, 0)
+
+        peers = self.store.get_peers(self.info_hash, 3, '10.0.0.1', 6881)
+
+        self.assertEqual([ip for ip, _, _ in peers],
+                         ['10.0.0.254', '10.0.0.2', '10.0.0.3'])
+
+    @mock.patch('rpm.TransactionSet')
+    @mock.patch('rpm.addMacro')
+    def test_load_topology(self,
+                           mock_rpm_addmacro,
+                           mock_rpm_transactionset,
+                           ):
+
+        packages = [
+            {'VERSION': '3.10', 'RELEASE': '999-el0', 'ARCH': 'x86_64'},
+        ]
+        mock_rpm_transactionset.return_value.dbMatch.return_value = packages
+
+        path = self.sandbox.path
+        luna.Cluster(mongo_db=self.db, create=True, path=path,
+                     user=getpass.getuser())
+        osimage = luna.OsImage(name='testosimage', path=path,
+                               mongo_db=self.db, create=True)
+        net = luna.Network(name='testnet', mongo_db=self.db, create=True,
+                           NETWORK='10.141.0.0', PREFIX=16)
+        switch = luna.Switch(name='switch01', network=net.name,
+                             ip='10.141.255.253', mongo_db=self.db,
+                             create=True)
+        group = luna.Group(name='testgroup', osimage=osimage.name,
+                           mongo_db=self.db, interfaces=['eth0'],
+                           create=True)
+        group.set_net_to_if('eth0', net.name)
+
+        node1 = luna.Node(group=group.name, mongo_db=self.db, create=True)
+        node1.set_switch(switch.name)
+        luna.Node(group=group.name, mongo_db=self.db, create=True)
+
+        self.store.policy = 'topology'
+        self.store.update(self.info_hash, self.peer_id, '10.141.0.1', 6881,
+                          'started', 0, 10, 90)
+        self.store.load_topology()
+
+        self.assertEqual(
+            self.store.topology,
+            {'10.141.0.1': (('switch', switch._id), ('group', group._id)),
+             '10.141.0.2': (('group', group._id), )}
+        )
+        self.assertEqual(
+            self.store.swarms[self.info_hash].zones[('switch', switch._id)],
+            [('10.141.0.1', 6881)]
+        )
+
+    @mock.patch('luna.tracker.PeerStore._upsert_many')
+    def test_sync_failure(self, mock_upsert):
+        mock_upsert.side_effect = Exception
+        self.store.update(self.info_hash, 'p' * 40, '10.141.0.1', 6881,
+                          'started', 0, 0, 100)
+
+        self.store.sync()
+
+        self.assertFalse(self.store.syncing)
+        self.assertEqual(len(self.store.dirty), 1)
+
+
+class ScrapeHandlerTests(tornado.testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        print
+        self.store = luna.PeerStore(mock.MagicMock())
+        self.info_hash = 'h' * 20
+        super(ScrapeHandlerTests, self).setUp()
+
+    def get_app(self):
+        params = {'luna_tracker_interval': 10,
+                  'luna_tracker_min_interval': 5,
+                  'luna_tracker_maxpeers': 200,
+                  'mongo_db': None,
+                  'peer_store': self.store}
+        return tornado.web.Application([
+            (r"/scrape.*", luna.ScrapeHandler, dict(params=params)),
+        ])
+
+    def scrape(self, query=''):
+        response = self.fetch('/scrape' + query)
+        self.assertEqual(response.code, 200)
+        return bdecode(response.body)
+
+    def test_scrape(self):
+        info_hash = binascii.hexlify(self.info_hash)
+        self.store.update(info_hash, binascii.hexlify('p' * 20),
+                          '10.0.0.1', 6881, 'started', 0, 0, 100)
+        self.store.update(info_hash, binascii.hexlify('p' * 20),
+                          '10.0.0.2', 6881, 'completed', 0, 100, 0)
+
+        expected = {'files': {self.info_hash: {'complete': 1,
+                                               'downloaded': 1,
+                                               'incomplete': 1}}}
+
+        self.assertEqual(self.scrape(), expected)
+        self.assertEqual(
+            self.scrape('?' + urllib.urlencode({'info_hash':
+                                                self.info_hash})),
+            expected
+        )
+
+    def test_scrape_unknown(self):
+        self.assertEqual(self.scrape(), {'files': {}})
+        self.assertEqual(
+            self.scrape('?info_hash=' + 'u' * 20),
+            {'files': {'u' * 20: {'complete': 0, 'downloaded': 0,
+                                  'incomplete': 0}}}
+        )
+
+
+class UDPTrackerTests(unittest.TestCase):
+
+    def setUp(self):
+        print
+        self.store = luna.PeerStore(mock.MagicMock())
+        self.tracker = luna.UDPTracker({'luna_tracker_interval': 10,
+                                        'luna_tracker_min_interval': 5,
+                                        'luna_tracker_maxpeers': 200,
+                                        'peer_store': self.store,
+                                        'udp_secret': 'secret'})
+        self.info_hash = 'h' * 20
+        self.addr = ('10.0.0.1', 6881)
+
+    def connect(self, addr=None):
+        addr = addr or self.addr
+        response = self.tracker.handle(
+            struct.pack('>QII', 0x41727101980, 0, 12345), addr)
+        action, transaction_id, connection_id = struct.unpack('>IIQ',
+                                                              response)
+        self.assertEqual((action, transaction_id), (0, 12345))
+        return connection_id
+
+    def announce(self, connection_id, addr=None, event=2, left=100,
+                 port=6881, ip=0):
+        return self.tracker.handle(
+            struct.pack('>QII20s20sQQQIIIiH', connection_id, 1, 54321,
+                        self.info_hash, 'p' * 20, 0, left, 0, event, ip,
+                        0, -1, port),
+            addr or self.addr)
+
+    def test_connect(self):
+        self.assertEqual(self.connect(), self.connect())
+        self.assertNotEqual(self.connect(), self.connect(('10.0.0.2', 6881)))
+
+        self.assertIsNone(
+            self.tracker.handle(struct.pack('>QII', 1, 0, 12345), self.addr)
+        )
+        self.assertIsNone(self.tracker.handle('short', self.addr))
+
+    @mock.patch('time.time')
+    def test_connection_id_expire(self, mock_time):
+        mock_time.return_value = 600
+        connection_id = self.connect()
+
+        mock_time.return_value = 690
+        self.assertTrue(self.tracker.check_connection_id(connection_id,
+                                                         self.addr))
+
+        mock_time.return_value = 720
+        self.assertFalse(self.tracker.check_connection_id(connection_id,
+                                                          self.addr))
+
+    def test_announce(self):
+        seeder_addr = ('10.0.0.254', 6881)
+        self.announce(self.connect(seeder_addr), seeder_addr, event=1,
+                      left=0)
+
+        response = self.announce(self.connect())
+
+        self.assertEqual(
+            struct.unpack('>IIIII', response[:20]),
+            (1, 54321, 10, 1, 1)
+        )
+        self.assertEqual(response[20:],
+                         socket.inet_aton('10.0.0.254') + '\x1a\xe1')
+
+        peer = self.store.get_peer(binascii.hexlify(self.info_hash),
+                                   '10.0.0.1', 6881)
+        self.assertEqual(peer['status'], 'started')
+        self.assertEqual(peer['left'], 100)
+
+    def test_announce_ip(self):
+        ip = struct.unpack('>I', socket.inet_aton('10.0.1.1'))[0]
+        self.announce(self.connect(), ip=ip)
+
+        self.assertIsNotNone(self.store.get_peer(
+            binascii.hexlify(self.info_hash), '10.0.1.1', 6881))
+
+    def test_announce_wrong_connection_id(self):
+        response = self.announce(1)
+
+        self.assertEqual(response,
+                         struct.pack('>II', 3, 54321) +
+                         'Connection ID mismatch')
+        self.assertEqual(self.store.swarms, {})
+
+    def test_scrape(self):
+        self.announce(self.connect())
+
+        response = self.tracker.handle(
+            struct.pack('>QII', self.connect(), 2, 777) +
+            self.info_hash + 'u' * 20,
+            self.addr)
+
+        self.assertEqual(
+            struct.unpack('>IIIIIIII', response),
+            (2, 777, 0, 0, 1, 0, 0, 0)
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
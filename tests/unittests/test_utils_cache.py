@@ -0,0 +1,109 @@
+import mock
+import unittest
+
+import luna
+import getpass
+from luna.utils import cache
+from helper_utils import Sandbox
+
+
+class UtilsCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        print
+        self.db = mock.MagicMock()
+        cache.configure()
+
+    def tearDown(self):
+        cache.clear()
+        cache.configure()
+
+    def test_get_put(self):
+        doc = {'_id': 1, 'name': 'node001', 'params': {'a': 1}}
+        cache.put(self.db, 'node', doc)
+
+        self.assertEqual(cache.get(self.db, 'node', id=1), doc)
+        self.assertEqual(cache.get(self.db, 'node', name='node001'), doc)
+        self.assertIsNone(cache.get(self.db, 'group', id=1))
+
+    def test_get_copy(self):
+        doc = {'_id': 1, 'name': 'node001', 'params': {'a': 1}}
+        cache.put(self.db, 'node', doc)
+
+        doc['params']['a'] = 2
+        cached = cache.get(self.db, 'node', id=1)
+        cached['params']['a'] = 3
+
+        self.assertEqual(cache.get(self.db, 'node', id=1)['params']['a'], 1)
+
+    def test_invalidate(self):
+        cache.put(self.db, 'node', {'_id': 1, 'name': 'node001'})
+        cache.invalidate(self.db, 'node', 1)
+
+        self.assertIsNone(cache.get(self.db, 'node', id=1))
+        self.assertIsNone(cache.get(self.db, 'node', name='node001'))
+
+    def test_separate_databases(self):
+        db2 = mock.MagicMock()
+        cache.put(self.db, 'node', {'_id': 1, 'name': 'node001'})
+
+        self.assertIsNone(cache.get(db2, 'node', id=1))
+
+    @mock.patch('time.time')
+    def test_ttl(self, mock_time):
+        cache.configure(ttl=5)
+
+        mock_time.return_value = 100
+        cache.put(self.db, 'node', {'_id': 1, 'name': 'node001'})
+
+        mock_time.return_value = 104
+        self.assertIsNotNone(cache.get(self.db, 'node', id=1))
+
+        mock_time.return_value = 106
+        self.assertIsNone(cache.get(self.db, 'node', id=1))
+
+    def test_disabled(self):
+        cache.configure(enabled=False)
+        cache.put(self.db, 'node', {'_id': 1, 'name': 'node001'})
+
+        self.assertIsNone(cache.get(self.db, 'node', id=1))
+
+
+class UtilsCacheObjectsTests(unittest.TestCase):
+
+    def setUp(self):
+
+        print
+
+        self.sandbox = Sandbox()
+        self.db = self.sandbox.db
+        self.path = self.sandbox.path
+
+        self.cluster = luna.Cluster(mongo_db=self.db, create=True,
+                                    path=self.path, user=getpass.getuser())
+
+        self.net = luna.Network(name='testnet', mongo_db=self.db, create=True,
+                                NETWORK='172.16.1.0', PREFIX=24)
+
+    def tearDown(self):
+        self.sandbox.cleanup()
+
+    def test_read_from_cache(self):
+        luna.Network(name='testnet', mongo_db=self.db)
+
+        with mock.patch.object(self.db['network'], 'find_one') as find_one:
+            net = luna.Network(name='testnet', mongo_db=self.db)
+            self.assertEqual(find_one.call_count, 0)
+
+        self.assertEqual(net.get('PREFIX'), 24)
+
+    def test_set_invalidates(self):
+        luna.Network(name='testnet', mongo_db=self.db)
+        self.net.set('PREFIX', 16)
+
+        net = luna.Network(name='testnet', mongo_db=self.db)
+        self.assertEqual(net.get('PREFIX'), 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
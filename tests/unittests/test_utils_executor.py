@@ -0,0 +1,79 @@
+import unittest
+import threading
+import tornado.gen
+import tornado.testing
+
+from luna.utils import executor
+
+
+class UtilsExecutorTests(unittest.TestCase):
+
+    def setUp(self):
+        print
+
+    def test_inline(self):
+        results = []
+
+        executor.Executor().run(lambda a, b: a + b, 1, b=2,
+                                callback=results.append)
+
+        self.assertEqual(results, [3])
+
+    def test_failure(self):
+        results = []
+
+        def fail():
+            raise ValueError('oops')
+
+        executor.Executor().run(fail, callback=results.append)
+
+        self.assertIsInstance(results[0], executor.Failure)
+        self.assertIs(results[0].exc_type, ValueError)
+
+
+class UtilsExecutorThreadsTests(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        print
+        super(UtilsExecutorThreadsTests, self).setUp()
+        self.executor = executor.Executor(workers=2, io_loop=self.io_loop)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super(UtilsExecutorThreadsTests, self).tearDown()
+
+    def test_threads(self):
+        main_thread = threading.current_thread()
+        threads = []
+
+        def call():
+            return threading.current_thread()
+
+        def callback(result):
+            threads.append((result, threading.current_thread()))
+            self.stop()
+
+        self.executor.run(call, callback=callback)
+        self.wait()
+
+        worker, callback_thread = threads[0]
+        self.assertIsNot(worker, main_thread)
+        self.assertIs(callback_thread, main_thread)
+
+    def test_gen_task(self):
+        results = []
+
+        @tornado.gen.engine
+        def coroutine():
+            result = yield tornado.gen.Task(self.executor.run, sum, [1, 2])
+            results.append(result)
+            self.stop()
+
+        coroutine()
+        self.wait()
+
+        self.assertEqual(results, [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+import mock
+import pymongo
+import unittest
+
+import luna
+import getpass
+from luna.utils import helpers
+from helper_utils import Sandbox
+
+
+class UtilsMongoClientTests(unittest.TestCase):
+
+    def setUp(self):
+        print
+        helpers._con_options = None
+        helpers._mongo_client = None
+        helpers._mongo_client_pid = None
+        helpers._mongo_db = None
+
+    def tearDown(self):
+        helpers._con_options = None
+        helpers._mongo_client = None
+        helpers._mongo_client_pid = None
+        helpers._mongo_db = None
+
+    @mock.patch('luna.utils.helpers._read_con_options')
+    def test_con_options_cached(self, mock_read):
+        mock_read.return_value = {'host': 'localhost'}
+
+        self.assertEqual(helpers.get_con_options(), {'host': 'localhost'})
+        self.assertEqual(helpers.get_con_options(), {'host': 'localhost'})
+        self.assertEqual(mock_read.call_count, 1)
+
+        helpers.get_con_options(reread=True)
+        self.assertEqual(mock_read.call_count, 2)
+
+    @mock.patch('luna.utils.helpers._read_con_options')
+    def test_con_options_copy(self, mock_read):
+        mock_read.return_value = {'host': 'localhost'}
+
+        opts = helpers.get_con_options()
+        opts['host'] = 'otherhost'
+
+        self.assertEqual(helpers.get_con_options(), {'host': 'localhost'})
+
+    @mock.patch('pymongo.MongoClient')
+    @mock.patch('luna.utils.helpers._read_con_options')
+    def test_client_shared(self, mock_read, mock_client):
+        mock_read.return_value = {'host': 'localhost'}
+
+        client1 = helpers.get_mongo_client()
+        client2 = helpers.get_mongo_client()
+
+        self.assertIs(client1, client2)
+        self.assertEqual(mock_client.call_count, 1)
+        mock_client.assert_called_with(host='localhost')
+
+    @mock.patch('os.getpid')
+    @mock.patch('pymongo.MongoClient')
+    @mock.patch('luna.utils.helpers._read_con_options')
+    def test_client_after_fork(self, mock_read, mock_client, mock_getpid):
+        mock_read.return_value = {'host': 'localhost'}
+
+        mock_getpid.return_value = 100
+        helpers.get_mongo_client()
+
+        mock_getpid.return_value = 101
+        helpers.get_mongo_client()
+
+        self.assertEqual(mock_client.call_count, 2)
+        self.assertEqual(helpers._mongo_client_pid, 101)
+
+    @mock.patch('pymongo.MongoClient')
+    @mock.patch('luna.utils.helpers._read_con_options')
+    def test_reset_client(self, mock_read, mock_client):
+        mock_read.return_value = {'host': 'localhost'}
+
+        client = helpers.get_mongo_client()
+        helpers.reset_mongo_client()
+
+        self.assertEqual(client.close.call_count, 1)
+        self.assertIsNone(helpers._mongo_client)
+
+        helpers.get_mongo_client()
+        self.assertEqual(mock_client.call_count, 2)
+
+    @mock.patch('pymongo.MongoClient')
+    @mock.patch('luna.utils.helpers._read_con_options')
+    def test_connection_failure(self, mock_read, mock_client):
+        mock_read.return_value = {'host': 'localhost'}
+        mock_client.side_effect = Exception
+
+        self.assertRaises(RuntimeError, helpers.get_mongo_db)
+        self.assertIsNone(helpers._mongo_client)
+
+
+class UtilsFindNodeTests(unittest.TestCase):
+
+    @mock.patch('rpm.TransactionSet')
+    @mock.patch('rpm.addMacro')
+    def setUp(self,
+              mock_rpm_addmacro,
+              mock_rpm_transactionset,
+              ):
+
+        print
+
+        packages = [
+            {'VERSION': '3.10', 'RELEASE': '999-el0', 'ARCH': 'x86_64'},
+        ]
+        mock_rpm_transactionset.return_value.dbMatch.return_value = packages
+
+        self.sandbox = Sandbox()
+        self.db = self.sandbox.db
+        self.path = self.sandbox.path
+
+        self.cluster = luna.Cluster(mongo_db=self.db, create=True,
+                                    path=self.path, user=getpass.getuser())
+
+        self.osimage = luna.OsImage(name='testosimage', path=self.path,
+                                    mongo_db=self.db, create=True)
+
+        self.group = luna.Group(name='testgroup',
+                                osimage=self.osimage.name,
+                                mongo_db=self.db, interfaces=['eth0'],
+                                create=True)
+
+        self.node = luna.Node(group=self.group.name, mongo_db=self.db,
+                              create=True)
+
+    def tearDown(self):
+        self.sandbox.cleanup()
+
+    def test_find_known_mac(self):
+        self.node.set_mac('00:11:22:33:44:55')
+
+        self.assertEqual(
+            helpers.find_node_by_macs(['', '00:11:22:33:44:55',
+                                       '00:11:22:33:44:66'], self.db),
+            (self.node._id, None)
+        )
+
+    def test_find_unknown_mac(self):
+        self.assertEqual(
+            helpers.find_node_by_macs(['00:11:22:33:44:66'], self.db),
+            (None, None)
+        )
+
+        self.assertEqual(
+            helpers.find_node_by_macs([''], self.db),
+            (None, None)
+        )
+
+    def test_set_mac_node(self):
+        if self.sandbox.dbtype != 'mongo':
+            raise unittest.SkipTest(
+                'This test can be run only with MongoDB as a backend.'
+            )
+
+        node2 = luna.Node(group=self.group.name, mongo_db=self.db,
+                          create=True)
+        self.node.set_mac('00:11:22:33:44:55')
+        node2.set_mac('00:11:22:33:44:66')
+
+        helpers.set_mac_node('00:11:22:33:44:55', node2.DBRef, self.db)
+
+        docs = list(self.db['mac'].find())
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['mac'], '00:11:22:33:44:55')
+        self.assertEqual(docs[0]['node'], node2.DBRef)
+
+    def test_set_mac_node_concurrent(self):
+        mongo_db = {'node_params': mock.MagicMock(), 'mac': mock.MagicMock()}
+        mongo_db['mac'].update.side_effect = [
+            pymongo.errors.DuplicateKeyError('E11000'), None]
+
+        self.assertTrue(helpers.set_mac_node('00:11:22:33:44:55',
+                                             self.node.DBRef, mongo_db))
+
+        self.assertEqual(mongo_db['mac'].update.call_count, 2)
+        self.assertFalse(mongo_db['mac'].insert.called)
+
+    def test_set_mac_node_failed(self):
+        mongo_db = {'node_params': mock.MagicMock(), 'mac': mock.MagicMock()}
+        mongo_db['mac'].update.side_effect = \
+            pymongo.errors.DuplicateKeyError('E11000')
+
+        self.assertFalse(helpers.set_mac_node('00:11:22:33:44:55',
+                                              self.node.DBRef, mongo_db))
+        self.assertEqual(mongo_db['mac'].update.call_count, 3)
+
+        # node reports the failure
+        self.node._mongo_db = mongo_db
+        self.assertFalse(self.node.set_mac('00:11:22:33:44:55'))
+
+    def test_set_mac_node_invalidate(self):
+        calls = mock.MagicMock()
+        mongo_db = {'node_params': calls.node_params, 'mac': calls.mac}
+
+        helpers.set_mac_node('00:11:22:33:44:55', self.node.DBRef, mongo_db)
+
+        # params computed from the old mapping are dropped
+        self.assertEqual([name for name, args, kwargs in calls.mock_calls],
+                         ['mac.remove', 'mac.update',
+                          'node_params.update', 'node_params.remove'])
+
+    def test_find_learned_mac(self):
+        if self.sandbox.dbtype != 'mongo':
+            raise unittest.SkipTest(
+                'This test can be run only with MongoDB as a backend.'
+            )
+
+        net = luna.Network(name='testnet', mongo_db=self.db, create=True,
+                           NETWORK='10.50.0.0', PREFIX=16)
+        switch = luna.Switch(name='switch01', network=net.name,
+                             ip='10.50.0.254', mongo_db=self.db, create=True)
+
+        self.node.set_switch(switch.name)
+        self.node.set('port', 'Gi1/0/2')
+
+        self.db['switch_mac'].insert({'switch_id': switch._id,
+                                      'mac': '00:11:22:33:44:55',
+                                      'port': '2', 'portname': 'Gi1/0/2'})
+
+        self.assertEqual(
+            helpers.find_node_by_macs(['00:11:22:33:44:55'], self.db),
+            (self.node._id, '00:11:22:33:44:55')
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import time
+import mock
+import shutil
+import unittest
+import tempfile
+
+from luna.utils import manifest
+
+
+class UtilsManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        print
+        self.path = tempfile.mkdtemp(prefix='luna-manifest.')
+        os.makedirs(self.path + '/etc/sysconfig')
+        with open(self.path + '/etc/hostname', 'w') as f:
+            f.write('node001')
+        os.symlink('hostname', self.path + '/etc/link')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_build(self):
+        m = manifest.build(self.path)
+
+        self.assertEqual(sorted(m), ['.', './etc', './etc/hostname',
+                                     './etc/link', './etc/sysconfig'])
+        self.assertEqual(m['./etc/hostname']['size'], 7)
+        self.assertEqual(m['./etc/hostname']['hash'],
+                         manifest.file_hash(self.path + '/etc/hostname'))
+        self.assertEqual(m['./etc/link']['link'], 'hostname')
+
+    def test_diff(self):
+        old = manifest.build(self.path)
+
+        with open(self.path + '/etc/hostname', 'w') as f:
+            f.write('node002')
+        os.utime(self.path + '/etc/hostname', (1, 1))
+        os.rmdir(self.path + '/etc/sysconfig')
+        os.remove(self.path + '/etc/link')
+        os.mkdir(self.path + '/etc/link')
+        os.utime(self.path + '/etc', (2, 2))
+
+        changed, removed = manifest.diff(old, manifest.build(self.path))
+
+        self.assertEqual(changed, ['./etc', './etc/hostname', './etc/link'])
+        self.assertEqual(removed, ['./etc/link', './etc/sysconfig'])
+
+    def test_diff_removed_dir(self):
+        old = manifest.build(self.path)
+        shutil.rmtree(self.path + '/etc')
+
+        changed, removed = manifest.diff(old, manifest.build(self.path))
+
+        self.assertEqual(removed, ['./etc'])
+
+    def test_hash_reused(self):
+        old = manifest.build(self.path)
+
+        with mock.patch.object(manifest, 'file_hash') as mock_file_hash:
+            m = manifest.build(self.path, old)
+            self.assertFalse(mock_file_hash.called)
+
+            os.utime(self.path + '/etc/hostname', (1, 1))
+            manifest.build(self.path, old)
+            mock_file_hash.assert_called_once_with(self.path + '/etc/hostname')
+
+        self.assertEqual(m, old)
+
+    def test_hash_not_reused(self):
+        path = self.path + '/etc/hostname'
+        old = manifest.build(self.path)
+
+        # rewritten within the same second
+        with open(path, 'w') as f:
+            f.write('node002')
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, int(st.st_mtime) + 0.5))
+        m = manifest.build(self.path, old)
+        self.assertEqual(m['./etc/hostname']['hash'], manifest.file_hash(path))
+        self.assertNotEqual(m['./etc/hostname']['hash'],
+                            old['./etc/hostname']['hash'])
+
+        # only ctime is changed, like on setting xattrs
+        old = m
+        time.sleep(0.01)
+        os.chmod(path, os.stat(path).st_mode)
+        with mock.patch.object(manifest, 'file_hash') as mock_file_hash:
+            mock_file_hash.return_value = old['./etc/hostname']['hash']
+            m = manifest.build(self.path, old)
+            mock_file_hash.assert_called_once_with(path)
+
+        self.assertEqual(m['./etc/hostname']['mtime'],
+                         old['./etc/hostname']['mtime'])
+        changed, removed = manifest.diff(old, m)
+        self.assertEqual(changed, ['./etc/hostname'])
+        self.assertEqual(removed, [])
+
+    @mock.patch.object(manifest, 'GROUP_PATHS', 1)
+    def test_groups(self):
+        with open(self.path + '/etc/passwd', 'w') as f:
+            f.write('root:x:0:0:root:/root:/bin/bash')
+
+        old = manifest.groups(manifest.build(self.path))
+        self.assertEqual([paths for key, paths in old],
+                         [['.'], ['./etc'], ['./etc/hostname'], ['./etc/link'],
+                          ['./etc/passwd'], ['./etc/sysconfig']])
+
+        with open(self.path + '/etc/hostname', 'w') as f:
+            f.write('node002')
+        os.utime(self.path + '/etc/hostname', (1, 1))
+        os.utime(self.path + '/etc', (2, 2))
+
+        new = manifest.groups(manifest.build(self.path))
+        self.assertEqual([old[i][0] == new[i][0] for i in range(len(old))],
+                         [True, False, False, True, True, True])
+
+        # owner names in all segments depend on passwd
+        with open(self.path + '/etc/passwd', 'w') as f:
+            f.write('root:x:0:0:root:/root:/bin/sh')
+
+        changed = manifest.groups(manifest.build(self.path))
+        self.assertFalse(set([key for key, paths in new]) &
+                         set([key for key, paths in changed]))
+
+    def test_save_load(self):
+        with open(self.path + '/etc/\xff', 'w') as f:
+            f.write('')
+
+        m = manifest.build(self.path)
+        manifest.save(self.path + '/manifest.gz', m,
+                      segments=[['key', 0, 100]])
+
+        info = manifest.load(self.path + '/manifest.gz')
+        self.assertEqual(info['files'], m)
+        self.assertEqual(info['segments'], [['key', 0, 100]])
+        self.assertIsNone(manifest.load(self.path + '/nonexistent.gz'))
+
+        with mock.patch.object(manifest, 'VERSION', manifest.VERSION + 1):
+            self.assertIsNone(manifest.load(self.path + '/manifest.gz'))
+
+
+if __name__ == '__main__':
+    unittest.main()
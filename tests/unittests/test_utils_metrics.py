@@ -0,0 +1,187 @@
+import mock
+import unittest
+import threading
+import tornado.web
+import tornado.testing
+
+import luna
+import getpass
+import binascii
+from luna.utils import metrics
+from helper_utils import Sandbox
+
+
+class UtilsMetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        print
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_counters(self):
+        metrics.inc('announces_total', protocol='udp')
+        metrics.inc('announces_total', 2, protocol='udp')
+        metrics.inc('announces_total', protocol='http')
+
+        self.assertEqual(metrics.value('announces_total', protocol='udp'), 3)
+        self.assertEqual(metrics.value('announces_total', protocol='http'), 1)
+        self.assertEqual(metrics.value('announces_total'), 0)
+
+    def test_histogram(self):
+        for val in [0.001, 0.003, 0.2, 20]:
+            metrics.observe('request_seconds', val, handler='manager')
+
+        text = metrics.render(metrics.collect())
+
+        self.assertIn('# TYPE luna_request_seconds histogram', text)
+        self.assertIn(
+            'luna_request_seconds_bucket{handler="manager",le="0.001"} 1',
+            text)
+        self.assertIn(
+            'luna_request_seconds_bucket{handler="manager",le="0.005"} 2',
+            text)
+        self.assertIn(
+            'luna_request_seconds_bucket{handler="manager",le="+Inf"} 4',
+            text)
+        self.assertIn('luna_request_seconds_count{handler="manager"} 4', text)
+
+    def test_threads(self):
+        def worker():
+            for i in range(1000):
+                metrics.inc('mongo_ops_total')
+                metrics.observe('request_seconds', 0.01)
+
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        worker()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(metrics.value('mongo_ops_total'), 5000)
+        self.assertEqual(
+            sum(metrics.snapshot()['histograms'][0][3]), 5000)
+
+    @mock.patch('time.time')
+    def test_rates(self, mock_time):
+        db = mock.MagicMock()
+
+        mock_time.return_value = 100
+        metrics.inc('announces_total', 10)
+        metrics.publish(db)
+
+        mock_time.return_value = 105
+        metrics.inc('announces_total', 50)
+        metrics.publish(db)
+
+        self.assertEqual(
+            metrics.collect()['gauges'][('announces_per_second', ())],
+            10.0
+        )
+
+
+class UtilsMetricsMongoTests(unittest.TestCase):
+
+    def setUp(self):
+
+        print
+
+        metrics.reset()
+        self.sandbox = Sandbox()
+        self.db = self.sandbox.db
+        self.path = self.sandbox.path
+
+        self.cluster = luna.Cluster(mongo_db=self.db, create=True,
+                                    path=self.path, user=getpass.getuser())
+
+    def tearDown(self):
+        metrics.reset()
+        self.sandbox.cleanup()
+
+    def test_collect(self):
+        metrics.inc('requests_total', handler='manager')
+        metrics.observe('request_seconds', 0.01, handler='manager')
+        metrics.publish(self.db)
+
+        # another lweb process
+        doc = self.db[metrics.collection].find_one()
+        doc['_id'] = 'otherhost:1'
+        self.db[metrics.collection].insert(doc)
+
+        metrics.inc('requests_total', handler='manager')
+
+        merged = metrics.collect(self.db)
+
+        self.assertEqual(
+            merged['counters'][('requests_total', (('handler', 'manager'),))],
+            3
+        )
+        self.assertEqual(
+            merged['histograms'][('request_seconds',
+                                  (('handler', 'manager'),))][1][3],
+            2
+        )
+
+    def test_counting_database(self):
+        counting_db = metrics.CountingDatabase(self.db)
+
+        luna.Network(name='testnet', mongo_db=counting_db, create=True,
+                     NETWORK='172.16.1.0', PREFIX=24)
+        ops = metrics.value('mongo_ops_total')
+        self.assertTrue(ops > 0)
+
+        counting_db['network'].find_one({'name': 'testnet'})
+        self.assertEqual(metrics.value('mongo_ops_total'), ops + 1)
+
+        self.assertEqual(counting_db.name, self.db.name)
+
+
+class MetricsHandlerTests(tornado.testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        print
+        metrics.reset()
+        self.db = {'osimage': mock.MagicMock(),
+                   metrics.collection: mock.MagicMock()}
+        self.db['osimage'].find.return_value = [
+            {'name': 'compute', 'info_hash': binascii.hexlify('h' * 20)}
+        ]
+        self.store = luna.PeerStore(mock.MagicMock())
+        super(MetricsHandlerTests, self).setUp()
+
+    def tearDown(self):
+        metrics.reset()
+        super(MetricsHandlerTests, self).tearDown()
+
+    def get_app(self):
+        params = {'mongo_db': self.db, 'peer_store': self.store}
+        return tornado.web.Application([
+            (r"/metrics", luna.MetricsHandler, dict(params=params)),
+        ])
+
+    def test_metrics(self):
+        self.db[metrics.collection].find.return_value = []
+        for i, left in enumerate([0, 100, 200]):
+            self.store.update(binascii.hexlify('h' * 20),
+                              binascii.hexlify('p' * 20), '10.0.0.%d' % i,
+                              6881, 'completed' if not left else 'started',
+                              0, 0, left)
+        metrics.inc('announces_total', protocol='http')
+
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+
+        labels = '{{info_hash="{}",osimage="compute"}}'.format(
+            binascii.hexlify('h' * 20))
+        self.assertIn('luna_swarm_peers' + labels + ' 3', response.body)
+        self.assertIn('luna_swarm_bytes_left' + labels + ' 300',
+                      response.body)
+        self.assertIn('luna_swarm_leechers' + labels + ' 2', response.body)
+        self.assertIn('luna_announces_total{protocol="http"} 1',
+                      response.body)
+
+
+if __name__ == '__main__':
+    unittest.main()
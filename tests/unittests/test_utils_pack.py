@@ -0,0 +1,103 @@
+import os
+import shutil
+import tarfile
+import unittest
+import hashlib
+import tempfile
+import StringIO
+
+from luna.utils import pack
+
+
+class UtilsPackTests(unittest.TestCase):
+
+    def setUp(self):
+        print
+
+    def test_tarball_name(self):
+        self.assertEqual(pack.tarball_name('UUID'), 'UUID.tgz')
+        self.assertEqual(pack.tarball_name('UUID', 'zstd'), 'UUID.tar.zst')
+        self.assertEqual(pack.tarball_name('UUID', 'none'), 'UUID.tar')
+        self.assertEqual(pack.tarball_name('UUID', 'zstd', 'squashfs'),
+                         'UUID.squashfs')
+
+    def test_piece_hasher(self):
+        hasher = pack.PieceHasher(piece_size=4)
+
+        for data in ['ab', 'cdefg', '', 'hij']:
+            hasher.update(data)
+
+        self.assertEqual(hasher.size, 10)
+        self.assertEqual(
+            hasher.finish(),
+            [hashlib.sha1(p).digest() for p in ['abcd', 'efgh', 'ij']]
+        )
+
+    def test_piece_hasher_aligned(self):
+        hasher = pack.PieceHasher(piece_size=4)
+        hasher.update('abcdefgh')
+
+        self.assertEqual(
+            hasher.finish(),
+            [hashlib.sha1(p).digest() for p in ['abcd', 'efgh']]
+        )
+
+    def test_piece_hasher_workers(self):
+        data = ''.join([chr(i) * 3 for i in range(40)])
+        serial = pack.PieceHasher(piece_size=8)
+        parallel = pack.PieceHasher(piece_size=8, workers=2)
+
+        for i in range(0, len(data), 5):
+            serial.update(data[i:i + 5])
+            parallel.update(data[i:i + 5])
+
+        self.assertEqual(parallel.size, serial.size)
+        self.assertEqual(parallel.finish(), serial.finish())
+
+    def test_copy_stream(self):
+        data = 'x' * (pack.BUF_SIZE + 10)
+        dst = StringIO.StringIO()
+        hasher = pack.PieceHasher()
+
+        copied = pack.copy_stream(StringIO.StringIO(data), dst, hasher)
+
+        self.assertEqual(copied, len(data))
+        self.assertEqual(dst.getvalue(), data)
+        self.assertEqual(hasher.finish(), [hashlib.sha1(data).digest()])
+
+    def test_copy_stream_size(self):
+        src = StringIO.StringIO('0123456789')
+        src.seek(2)
+        dst = StringIO.StringIO()
+
+        self.assertEqual(pack.copy_stream(src, dst, size=5), 5)
+        self.assertEqual(dst.getvalue(), '23456')
+        self.assertEqual(pack.copy_stream(src, dst, size=5), 3)
+
+    def test_write_accounts(self):
+        root = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(root, pack.accounts_name('UUID'))
+            os.mkdir(os.path.join(root, 'etc'))
+            with open(os.path.join(root, 'etc', 'passwd'), 'w') as f:
+                f.write('root:x:0:0:root:/root:/bin/bash\n')
+
+            self.assertFalse(pack.write_accounts(root, filename))
+            self.assertFalse(os.path.exists(filename))
+
+            with open(os.path.join(root, 'etc', 'group'), 'w') as f:
+                f.write('root:x:0:\n')
+
+            self.assertTrue(pack.write_accounts(root, filename))
+
+            tar = tarfile.open(filename)
+            self.assertEqual(tar.getnames(), ['./etc/passwd', './etc/group'])
+            self.assertEqual(tar.extractfile('./etc/group').read(),
+                             'root:x:0:\n')
+            tar.close()
+        finally:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from luna.utils import metrics
+from luna.utils import templates
+
+
+class UtilsTemplatesTests(unittest.TestCase):
+
+    def setUp(self):
+        print
+        templates.reset()
+        metrics.reset()
+        self.path = tempfile.mkdtemp(prefix='luna')
+        self.write('templ_test.cfg', 'name={{ node }}')
+
+    def tearDown(self):
+        templates.reset()
+        metrics.reset()
+        shutil.rmtree(self.path)
+
+    def write(self, name, text):
+        with open(os.path.join(self.path, name), 'w') as f:
+            f.write(text)
+
+    def test_render(self):
+        self.assertEqual(
+            templates.render(self.path, 'templ_test.cfg', node='node<1>'),
+            'name=node&lt;1&gt;'
+        )
+        self.assertEqual(
+            templates.render(self.path, 'templ_test.cfg', autoescape=None,
+                             node='node<1>'),
+            'name=node<1>'
+        )
+
+    def test_loader_shared(self):
+        self.assertIs(
+            templates.load(self.path, 'templ_test.cfg'),
+            templates.load(self.path + '/', 'templ_test.cfg')
+        )
+        self.assertIs(templates.get_loader(self.path),
+                      templates.get_loader(self.path))
+
+    def test_file_changed(self):
+        templates.render(self.path, 'templ_test.cfg', node='node001')
+        version = templates.version(self.path, 'templ_test.cfg')
+
+        self.write('templ_test.cfg', 'hostname={{ node }}')
+        mtime = time.time() + 10
+        os.utime(os.path.join(self.path, 'templ_test.cfg'), (mtime, mtime))
+
+        self.assertNotEqual(templates.version(self.path, 'templ_test.cfg'),
+                            version)
+        self.assertEqual(
+            templates.render(self.path, 'templ_test.cfg', node='node001'),
+            'hostname=node001'
+        )
+
+    def test_include_changed(self):
+        self.write('templ_part.cfg', 'part={{ node }}')
+        self.write('templ_main.cfg', '{% include "templ_part.cfg" %}')
+
+        self.assertEqual(
+            templates.render(self.path, 'templ_main.cfg', node='node001'),
+            'part=node001'
+        )
+        version = templates.version(self.path, 'templ_main.cfg')
+
+        self.write('templ_part.cfg', 'changed={{ node }}')
+        mtime = time.time() + 10
+        os.utime(os.path.join(self.path, 'templ_part.cfg'), (mtime, mtime))
+
+        self.assertNotEqual(templates.version(self.path, 'templ_main.cfg'),
+                            version)
+        self.assertEqual(
+            templates.render(self.path, 'templ_main.cfg', node='node001'),
+            'changed=node001'
+        )
+
+    def test_version_include_first_render(self):
+        self.write('templ_part.cfg', 'part={{ node }}')
+        self.write('templ_main.cfg', '{% include "templ_part.cfg" %}')
+
+        version = templates.version(self.path, 'templ_main.cfg')
+        self.assertEqual(templates.version(self.path, 'templ_main.cfg'),
+                         version)
+
+        mtime = time.time() + 10
+        os.utime(os.path.join(self.path, 'templ_part.cfg'), (mtime, mtime))
+        self.assertNotEqual(templates.version(self.path, 'templ_main.cfg'),
+                            version)
+
+    def test_render_timed(self):
+        templates.render(self.path, 'templ_test.cfg', node='node001')
+
+        histograms = metrics.snapshot()['histograms']
+        self.assertEqual(len(histograms), 1)
+        name, labels, buckets, counts, total = histograms[0]
+        self.assertEqual(name, 'template_render_seconds')
+        self.assertEqual(labels, [['template', 'templ_test.cfg']])
+        self.assertEqual(sum(counts), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()